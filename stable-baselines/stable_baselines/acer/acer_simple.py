@@ -12,6 +12,7 @@ from stable_baselines.acer.buffer import Buffer
 from stable_baselines.common import ActorCriticRLModel, tf_util, SetVerbosity, TensorboardWriter
 from stable_baselines.common.runners import AbstractEnvRunner
 from stable_baselines.common.policies import ActorCriticPolicy, RecurrentActorCriticPolicy
+from stable_baselines.common.vec_env import VecFrameStack
 
 
 def strip(var, n_envs, n_steps, flat=False):
@@ -486,7 +487,9 @@ class ACER(ActorCriticRLModel):
             episode_stats = EpisodeStats(self.n_steps, self.n_envs)
 
             if self.replay_ratio > 0:
-                buffer = Buffer(env=self.env, n_steps=self.n_steps, size=self.buffer_size)
+                # Store the frames of a VecFrameStack once, instead of n_stack times
+                n_stack = self.env.n_stack if isinstance(self.env, VecFrameStack) else 1
+                buffer = Buffer(env=self.env, n_steps=self.n_steps, size=self.buffer_size, n_stack=n_stack)
             else:
                 buffer = None
 
@@ -2,17 +2,21 @@ import numpy as np
 
 
 class Buffer(object):
-    def __init__(self, env, n_steps, size=50000):
+    def __init__(self, env, n_steps, size=50000, n_stack=1):
         """
         A buffer for observations, actions, rewards, mu's, states, masks and dones values
 
         :param env: (Gym environment) The environment to learn from
         :param n_steps: (int) The number of steps to run for each environment
         :param size: (int) The buffer size in number of steps
+        :param n_stack: (int) The number of frames stacked on the last axis of the observations (e.g. by
+            VecFrameStack). If greater than 1, only the newest frame of each step is stored, and the stacks are
+            rebuilt when sampling.
         """
         self.n_env = env.num_envs
         self.n_steps = n_steps
         self.n_batch = self.n_env * self.n_steps
+        self.n_stack = n_stack
         # Each loc contains n_env * n_steps frames, thus total buffer is n_env * size frames
         self.size = size // self.n_steps
 
@@ -28,6 +32,16 @@ class Buffer(object):
                 self.obs_dim = 1
             self.obs_dtype = np.float32
 
+        if self.raw_pixels:
+            self.obs_shape = [self.height, self.width, self.n_channels]
+        else:
+            self.obs_shape = [self.obs_dim]
+        assert self.obs_shape[-1] % n_stack == 0, \
+            "The last axis of the observations ({}) is not divisible by n_stack ({})".format(self.obs_shape[-1],
+                                                                                             n_stack)
+        # Shape of a single (unstacked) frame
+        self.frame_shape = self.obs_shape[:-1] + [self.obs_shape[-1] // n_stack]
+
         # Memory
         self.enc_obs = None
         self.actions = None
@@ -59,32 +73,50 @@ class Buffer(object):
         """
         return self.num_in_buffer > 0
 
-    def decode(self, enc_obs):
+    def encode(self, enc_obs):
+        """
+        Get the frames to store for a rollout of stacked observations: the frames of the first observation,
+        followed by the newest frame of each of the next observations
+
+        :param enc_obs: (np.ndarray) the stacked observations, of shape [n_env, n_steps + 1, ..., n_stack * nc]
+        :return: (np.ndarray) the frames, of shape [n_env, n_steps + n_stack, ..., nc]
+        """
+        enc_obs = np.reshape(enc_obs, [self.n_env, self.n_steps + 1] + self.obs_shape)
+        if self.n_stack == 1:
+            return enc_obs
+        n_channels = self.frame_shape[-1]
+        # [n_env, ..., n_stack, nc] -> [n_env, n_stack, ..., nc]
+        first_frames = np.moveaxis(enc_obs[:, 0].reshape([self.n_env] + self.frame_shape[:-1] +
+                                                         [self.n_stack, n_channels]), -2, 1)
+        return np.concatenate((first_frames, enc_obs[:, 1:, ..., -n_channels:]), axis=1)
+
+    def decode(self, enc_obs, masks=None):
         """
         Get the stacked frames of an observation
         
         :param enc_obs: ([float]) the encoded observation
+        :param masks: ([bool]) the episode starts of the observations, of shape [n_env, n_steps + 1]. Only used
+            to rebuild the frame stacks, which are reset at the start of an episode
         :return: ([float]) the decoded observation
         """
-        # enc_obs has shape [n_envs, n_steps + 1, nh, nw, nc]
-        # dones has shape [n_envs, n_steps, nh, nw, nc]
-        # returns stacked obs of shape [n_env, (n_steps + 1), nh, nw, nc]
-        n_env, n_steps = self.n_env, self.n_steps
-        if self.raw_pixels:
-            obs_dim = [self.height, self.width, self.n_channels]
-        else:
-            obs_dim = [self.obs_dim]
-
-        obs = np.zeros([1, n_steps + 1, n_env] + obs_dim, dtype=self.obs_dtype)
-        # [n_steps + nstack, n_env, nh, nw, nc]
-        x_var = np.reshape(enc_obs, [n_env, n_steps + 1] + obs_dim).swapaxes(1, 0)
-        obs[-1, :] = x_var
-
-        if self.raw_pixels:
-            obs = obs.transpose((2, 1, 3, 4, 0, 5))
-        else:
-            obs = obs.transpose((2, 1, 3, 0))
-        return np.reshape(obs, [n_env, (n_steps + 1)] + obs_dim[:-1] + [obs_dim[-1]])
+        # enc_obs has shape [n_envs, n_steps + n_stack, nh, nw, nc]
+        # returns stacked obs of shape [n_env, (n_steps + 1), nh, nw, n_stack * nc]
+        n_env, n_steps, n_stack = self.n_env, self.n_steps, self.n_stack
+        if n_stack == 1:
+            return np.reshape(enc_obs, [n_env, n_steps + 1] + self.obs_shape)
+
+        # The stack of the step t is made of the frames t, ..., t + n_stack - 1
+        frame_idxes = np.arange(n_steps + 1)[:, None] + np.arange(n_stack)[None, :]
+        # [n_env, n_steps + 1, n_stack, nh, nw, nc]
+        obs = enc_obs[:, frame_idxes]
+        # A frame is zeroed if an episode started after it, up to the step of the stack
+        n_starts = np.concatenate((np.zeros((n_env, 1), dtype=np.int64), np.cumsum(masks[:, 1:], axis=1)), axis=1)
+        frame_steps = np.maximum(frame_idxes - (n_stack - 1), 0)
+        keep = n_starts[:, :, None] == n_starts[:, frame_steps]
+        obs *= keep.reshape(keep.shape + (1,) * (obs.ndim - keep.ndim)).astype(obs.dtype)
+        # [n_env, n_steps + 1, nh, nw, n_stack, nc]
+        obs = np.moveaxis(obs, 2, -2)
+        return np.reshape(obs, [n_env, n_steps + 1] + self.obs_shape)
 
     def put(self, enc_obs, actions, rewards, mus, dones, masks):
         """
@@ -97,17 +129,18 @@ class Buffer(object):
         :param dones: ([bool])
         :param masks: ([bool])
         """
-        # enc_obs [n_env, (n_steps + n_stack), nh, nw, nc]
+        # enc_obs [n_env, (n_steps + 1), nh, nw, n_stack * nc]
         # actions, rewards, dones [n_env, n_steps]
         # mus [n_env, n_steps, n_act]
+        enc_obs = self.encode(enc_obs)
 
         if self.enc_obs is None:
             self.enc_obs = np.empty([self.size] + list(enc_obs.shape), dtype=self.obs_dtype)
             self.actions = np.empty([self.size] + list(actions.shape), dtype=np.int32)
             self.rewards = np.empty([self.size] + list(rewards.shape), dtype=np.float32)
             self.mus = np.empty([self.size] + list(mus.shape), dtype=np.float32)
-            self.dones = np.empty([self.size] + list(dones.shape), dtype=np.bool)
-            self.masks = np.empty([self.size] + list(masks.shape), dtype=np.bool)
+            self.dones = np.empty([self.size] + list(dones.shape), dtype=np.bool_)
+            self.masks = np.empty([self.size] + list(masks.shape), dtype=np.bool_)
 
         self.enc_obs[self.next_idx] = enc_obs
         self.actions[self.next_idx] = actions
@@ -119,7 +152,8 @@ class Buffer(object):
         self.next_idx = (self.next_idx + 1) % self.size
         self.num_in_buffer = min(self.size, self.num_in_buffer + 1)
 
-    def take(self, arr, idx, envx):
+    @staticmethod
+    def take(arr, idx, envx):
         """
         Reads a frame from a list and index for the asked environment ids
         
@@ -128,11 +162,7 @@ class Buffer(object):
         :param envx: ([int]) the idx for the environments
         :return: ([float]) the askes frames from the list
         """
-        n_env = self.n_env
-        out = np.empty([n_env] + list(arr.shape[2:]), dtype=arr.dtype)
-        for i in range(n_env):
-            out[i] = arr[idx[i], envx[i]]
-        return out
+        return arr[idx, envx]
 
     def get(self):
         """
@@ -153,10 +183,9 @@ class Buffer(object):
         envx = np.arange(n_env)
 
         dones = self.take(self.dones, idx, envx)
-        enc_obs = self.take(self.enc_obs, idx, envx)
-        obs = self.decode(enc_obs)
+        masks = self.take(self.masks, idx, envx)
+        obs = self.decode(self.take(self.enc_obs, idx, envx), masks)
         actions = self.take(self.actions, idx, envx)
         rewards = self.take(self.rewards, idx, envx)
         mus = self.take(self.mus, idx, envx)
-        masks = self.take(self.masks, idx, envx)
         return obs, actions, rewards, mus, dones, masks
@@ -1,20 +1,27 @@
-__all__ = ['Monitor', 'get_monitor_files', 'load_results']
+__all__ = ['Monitor', 'ResultsWriter', 'get_monitor_files', 'load_results']
 
+import atexit
 import csv
+import io
 import json
 import os
 import time
+import weakref
 from glob import glob
 
+import numpy as np
 import pandas
 from gym.core import Wrapper
 
 
 class Monitor(Wrapper):
     EXT = "monitor.csv"
-    file_handler = None
+    BINARY_EXT = "monitor.bin"
+    CACHE_EXT = ".cache.npz"
+    results_writer = None
 
-    def __init__(self, env, filename, allow_early_resets=True, reset_keywords=(), info_keywords=()):
+    def __init__(self, env, filename, allow_early_resets=True, reset_keywords=(), info_keywords=(),
+                 flush_interval=1.0, flush_size=100, binary=False):
         """
         A monitor wrapper for Gym environments, it is used to know the episode reward, length, time and other data.
 
@@ -23,29 +30,26 @@ class Monitor(Wrapper):
         :param allow_early_resets: (bool) allows the reset of the environment before it is done
         :param reset_keywords: (tuple) extra keywords for the reset call, if extra parameters are needed at reset
         :param info_keywords: (tuple) extra information to log, from the information return of environment.step
+        :param flush_interval: (float) the episodes are written to the log file at most every flush_interval seconds
+            (and when the monitor is closed or the interpreter exits)
+        :param flush_size: (int) the number of buffered episodes that triggers a write, whatever flush_interval
+        :param binary: (bool) write the log in a compact binary file (``*monitor.bin``, also read by
+            ``load_results``) instead of a csv file. The reset and info keywords must then be numbers
         """
         Wrapper.__init__(self, env=env)
         self.t_start = time.time()
-        if filename is None:
-            self.file_handler = None
-            self.logger = None
-        else:
-            if not filename.endswith(Monitor.EXT):
-                if os.path.isdir(filename):
-                    filename = os.path.join(filename, Monitor.EXT)
-                else:
-                    filename = filename + "." + Monitor.EXT
-            self.file_handler = open(filename, "wt")
-            self.file_handler.write('#%s\n' % json.dumps({"t_start": self.t_start, 'env_id': env.spec and env.spec.id}))
-            self.logger = csv.DictWriter(self.file_handler,
-                                         fieldnames=('r', 'l', 't') + reset_keywords + info_keywords)
-            self.logger.writeheader()
-            self.file_handler.flush()
+        if filename is not None:
+            self.results_writer = ResultsWriter(filename, header={"t_start": self.t_start,
+                                                                  'env_id': env.spec and env.spec.id},
+                                                fieldnames=('r', 'l', 't') + reset_keywords + info_keywords,
+                                                flush_interval=flush_interval, flush_size=flush_size,
+                                                binary=binary)
 
         self.reset_keywords = reset_keywords
         self.info_keywords = info_keywords
         self.allow_early_resets = allow_early_resets
-        self.rewards = None
+        self.episode_return = 0.0
+        self.episode_length = 0
         self.needs_reset = True
         self.episode_rewards = []
         self.episode_lengths = []
@@ -63,7 +67,8 @@ class Monitor(Wrapper):
         if not self.allow_early_resets and not self.needs_reset:
             raise RuntimeError("Tried to reset an environment before done. If you want to allow early resets, "
                                "wrap your env with Monitor(env, path, allow_early_resets=True)")
-        self.rewards = []
+        self.episode_return = 0.0
+        self.episode_length = 0
         self.needs_reset = False
         for key in self.reset_keywords:
             value = kwargs.get(key)
@@ -82,11 +87,12 @@ class Monitor(Wrapper):
         if self.needs_reset:
             raise RuntimeError("Tried to step environment that needs reset")
         observation, reward, done, info = self.env.step(action)
-        self.rewards.append(reward)
+        self.episode_return += reward
+        self.episode_length += 1
         if done:
             self.needs_reset = True
-            ep_rew = sum(self.rewards)
-            eplen = len(self.rewards)
+            ep_rew = self.episode_return
+            eplen = self.episode_length
             ep_info = {"r": round(ep_rew, 6), "l": eplen, "t": round(time.time() - self.t_start, 6)}
             for key in self.info_keywords:
                 ep_info[key] = info[key]
@@ -94,19 +100,25 @@ class Monitor(Wrapper):
             self.episode_lengths.append(eplen)
             self.episode_times.append(time.time() - self.t_start)
             ep_info.update(self.current_reset_info)
-            if self.logger:
-                self.logger.writerow(ep_info)
-                self.file_handler.flush()
+            if self.results_writer is not None:
+                self.results_writer.write_row(ep_info)
             info['episode'] = ep_info
         self.total_steps += 1
         return observation, reward, done, info
 
+    def flush(self):
+        """
+        Write the buffered episodes to the log file
+        """
+        if self.results_writer is not None:
+            self.results_writer.flush()
+
     def close(self):
         """
         Closes the environment
         """
-        if self.file_handler is not None:
-            self.file_handler.close()
+        if self.results_writer is not None:
+            self.results_writer.close()
 
     def get_total_steps(self):
         """
@@ -141,6 +153,94 @@ class Monitor(Wrapper):
         return self.episode_times
 
 
+# The open results writers, flushed when the interpreter exits
+_RESULTS_WRITERS = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_results_writers():
+    for results_writer in list(_RESULTS_WRITERS):
+        results_writer.flush()
+
+
+class ResultsWriter(object):
+    def __init__(self, filename, header, fieldnames, flush_interval=1.0, flush_size=100, binary=False):
+        """
+        Writes the episodes of a monitor to a log file, buffering them to write them in batches.
+
+        The csv file starts with a commented json header line, followed by the csv header and rows. The binary file
+        starts with the same json header line, with the fields and their dtypes, followed by the episodes as fixed
+        size records (the length is an int64, the other fields are float64).
+
+        :param filename: (str) the location of the log file, ``monitor.csv`` (or ``monitor.bin``) is appended if
+            needed
+        :param header: (dict) the metadata written in the header line
+        :param fieldnames: (tuple) the fields of the episodes
+        :param flush_interval: (float) the buffered episodes are written at most every flush_interval seconds
+        :param flush_size: (int) the number of buffered episodes that triggers a write, whatever flush_interval
+        :param binary: (bool) write fixed size records instead of csv rows
+        """
+        ext = Monitor.BINARY_EXT if binary else Monitor.EXT
+        if not filename.endswith(ext):
+            if os.path.isdir(filename):
+                filename = os.path.join(filename, ext)
+            else:
+                filename = filename + "." + ext
+        self.filename = filename
+        self.fieldnames = tuple(fieldnames)
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.binary = binary
+        self._rows = []
+        self._last_flush = time.time()
+        if binary:
+            self.dtype = np.dtype([(name, '<i8' if name == 'l' else '<f8') for name in self.fieldnames])
+            header = dict(header, fields=[[name, self.dtype[name].str] for name in self.fieldnames])
+            self.file_handler = open(filename, "wb")
+            self.file_handler.write(('#%s\n' % json.dumps(header)).encode())
+            self.logger = None
+        else:
+            self.file_handler = open(filename, "wt")
+            self.file_handler.write('#%s\n' % json.dumps(header))
+            self.logger = csv.DictWriter(self.file_handler, fieldnames=self.fieldnames)
+            self.logger.writeheader()
+        self.file_handler.flush()
+        _RESULTS_WRITERS.add(self)
+
+    def write_row(self, row):
+        """
+        Buffer an episode, and write the buffered episodes if the size or time threshold is reached
+
+        :param row: (dict) the fields of the episode
+        """
+        self._rows.append(row)
+        if len(self._rows) >= self.flush_size or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered episodes to the file
+        """
+        self._last_flush = time.time()
+        if not self._rows or self.file_handler.closed:
+            return
+        if self.binary:
+            records = np.array([tuple(row[name] for name in self.fieldnames) for row in self._rows], dtype=self.dtype)
+            self.file_handler.write(records.tobytes())
+        else:
+            self.logger.writerows(self._rows)
+        self.file_handler.flush()
+        self._rows = []
+
+    def close(self):
+        """
+        Write the buffered episodes and close the file
+        """
+        self.flush()
+        self.file_handler.close()
+        _RESULTS_WRITERS.discard(self)
+
+
 class LoadMonitorResultsError(Exception):
     """
     Raised when loading the monitor log fails.
@@ -153,16 +253,113 @@ def get_monitor_files(path):
     get all the monitor files in the given path
 
     :param path: (str) the logging folder
-    :return: ([str]) the log files
+    :return: ([str]) the log files, csv or binary
+    """
+    return glob(os.path.join(path, "*" + Monitor.EXT)) + glob(os.path.join(path, "*" + Monitor.BINARY_EXT))
+
+
+def _cached_column_arrays(name, values):
+    """
+    Arrays holding a column in the cache of a csv log, without object arrays (which would be pickled):
+    the strings are stored as a fixed-width array, with a mask of the missing values
+
+    :param name: (str) the name of the column
+    :param values: (np.ndarray) the values of the column
+    :return: ({str: np.ndarray}) the arrays to store
+    """
+    if values.dtype != object:
+        return {'column_' + name: values}
+    missing = pandas.isnull(values)
+    return {'column_' + name: np.where(missing, '', values).astype(str), 'missing_' + name: missing}
+
+
+def _load_cached_column(cache_file, name):
+    """
+    Read a column from the cache of a csv log (see ``_cached_column_arrays``)
+
+    :param cache_file: (NpzFile) the cache
+    :param name: (str) the name of the column
+    :return: (np.ndarray) the values of the column
     """
-    return glob(os.path.join(path, "*" + Monitor.EXT))
+    values = cache_file['column_' + name]
+    if 'missing_' + name not in cache_file.files:
+        return values
+    values = values.astype(object)
+    values[cache_file['missing_' + name]] = np.nan
+    return values
 
 
-def load_results(path):
+def _load_csv(file_name, cache=True):
     """
-    Load all Monitor logs from a given directory path matching ``*monitor.csv`` and ``*monitor.json``
+    Load a csv monitor log, through a columnar cache (``<file_name>.cache.npz``) holding the episodes parsed by the
+    previous loads: only the bytes written since then are parsed. The cache is rebuilt if the file was replaced.
+
+    :param file_name: (str) the csv file
+    :param cache: (bool) use and update the cache
+    :return: (dict, Pandas DataFrame) the header and the episodes of the file
+    """
+    cache_name = file_name + Monitor.CACHE_EXT
+    with open(file_name, 'rb') as file_handler:
+        first_line = file_handler.readline()
+        assert first_line[:1] == b'#'
+        header = json.loads(first_line[1:].decode())
+        fieldnames = next(csv.reader([file_handler.readline().decode()]), [])
+        offset = file_handler.tell()
+        file_size = os.fstat(file_handler.fileno()).st_size
+        cached = None
+        if cache and os.path.exists(cache_name):
+            try:
+                # Never unpickle: the cache may come from a shared directory
+                with np.load(cache_name, allow_pickle=False) as cache_file:
+                    meta = json.loads(str(cache_file['meta']))
+                    if meta['header'] == header and meta['fieldnames'] == fieldnames and meta['offset'] <= file_size:
+                        cached = pandas.DataFrame({name: _load_cached_column(cache_file, name) for name in fieldnames},
+                                                  columns=fieldnames)
+                        offset = meta['offset']
+            except (OSError, ValueError, KeyError):
+                # Unreadable cache, it is rebuilt
+                cached = None
+        file_handler.seek(offset)
+        data = file_handler.read()
+    # Only parse the complete lines, the last one may be being written
+    data = data[:data.rfind(b'\n') + 1]
+    data_frames = [] if cached is None else [cached]
+    if data:
+        data_frames.append(pandas.read_csv(io.BytesIO(data), header=None, names=fieldnames, index_col=None))
+    if not data_frames:
+        data_frames.append(pandas.DataFrame(columns=fieldnames))
+    data_frame = pandas.concat(data_frames, ignore_index=True) if len(data_frames) > 1 else data_frames[0]
+
+    if cache and (data or cached is None):
+        meta = {"header": header, "fieldnames": fieldnames, "offset": offset + len(data)}
+        columns = {}
+        for name in fieldnames:
+            columns.update(_cached_column_arrays(name, np.asarray(data_frame[name])))
+        try:
+            # Write then rename, so that a concurrent load never reads a truncated cache
+            with open(cache_name + ".tmp", "wb") as file_handler:
+                np.savez(file_handler, meta=json.dumps(meta), **columns)
+            os.replace(cache_name + ".tmp", cache_name)
+        except OSError:
+            # e.g. read-only log directory
+            pass
+    return header, data_frame
+
+
+def load_results(path, cache=True, time_range=None, timesteps_range=None):
+    """
+    Load all Monitor logs from a given directory path matching ``*monitor.csv``, ``*monitor.bin`` and
+    ``*monitor.json``
+
+    The parsed csv logs are cached next to the files (``*monitor.csv.cache.npz``), so that loading the logs of
+    a run in progress again only parses the new episodes.
 
     :param path: (str) the directory path containing the log file(s)
+    :param cache: (bool) use and update the caches of the csv logs
+    :param time_range: ((float, float)) only keep the episodes that ended in this range of time (in seconds, since
+        the start of the first log), a bound can be None
+    :param timesteps_range: ((int, int)) only keep the episodes that ended in this range of timesteps (summed over
+        the episodes of all the logs), a bound can be None
     :return: (Pandas DataFrame) the logged data
     """
     # get both csv and (old) json files
@@ -172,29 +369,54 @@ def load_results(path):
     data_frames = []
     headers = []
     for file_name in monitor_files:
-        with open(file_name, 'rt') as file_handler:
-            if file_name.endswith('csv'):
-                first_line = file_handler.readline()
-                assert first_line[0] == '#'
-                header = json.loads(first_line[1:])
-                data_frame = pandas.read_csv(file_handler, index_col=None)
-                headers.append(header)
-            elif file_name.endswith('json'):  # Deprecated json format
-                episodes = []
-                lines = file_handler.readlines()
-                header = json.loads(lines[0])
-                headers.append(header)
-                for line in lines[1:]:
-                    episode = json.loads(line)
-                    episodes.append(episode)
-                data_frame = pandas.DataFrame(episodes)
-            else:
-                assert 0, 'unreachable'
-            data_frame['t'] += header['t_start']
+        if file_name.endswith('csv'):
+            header, data_frame = _load_csv(file_name, cache=cache)
+            headers.append(header)
+        else:
+            with open(file_name, 'rb' if file_name.endswith('bin') else 'rt') as file_handler:
+                if file_name.endswith('bin'):
+                    header = json.loads(file_handler.readline()[1:].decode())
+                    dtype = np.dtype([tuple(field) for field in header.pop('fields')])
+                    data = file_handler.read()
+                    # Ignore a record truncated by a crash
+                    n_records = len(data) // dtype.itemsize
+                    data_frame = pandas.DataFrame(np.frombuffer(data[:n_records * dtype.itemsize], dtype=dtype))
+                    headers.append(header)
+                elif file_name.endswith('json'):  # Deprecated json format
+                    episodes = []
+                    lines = file_handler.readlines()
+                    header = json.loads(lines[0])
+                    headers.append(header)
+                    for line in lines[1:]:
+                        episode = json.loads(line)
+                        episodes.append(episode)
+                    data_frame = pandas.DataFrame(episodes)
+                else:
+                    assert 0, 'unreachable'
+        data_frame['t'] += header['t_start']
         data_frames.append(data_frame)
     data_frame = pandas.concat(data_frames)
-    data_frame.sort_values('t', inplace=True)
+    data_frame.sort_values('t', inplace=True, kind='mergesort')
     data_frame.reset_index(inplace=True)
     data_frame['t'] -= min(header['t_start'] for header in headers)
+    if timesteps_range is not None:
+        data_frame = data_frame[_in_range(data_frame['l'].cumsum(), timesteps_range)]
+    if time_range is not None:
+        data_frame = data_frame[_in_range(data_frame['t'], time_range)]
     # data_frame.headers = headers  # HACK to preserve backwards compatibility
     return data_frame
+
+
+def _in_range(values, value_range):
+    """
+    :param values: (Pandas Series) values
+    :param value_range: ((float, float)) the bounds of the range, a bound can be None
+    :return: (Pandas Series) whether the values are in the range, bounds included
+    """
+    low, high = value_range
+    mask = np.ones(len(values), dtype=bool)
+    if low is not None:
+        mask &= (values >= low).values
+    if high is not None:
+        mask &= (values <= high).values
+    return mask
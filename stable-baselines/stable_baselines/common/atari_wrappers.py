@@ -255,6 +255,12 @@ class LazyFrames(object):
         self._frames = frames
         self._out = None
 
+    @property
+    def frames(self):
+        """[np.ndarray]: the stacked frames, shared with the neighbouring observations (e.g. by a
+        FramePoolReplayBuffer), None once converted to an array"""
+        return self._frames
+
     def _force(self):
         if self._out is None:
             self._out = np.concatenate(self._frames, axis=2)
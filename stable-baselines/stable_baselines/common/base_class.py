@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from collections import deque
+from contextlib import contextmanager
 import os
 import glob
 import warnings
@@ -30,6 +31,8 @@ class BaseRLModel(ABC):
     :param verbose: (int) the verbosity level: 0 none, 1 training information, 2 tensorflow debug
     :param requires_vec_env: (bool) Does this model require a vectorized environment
     :param policy_base: (BasePolicy) the base policy used by this method
+    :param supports_vec_env: (bool) Can this model learn from a vectorized environment with several environments,
+        when it does not require a vectorized environment
     :param policy_kwargs: (dict) additional arguments to be passed to the policy on creation
     :param seed: (int) Seed for the pseudo-random generators (python, numpy, tensorflow).
         If None (default), use random seed. Note that if you want completely deterministic
@@ -39,7 +42,7 @@ class BaseRLModel(ABC):
     """
 
     def __init__(self, policy, env, verbose=0, *, requires_vec_env, policy_base,
-                 policy_kwargs=None, seed=None, n_cpu_tf_sess=None):
+                 policy_kwargs=None, seed=None, n_cpu_tf_sess=None, supports_vec_env=False):
         if isinstance(policy, str) and policy_base is not None:
             self.policy = get_policy_from_name(policy_base, policy)
         else:
@@ -47,6 +50,7 @@ class BaseRLModel(ABC):
         self.env = env
         self.verbose = verbose
         self._requires_vec_env = requires_vec_env
+        self._supports_vec_env = supports_vec_env
         self.policy_kwargs = {} if policy_kwargs is None else policy_kwargs
         self.observation_space = None
         self.action_space = None
@@ -80,6 +84,8 @@ class BaseRLModel(ABC):
                     if self.verbose >= 1:
                         print("Wrapping the env in a DummyVecEnv.")
                     self.n_envs = 1
+            elif isinstance(env, VecEnv) and env.num_envs > 1 and supports_vec_env:
+                self.n_envs = env.num_envs
             else:
                 if isinstance(env, VecEnv):
                     if env.num_envs == 1:
@@ -125,6 +131,9 @@ class BaseRLModel(ABC):
                 "Error: the environment passed must have the same number of environments as the model was trained on." \
                 "This is due to the Lstm policy not being capable of changing the number of environments."
             self.n_envs = env.num_envs
+        elif isinstance(env, VecEnv) and env.num_envs > 1 and self._supports_vec_env:
+            self._vectorize_action = False
+            self.n_envs = env.num_envs
         else:
             # for models that dont want vectorized environment, check if they make sense and adapt them.
             # Otherwise tell the user about this issue
@@ -934,6 +943,8 @@ class OffPolicyRLModel(BaseRLModel):
     :param verbose: (int) the verbosity level: 0 none, 1 training information, 2 tensorflow debug
     :param requires_vec_env: (bool) Does this model require a vectorized environment
     :param policy_base: (BasePolicy) the base policy used by this method
+    :param supports_vec_env: (bool) Can this model learn from a vectorized environment with several environments,
+        when it does not require a vectorized environment
     :param policy_kwargs: (dict) additional arguments to be passed to the policy on creation
     :param seed: (int) Seed for the pseudo-random generators (python, numpy, tensorflow).
         If None (default), use random seed. Note that if you want completely deterministic
@@ -944,13 +955,125 @@ class OffPolicyRLModel(BaseRLModel):
 
     def __init__(self, policy, env, replay_buffer=None, _init_setup_model=False, verbose=0, *,
                  requires_vec_env=False, policy_base=None,
-                 policy_kwargs=None, seed=None, n_cpu_tf_sess=None):
+                 policy_kwargs=None, seed=None, n_cpu_tf_sess=None, supports_vec_env=False):
         super(OffPolicyRLModel, self).__init__(policy, env, verbose=verbose, requires_vec_env=requires_vec_env,
                                                policy_base=policy_base, policy_kwargs=policy_kwargs,
-                                               seed=seed, n_cpu_tf_sess=n_cpu_tf_sess)
+                                               seed=seed, n_cpu_tf_sess=n_cpu_tf_sess,
+                                               supports_vec_env=supports_vec_env)
 
         self.replay_buffer = replay_buffer
 
+    def save_replay_buffer(self, path):
+        """
+        Save the transitions of the replay buffer to a directory of memory-mapped files,
+        e.g. next to the file written by ``save``.
+
+        :param path: (str) the directory of the replay buffer
+        """
+        # Imported here to avoid a circular import (deepq depends on this module)
+        from stable_baselines.deepq.replay_buffer import MemmapReplayBuffer
+
+        replay_buffer = self.replay_buffer
+        # Unwrap replay wrappers (e.g. HER)
+        while hasattr(replay_buffer, 'replay_buffer'):
+            replay_buffer = replay_buffer.replay_buffer
+        if isinstance(replay_buffer, MemmapReplayBuffer):
+            replay_buffer.snapshot(path)
+        else:
+            MemmapReplayBuffer.from_buffer(replay_buffer, path)
+
+    def load_replay_buffer(self, path, mode='r+'):
+        """
+        Reopen a replay buffer saved with ``save_replay_buffer`` (or a flushed ``MemmapReplayBuffer``),
+        to resume training with its transitions. The files are not loaded in memory.
+
+        :param path: (str) the directory of the replay buffer
+        :param mode: (str) 'r+' to keep adding transitions to the files, 'c' to leave them untouched
+        """
+        from stable_baselines.deepq.replay_buffer import MemmapReplayBuffer
+
+        self.replay_buffer = MemmapReplayBuffer.load(path, mode=mode)
+
+    @contextmanager
+    def _prefetch_replay(self, batch_size, n_batches):
+        """
+        Sample the minibatches of the replay buffer on a background thread within the block
+        (cf ``PrefetchReplayBuffer``), if ``n_batches > 0``
+
+        :param batch_size: (int) the size of the minibatches sampled by the model
+        :param n_batches: (int) the number of minibatches sampled ahead (0 to sample them synchronously)
+        """
+        if n_batches <= 0:
+            yield
+            return
+        # Imported here to avoid a circular import (deepq depends on this module)
+        from stable_baselines.deepq.replay_buffer import PrefetchReplayBuffer
+
+        with PrefetchReplayBuffer(self.replay_buffer, batch_size, n_batches) as replay_buffer:
+            self.replay_buffer = replay_buffer
+            try:
+                yield
+            finally:
+                self.replay_buffer = replay_buffer.replay_buffer
+
+    def _train_rounds(self, step, train_freq):
+        """
+        Number of training rounds due at a step of the environments: one per multiple of ``train_freq``
+        among the ``n_envs`` env steps ``step, ..., step + n_envs - 1``, so that the training frequency is
+        defined in env steps (with a single environment, this is ``step % train_freq == 0``).
+
+        :param step: (int) the number of env steps done before this step
+        :param train_freq: (int) the training frequency, in env steps
+        :return: (int) the number of training rounds
+        """
+        return (step + self.n_envs - 1) // train_freq - (step - 1) // train_freq
+
+    def _store_vec_transitions(self, obs, actions, rewards, new_obs, dones, infos):
+        """
+        Store the transitions of one step of a vectorized environment in the replay buffer, in bulk.
+        The environments that finished an episode were reset by the VecEnv, their next observation
+        is taken from ``info['terminal_observation']``.
+
+        :param obs: (np.ndarray) the last observations, one per env
+        :param actions: (np.ndarray) the actions
+        :param rewards: (np.ndarray) the rewards
+        :param new_obs: (np.ndarray) the observations returned by the VecEnv
+        :param dones: (np.ndarray) whether the episodes are done
+        :param infos: ([dict]) the infos returned by the VecEnv
+        """
+        next_obs = np.array(new_obs)
+        for env_idx in np.flatnonzero(dones):
+            terminal_obs = infos[env_idx].get('terminal_observation')
+            if terminal_obs is not None:
+                next_obs[env_idx] = terminal_obs
+        self.replay_buffer.extend(obs, actions, rewards, next_obs, np.asarray(dones, dtype=np.float32))
+
+    @staticmethod
+    def _vec_episodes_bookkeeping(running_rewards, rewards, dones, infos, episode_rewards, episode_successes):
+        """
+        Episode statistics of one step of a vectorized environment with several environments
+        (the counterpart of ``episode_rewards[-1] += reward`` and of the ``if done:`` block with a single one).
+        The returns of the finished episodes are inserted before the last entry of ``episode_rewards``,
+        which is kept as a placeholder for the running episodes.
+
+        :param running_rewards: (np.ndarray) the returns of the running episodes, one per env (updated in place)
+        :param rewards: (np.ndarray) the rewards
+        :param dones: (np.ndarray) whether the episodes are done
+        :param infos: ([dict]) the infos returned by the VecEnv
+        :param episode_rewards: ([float]) the returns of the episodes (updated in place)
+        :param episode_successes: ([float]) the successes of the episodes (updated in place)
+        :return: (int) the number of episodes finished at this step
+        """
+        running_rewards += rewards
+        ended = np.flatnonzero(dones)
+        episode_rewards[-1:-1] = running_rewards[ended].tolist()
+        running_rewards[ended] = 0.0
+        for env_idx in ended:
+            maybe_is_success = infos[env_idx].get('is_success')
+            if maybe_is_success is not None:
+                episode_successes.append(float(maybe_is_success))
+        return len(ended)
+
     @abstractmethod
     def setup_model(self):
         pass
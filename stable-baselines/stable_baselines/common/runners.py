@@ -28,3 +28,101 @@ class AbstractEnvRunner(ABC):
         Run a learning step of the model
         """
         raise NotImplementedError
+
+
+class RolloutStorage(object):
+    def __init__(self, n_envs, n_steps):
+        """
+        Preallocated storage for the transitions collected by a runner.
+
+        Every field is kept env-major, with shape (n_envs, n_steps, ...), and written in place one step
+        at a time. Flattening a field for training is then a reshape of a contiguous array instead of a
+        swap of axes followed by a copy.
+
+        :param n_envs: (int) The number of environments run in parallel
+        :param n_steps: (int) The number of steps to run for each environment
+        """
+        self.n_envs = n_envs
+        self.n_steps = n_steps
+        self._buffers = {}
+
+    def allocate(self, name, shape, dtype):
+        """
+        Return the buffer for a field, allocating it if it does not exist yet with the given layout.
+
+        :param name: (str) the name of the field
+        :param shape: (tuple) the shape of the field for a single environment and step
+        :param dtype: (np.dtype) the dtype of the field
+        :return: (np.ndarray) the buffer, with shape (n_envs, n_steps) + shape
+        """
+        shape = (self.n_envs, self.n_steps) + tuple(shape)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.zeros(shape, dtype=dtype)
+            self._buffers[name] = buf
+        return buf
+
+    def store(self, step, name, value, dtype=None):
+        """
+        Write the value of a field for all the environments at a given step
+
+        :param step: (int) the step index
+        :param name: (str) the name of the field
+        :param value: (np.ndarray) the value for all the environments, with shape (n_envs, ...)
+        :param dtype: (np.dtype) the dtype of the field, if None the dtype of `value` is used
+        """
+        value = np.asarray(value)
+        self.allocate(name, value.shape[1:], value.dtype if dtype is None else dtype)[:, step] = value
+
+    def __getitem__(self, name):
+        return self._buffers[name]
+
+    def __contains__(self, name):
+        return name in self._buffers
+
+    def flat(self, name):
+        """
+        Return a field flattened to (n_envs * n_steps, ...), without copying
+
+        :param name: (str) the name of the field
+        :return: (np.ndarray)
+        """
+        buf = self._buffers[name]
+        return buf.reshape((self.n_envs * self.n_steps,) + buf.shape[2:])
+
+
+def compute_gae(rewards, values, dones, last_values, last_dones, gamma, lam, out=None):
+    """
+    Compute the Generalized Advantage Estimates of a rollout stored env-major.
+
+    The recursion runs backward over the steps only: each step is vectorized over the environments
+    and over any trailing dimensions of the rewards (e.g. one column per agent in multi-agent envs).
+
+    :param rewards: (np.ndarray) the rewards, with shape (n_envs, n_steps, ...)
+    :param values: (np.ndarray) the value estimates, same shape as `rewards`
+    :param dones: (np.ndarray) whether an episode was over before each step, with shape (n_envs, n_steps)
+    :param last_values: (np.ndarray) the value estimates after the last step, with shape (n_envs, ...)
+    :param last_dones: (np.ndarray) whether an episode was over after the last step, with shape (n_envs,)
+    :param gamma: (float) Discount factor
+    :param lam: (float) Factor for trade-off of bias vs variance for Generalized Advantage Estimator
+    :param out: (np.ndarray) optional array in which to write the advantages, same shape as `rewards`
+    :return: (np.ndarray) the advantages
+    """
+    if out is None:
+        out = np.zeros(rewards.shape, dtype=np.float32)
+    n_steps = rewards.shape[1]
+    # Broadcast the done flags over the trailing (e.g. agent) dimensions of the rewards
+    extra_dims = (1,) * (rewards.ndim - 2)
+    nextnonterminals = 1.0 - np.asarray(dones, dtype=np.float32).reshape(dones.shape[:2] + extra_dims)
+    last_nonterminal = 1.0 - np.asarray(last_dones, dtype=np.float32).reshape((-1,) + extra_dims)
+    last_gae_lam = 0
+    for step in reversed(range(n_steps)):
+        if step == n_steps - 1:
+            nextnonterminal = last_nonterminal
+            nextvalues = last_values
+        else:
+            nextnonterminal = nextnonterminals[:, step + 1]
+            nextvalues = values[:, step + 1]
+        delta = rewards[:, step] + gamma * nextvalues * nextnonterminal - values[:, step]
+        out[:, step] = last_gae_lam = delta + gamma * lam * nextnonterminal * last_gae_lam
+    return out
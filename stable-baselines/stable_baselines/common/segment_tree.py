@@ -1,20 +1,6 @@
 import numpy as np
 
 
-def unique(sorted_array):
-    """
-    More efficient implementation of np.unique for sorted arrays
-    :param sorted_array: (np.ndarray)
-    :return:(np.ndarray) sorted_array without duplicate elements
-    """
-    if len(sorted_array) == 1:
-        return sorted_array
-    left = sorted_array[:-1]
-    right = sorted_array[1:]
-    uniques = np.append(right != left, True)
-    return sorted_array[uniques]
-
-
 class SegmentTree(object):
     def __init__(self, capacity, operation, neutral_element):
         """
@@ -31,32 +17,28 @@ class SegmentTree(object):
                `reduce` operation which reduces `operation` over
                a contiguous subsequence of items in the array.
 
+        The tree is stored in an array: node `i` has children `2 * i` and `2 * i + 1`, the root is node 1
+        (so that reducing the whole array is O(1)) and the leaves are nodes `capacity` to `2 * capacity - 1`.
+
         :param capacity: (int) Total size of the array - must be a power of two.
-        :param operation: (lambda (Any, Any): Any) operation for combining elements (eg. sum, max) must form a
-            mathematical group together with the set of possible values for array elements (i.e. be associative)
-        :param neutral_element: (Any) neutral element for the operation above. eg. float('-inf') for max and 0 for sum.
+        The nodes are kept in a float64 array, and batches of nodes are combined at once: only numeric values and
+        numpy ufuncs as operation (eg. np.add, np.minimum, np.maximum) are supported.
+
+        :param operation: (np.ufunc) operation for combining elements (eg. sum, max) must form a
+            mathematical group together with the set of possible values for array elements (i.e. be associative).
+            It is applied elementwise on arrays of nodes.
+        :param neutral_element: (float) neutral element for the operation above. eg. float('-inf') for max and 0 for
+            sum.
         """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
+        assert isinstance(operation, np.ufunc) and operation.nin == 2, "operation must be a binary numpy ufunc."
+        assert isinstance(neutral_element, (int, float, np.number)), "neutral_element must be a number."
         self._capacity = capacity
-        self._value = [neutral_element for _ in range(2 * capacity)]
+        self._depth = capacity.bit_length() - 1
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
         self._operation = operation
         self.neutral_element = neutral_element
 
-    def _reduce_helper(self, start, end, node, node_start, node_end):
-        if start == node_start and end == node_end:
-            return self._value[node]
-        mid = (node_start + node_end) // 2
-        if end <= mid:
-            return self._reduce_helper(start, end, 2 * node, node_start, mid)
-        else:
-            if mid + 1 <= start:
-                return self._reduce_helper(start, end, 2 * node + 1, mid + 1, node_end)
-            else:
-                return self._operation(
-                    self._reduce_helper(start, mid, 2 * node, node_start, mid),
-                    self._reduce_helper(mid + 1, end, 2 * node + 1, mid + 1, node_end)
-                )
-
     def reduce(self, start=0, end=None):
         """
         Returns result of applying `self.operation`
@@ -72,25 +54,38 @@ class SegmentTree(object):
             end = self._capacity
         if end < 0:
             end += self._capacity
-        end -= 1
-        return self._reduce_helper(start, end, 1, 0, self._capacity - 1)
+        if start == 0 and end == self._capacity:
+            return self._value[1]
+        # Bottom-up: reduce the nodes at the borders of the range, then go up one level
+        result = self.neutral_element
+        start += self._capacity
+        end += self._capacity
+        while start < end:
+            if start & 1:
+                result = self._operation(result, self._value[start])
+                start += 1
+            if end & 1:
+                end -= 1
+                result = self._operation(result, self._value[end])
+            start //= 2
+            end //= 2
+        return result
 
     def __setitem__(self, idx, val):
         # indexes of the leaf
         idxs = idx + self._capacity
         self._value[idxs] = val
-        if isinstance(idxs, int):
-            idxs = np.array([idxs])
-        # go up one level in the tree and remove duplicate indexes
-        idxs = unique(idxs // 2)
-        while len(idxs) > 1 or idxs[0] > 0:
-            # as long as there are non-zero indexes, update the corresponding values
-            self._value[idxs] = self._operation(
-                self._value[2 * idxs],
-                self._value[2 * idxs + 1]
-            )
-            # go up one level in the tree and remove duplicate indexes
-            idxs = unique(idxs // 2)
+        if isinstance(idxs, (int, np.integer)):
+            while idxs > 1:
+                idxs //= 2
+                self._value[idxs] = self._operation(self._value[2 * idxs], self._value[2 * idxs + 1])
+            return
+        idxs = np.asarray(idxs)
+        # Go up one level at a time: parents shared by several indexes are computed more than once, but always
+        # from their updated children, which is cheaper than removing the duplicates
+        for _ in range(self._depth):
+            idxs = idxs // 2
+            self._value[idxs] = self._operation(self._value[2 * idxs], self._value[2 * idxs + 1])
 
     def __getitem__(self, idx):
         assert np.max(idx) < self._capacity
@@ -105,7 +100,6 @@ class SumSegmentTree(SegmentTree):
             operation=np.add,
             neutral_element=0.0
         )
-        self._value = np.array(self._value)
 
     def sum(self, start=0, end=None):
         """
@@ -131,25 +125,38 @@ class SumSegmentTree(SegmentTree):
         """
         if isinstance(prefixsum, float):
             prefixsum = np.array([prefixsum])
+        prefixsum = np.array(prefixsum, dtype=np.float64)
         assert 0 <= np.min(prefixsum)
         assert np.max(prefixsum) <= self.sum() + 1e-5
-        assert isinstance(prefixsum[0], float)
-
-        idx = np.ones(len(prefixsum), dtype=int)
-        cont = np.ones(len(prefixsum), dtype=bool)
-
-        while np.any(cont):  # while not all nodes are leafs
-            idx[cont] = 2 * idx[cont]
-            prefixsum_new = np.where(self._value[idx] <= prefixsum, prefixsum - self._value[idx], prefixsum)
-            # prepare update of prefixsum for all right children
-            idx = np.where(np.logical_or(self._value[idx] > prefixsum, np.logical_not(cont)), idx, idx + 1)
-            # Select child node for non-leaf nodes
-            prefixsum = prefixsum_new
-            # update prefixsum
-            cont = idx < self._capacity
-            # collect leafs
+
+        # All the leaves are at the same depth: descend one level at a time for all the prefix sums
+        idx = np.ones(len(prefixsum), dtype=np.int64)
+        for _ in range(self._depth):
+            left = 2 * idx
+            left_value = self._value[left]
+            go_right = left_value <= prefixsum
+            prefixsum -= np.where(go_right, left_value, 0.0)
+            idx = left + go_right
         return idx - self._capacity
 
+    def sample(self, batch_size, stratified=False, end=None):
+        """
+        Sample indexes with probabilities proportional to their values, in a single descent of the tree
+
+        :param batch_size: (int) the number of indexes to sample
+        :param stratified: (bool) draw one prefix sum uniformly in each of `batch_size` equal segments of the total
+            sum, instead of drawing them independently, which reduces the variance of the batch
+        :param end: (int) sample among the indexes before `end` (None for all the indexes)
+        :return: (np.ndarray) the sampled indexes
+        """
+        total = self.sum(0, end)
+        if stratified:
+            prefixsum = (np.arange(batch_size) + np.random.random(size=batch_size)) * (total / batch_size)
+        else:
+            prefixsum = np.random.random(size=batch_size) * total
+        # The prefix sums are below the total, also when rounding the stratified segments
+        return self.find_prefixsum_idx(np.minimum(prefixsum, np.nextafter(total, 0)))
+
 
 class MinSegmentTree(SegmentTree):
     def __init__(self, capacity):
@@ -158,7 +165,6 @@ class MinSegmentTree(SegmentTree):
             operation=np.minimum,
             neutral_element=float('inf')
         )
-        self._value = np.array(self._value)
 
     def min(self, start=0, end=None):
         """
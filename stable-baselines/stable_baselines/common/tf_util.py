@@ -167,7 +167,9 @@ class _Function(object):
         :param givens: (dict) the values known for the output
         """
         for inpt in inputs:
-            if not hasattr(inpt, 'make_feed_dict') and not (isinstance(inpt, tf.Tensor)and len(inpt.op.inputs) == 0):
+            if not hasattr(inpt, 'make_feed_dict') and not (isinstance(inpt, tf.Tensor) and
+                                                            (len(inpt.op.inputs) == 0 or
+                                                             inpt.op.type == 'PlaceholderWithDefault')):
                 assert False, "inputs should all be placeholders, constants, or have a make_feed_dict method"
         self.inputs = inputs
         updates = updates or []
@@ -336,3 +338,16 @@ def outer_scope_getter(scope, new_scope=""):
         val = getter(name, *args, **kwargs)
         return val
     return _getter
+
+
+def fresh_read_getter(getter, name, *args, **kwargs):
+    """
+    read the variables where they are used (instead of through their cached snapshot), so that the ops
+    created under ``tf.control_dependencies`` see the updates of the ops they depend on,
+    e.g. to chain several training steps in one session call
+
+    :param getter: (function) the variable getter
+    :param name: (str) the name of the variable
+    :return: (Tensorflow Tensor) the value of the variable
+    """
+    return getter(name, *args, **kwargs).read_value()
@@ -1,4 +1,5 @@
 import warnings
+from contextlib import contextmanager
 
 import numpy as np
 from gym import spaces
@@ -10,46 +11,83 @@ class VecFrameStack(VecEnvWrapper):
     """
     Frame stacking wrapper for vectorized environment
 
+    The frames are kept in a ring buffer along the last axis, where each frame is written twice (``n_stack``
+    frames apart), so that the last ``n_stack`` frames are always a contiguous slice of the buffer: a step writes
+    the new frames instead of shifting the whole stack.
+
     :param venv: (VecEnv) the vectorized environment to wrap
     :param n_stack: (int) Number of frames to stack
+    :param copy_obs: (bool) Return a new array of stacked observations at each step. If False, a view on the frame
+        buffer is returned, which is only valid until the next step (see ``obs_views``)
     """
 
-    def __init__(self, venv, n_stack):
+    def __init__(self, venv, n_stack, copy_obs=True):
         self.venv = venv
         self.n_stack = n_stack
+        self.copy_obs = copy_obs
         wrapped_obs_space = venv.observation_space
         low = np.repeat(wrapped_obs_space.low, self.n_stack, axis=-1)
         high = np.repeat(wrapped_obs_space.high, self.n_stack, axis=-1)
-        self.stackedobs = np.zeros((venv.num_envs,) + low.shape, low.dtype)
+        self._frame_size = wrapped_obs_space.shape[-1]
+        self._frames = np.zeros((venv.num_envs,) + low.shape[:-1] + (2 * low.shape[-1],), low.dtype)
+        # Slot of the last frame in the lower half of the buffer, the stack is the n_stack slots after it
+        self._last_slot = n_stack - 1
         observation_space = spaces.Box(low=low, high=high, dtype=venv.observation_space.dtype)
         VecEnvWrapper.__init__(self, venv, observation_space=observation_space)
 
+    @property
+    def stackedobs(self):
+        """np.ndarray: the stacked observations (a view on the frame buffer)"""
+        start = (self._last_slot + 1) * self._frame_size
+        return self._frames[..., start:start + self.n_stack * self._frame_size]
+
+    def _write_frames(self, observations):
+        self._last_slot = (self._last_slot + 1) % self.n_stack
+        for slot in (self._last_slot, self._last_slot + self.n_stack):
+            self._frames[..., slot * self._frame_size:(slot + 1) * self._frame_size] = observations
+
+    @contextmanager
+    def obs_views(self):
+        """
+        Return views on the frame buffer instead of copies (``copy_obs=False``) inside the scope, for a caller
+        that copies the observations before the next step (like the PPO2 runner)
+        """
+        copy_obs = self.copy_obs
+        self.copy_obs = False
+        try:
+            yield self
+        finally:
+            self.copy_obs = copy_obs
+
+    def _get_obs(self):
+        return self.stackedobs.copy() if self.copy_obs else self.stackedobs
+
     def step_wait(self):
         observations, rewards, dones, infos = self.venv.step_wait()
-        last_ax_size = observations.shape[-1]
-        self.stackedobs = np.roll(self.stackedobs, shift=-last_ax_size, axis=-1)
-        for i, done in enumerate(dones):
-            if done:
+        done_idxes = np.flatnonzero(dones)
+        if len(done_idxes) > 0:
+            stackedobs = self.stackedobs
+            for i in done_idxes:
                 if 'terminal_observation' in infos[i]:
                     old_terminal = infos[i]['terminal_observation']
                     new_terminal = np.concatenate(
-                        (self.stackedobs[i, ..., :-last_ax_size], old_terminal), axis=-1)
+                        (stackedobs[i, ..., self._frame_size:], old_terminal), axis=-1)
                     infos[i]['terminal_observation'] = new_terminal
                 else:
                     warnings.warn(
                         "VecFrameStack wrapping a VecEnv without terminal_observation info")
-                self.stackedobs[i] = 0
-        self.stackedobs[..., -observations.shape[-1]:] = observations
-        return self.stackedobs, rewards, dones, infos
+            self._frames[done_idxes] = 0
+        self._write_frames(observations)
+        return self._get_obs(), rewards, dones, infos
 
     def reset(self):
         """
         Reset all environments
         """
         obs = self.venv.reset()
-        self.stackedobs[...] = 0
-        self.stackedobs[..., -obs.shape[-1]:] = obs
-        return self.stackedobs
+        self._frames[...] = 0
+        self._write_frames(obs)
+        return self._get_obs()
 
     def close(self):
         self.venv.close()
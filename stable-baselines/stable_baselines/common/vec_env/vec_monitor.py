@@ -0,0 +1,87 @@
+import time
+
+import numpy as np
+
+from stable_baselines.bench.monitor import ResultsWriter
+from stable_baselines.common.vec_env.base_vec_env import VecEnvWrapper
+
+
+class VecMonitor(VecEnvWrapper):
+    """
+    A monitor wrapper for vectorized environments, it is used to know the episode reward, length, time and other
+    data of all the environments, without wrapping each of them in a ``Monitor``.
+
+    The finished episodes are added to the info dicts (``info['episode']``) and written to the log file with the
+    same fields as ``Monitor``. With several agents (``num_agents``), the returns of the agents are in the
+    ``r_0``, ..., ``r_{num_agents - 1}`` fields, and ``r`` is their mean.
+
+    :param venv: (VecEnv) the vectorized environment to wrap
+    :param filename: (str) the location to save a log file, can be None for no log
+    :param info_keywords: (tuple) extra information to log, from the information return of environment.step
+    :param flush_interval: (float) the episodes are written to the log file at most every flush_interval seconds
+        (and when the monitor is closed or the interpreter exits)
+    :param flush_size: (int) the number of buffered episodes that triggers a write, whatever flush_interval
+    :param binary: (bool) write the log in a compact binary file (``*monitor.bin``, also read by ``load_results``)
+        instead of a csv file. The info keywords must then be numbers
+    """
+
+    def __init__(self, venv, filename=None, info_keywords=(), flush_interval=1.0, flush_size=100, binary=False):
+        VecEnvWrapper.__init__(self, venv)
+        self.t_start = time.time()
+        self.info_keywords = info_keywords
+        agents_shape = () if self.num_agents is None else (self.num_agents,)
+        self.agent_keywords = tuple('r_{}'.format(agent) for agent in range(self.num_agents or 0))
+        self.episode_returns = np.zeros((self.num_envs,) + agents_shape, dtype=np.float64)
+        self.episode_lengths = np.zeros(self.num_envs, dtype=np.int64)
+        self.episode_count = 0
+        self.total_steps = 0
+        self.results_writer = None
+        if filename is not None:
+            spec = getattr(venv, 'spec', None)
+            self.results_writer = ResultsWriter(filename, header={"t_start": self.t_start,
+                                                                  'env_id': spec and spec.id},
+                                                fieldnames=('r', 'l', 't') + self.agent_keywords + info_keywords,
+                                                flush_interval=flush_interval, flush_size=flush_size,
+                                                binary=binary)
+
+    def reset(self):
+        obs = self.venv.reset()
+        self.episode_returns[...] = 0
+        self.episode_lengths[...] = 0
+        return obs
+
+    def step_wait(self):
+        obs, rewards, dones, infos = self.venv.step_wait()
+        self.episode_returns += rewards
+        self.episode_lengths += 1
+        self.total_steps += self.num_envs
+        done_idxes = np.flatnonzero(dones)
+        if len(done_idxes) > 0:
+            episode_time = round(time.time() - self.t_start, 6)
+            returns = self.episode_returns[done_idxes]
+            mean_returns = np.round(returns.reshape(len(done_idxes), -1).mean(axis=1), 6)
+            for i, env_idx in enumerate(done_idxes):
+                ep_info = {"r": float(mean_returns[i]), "l": int(self.episode_lengths[env_idx]), "t": episode_time}
+                if self.agent_keywords:
+                    ep_info.update(zip(self.agent_keywords, np.round(returns[i], 6).tolist()))
+                for key in self.info_keywords:
+                    ep_info[key] = infos[env_idx][key]
+                infos[env_idx]['episode'] = ep_info
+                if self.results_writer is not None:
+                    self.results_writer.write_row(ep_info)
+            self.episode_count += len(done_idxes)
+            self.episode_returns[done_idxes] = 0
+            self.episode_lengths[done_idxes] = 0
+        return obs, rewards, dones, infos
+
+    def flush(self):
+        """
+        Write the buffered episodes to the log file
+        """
+        if self.results_writer is not None:
+            self.results_writer.flush()
+
+    def close(self):
+        if self.results_writer is not None:
+            self.results_writer.close()
+        self.venv.close()
@@ -19,7 +19,7 @@ from stable_baselines.common.math_util import unscale_action, scale_action
 from stable_baselines.ddpg.policies import DDPGPolicy
 from stable_baselines.common.mpi_running_mean_std import RunningMeanStd
 from stable_baselines.a2c.utils import total_episode_reward_logger
-from stable_baselines.deepq.replay_buffer import ReplayBuffer
+from stable_baselines.deepq.replay_buffer import ReplayBuffer, NStepReplayBuffer
 
 
 def normalize(tensor, stats):
@@ -196,6 +196,10 @@ class DDPG(OffPolicyRLModel):
         results, you must set `n_cpu_tf_sess` to 1.
     :param n_cpu_tf_sess: (int) The number of threads for TensorFlow operations
         If None, the number of cpu of the current machine will be used.
+    :param n_step: (int) the number of rewards in the targets (n-step returns), uses a NStepReplayBuffer if > 1
+    :param prefetch_batches: (int) number of minibatches sampled ahead from the replay buffer on a background thread
+        (0 to sample them synchronously). The prefetched minibatches depend on the thread scheduling,
+        so a seeded run is not exactly reproducible with prefetching
     """
     def __init__(self, policy, env, gamma=0.99, memory_policy=None, eval_env=None, nb_train_steps=50,
                  nb_rollout_steps=100, nb_eval_steps=100, param_noise=None, action_noise=None,
@@ -204,7 +208,8 @@ class DDPG(OffPolicyRLModel):
                  return_range=(-np.inf, np.inf), actor_lr=1e-4, critic_lr=1e-3, clip_norm=None, reward_scale=1.,
                  render=False, render_eval=False, memory_limit=None, buffer_size=50000, random_exploration=0.0,
                  verbose=0, tensorboard_log=None, _init_setup_model=True, policy_kwargs=None,
-                 full_tensorboard_log=False, seed=None, n_cpu_tf_sess=1):
+                 full_tensorboard_log=False, seed=None, n_cpu_tf_sess=1, n_step=1,
+                 prefetch_batches=0):
 
         super(DDPG, self).__init__(policy=policy, env=env, replay_buffer=None,
                                    verbose=verbose, policy_base=DDPGPolicy,
@@ -213,6 +218,8 @@ class DDPG(OffPolicyRLModel):
 
         # Parameters.
         self.gamma = gamma
+        self.n_step = n_step
+        self.prefetch_batches = prefetch_batches
         self.tau = tau
 
         # TODO: remove this param in v3.x.x
@@ -292,6 +299,7 @@ class DDPG(OffPolicyRLModel):
         self.obs_adapt_noise = None
         self.action_adapt_noise = None
         self.terminals_ph = None
+        self.discounts_ph = None
         self.rewards = None
         self.actions = None
         self.critic_target = None
@@ -328,7 +336,10 @@ class DDPG(OffPolicyRLModel):
                 self.set_random_seed(self.seed)
                 self.sess = tf_util.make_session(num_cpu=self.n_cpu_tf_sess, graph=self.graph)
 
-                self.replay_buffer = ReplayBuffer(self.buffer_size)
+                if self.n_step > 1:
+                    self.replay_buffer = NStepReplayBuffer(self.buffer_size, n_step=self.n_step, gamma=self.gamma)
+                else:
+                    self.replay_buffer = ReplayBuffer(self.buffer_size)
 
                 with tf.variable_scope("input", reuse=False):
                     # Observation normalization.
@@ -378,6 +389,9 @@ class DDPG(OffPolicyRLModel):
                     self.action_train_ph = self.policy_tf.action_ph
                     self.terminals_ph = tf.placeholder(tf.float32, shape=(None, 1), name='terminals')
                     self.rewards = tf.placeholder(tf.float32, shape=(None, 1), name='rewards')
+                    # Discount of the next value, fed for n-step transitions
+                    self.discounts_ph = tf.placeholder_with_default(self.gamma * tf.ones_like(self.terminals_ph),
+                                                                    shape=(None, 1), name='discounts')
                     self.actions = tf.placeholder(tf.float32, shape=(None,) + self.action_space.shape, name='actions')
                     self.critic_target = tf.placeholder(tf.float32, shape=(None, 1), name='critic_target')
                     self.param_noise_stddev = tf.placeholder(tf.float32, shape=(), name='param_noise_stddev')
@@ -408,7 +422,7 @@ class DDPG(OffPolicyRLModel):
                         self.ret_rms)
 
                     q_next_obs = denormalize(critic_target, self.ret_rms)
-                    self.target_q = self.rewards + (1. - self.terminals_ph) * self.gamma * q_next_obs
+                    self.target_q = self.rewards + (1. - self.terminals_ph) * self.discounts_ph * q_next_obs
 
                     tf.summary.scalar('critic_target', tf.reduce_mean(self.critic_target))
                     if self.full_tensorboard_log:
@@ -651,18 +665,21 @@ class DDPG(OffPolicyRLModel):
         :return: (float, float) critic loss, actor loss
         """
         # Get a batch
-        obs, actions, rewards, next_obs, terminals = self.replay_buffer.sample(batch_size=self.batch_size)
+        obs, actions, rewards, next_obs, terminals, *discounts = self.replay_buffer.sample(batch_size=self.batch_size)
         # Reshape to match previous behavior and placeholder shape
         rewards = rewards.reshape(-1, 1)
         terminals = terminals.reshape(-1, 1)
+        target_feed_dict = {
+            self.obs_target: next_obs,
+            self.rewards: rewards,
+            self.terminals_ph: terminals
+        }
+        if discounts:
+            target_feed_dict[self.discounts_ph] = discounts[0].reshape(-1, 1)
 
         if self.normalize_returns and self.enable_popart:
             old_mean, old_std, target_q = self.sess.run([self.ret_rms.mean, self.ret_rms.std, self.target_q],
-                                                        feed_dict={
-                                                            self.obs_target: next_obs,
-                                                            self.rewards: rewards,
-                                                            self.terminals_ph: terminals
-                                                        })
+                                                        feed_dict=target_feed_dict)
             self.ret_rms.update(target_q.flatten())
             self.sess.run(self.renormalize_q_outputs_op, feed_dict={
                 self.old_std: np.array([old_std]),
@@ -670,11 +687,7 @@ class DDPG(OffPolicyRLModel):
             })
 
         else:
-            target_q = self.sess.run(self.target_q, feed_dict={
-                self.obs_target: next_obs,
-                self.rewards: rewards,
-                self.terminals_ph: terminals
-            })
+            target_q = self.sess.run(self.target_q, feed_dict=target_feed_dict)
 
         # Get all gradients and perform a synced update.
         ops = [self.actor_grads, self.actor_loss, self.critic_grads, self.critic_loss]
@@ -736,7 +749,7 @@ class DDPG(OffPolicyRLModel):
         if self.stats_sample is None:
             # Get a sample and keep that fixed for all further computations.
             # This allows us to estimate the change in value for the same set of inputs.
-            obs, actions, rewards, next_obs, terminals = self.replay_buffer.sample(batch_size=self.batch_size)
+            obs, actions, rewards, next_obs, terminals, *_ = self.replay_buffer.sample(batch_size=self.batch_size)
             self.stats_sample = {
                 'obs': obs,
                 'actions': actions,
@@ -811,7 +824,7 @@ class DDPG(OffPolicyRLModel):
             self.replay_buffer = replay_wrapper(self.replay_buffer)
 
         with SetVerbosity(self.verbose), TensorboardWriter(self.graph, self.tensorboard_log, tb_log_name, new_tb_log) \
-                as writer:
+                as writer, self._prefetch_replay(self.batch_size, self.prefetch_batches):
             self._setup_learn()
 
             # a list for tensorboard logging, to prevent logging with the same step number, if it already occured
@@ -1078,6 +1091,8 @@ class DDPG(OffPolicyRLModel):
             "param_noise": self.param_noise,
             "action_noise": self.action_noise,
             "gamma": self.gamma,
+            "n_step": self.n_step,
+            "prefetch_batches": self.prefetch_batches,
             "tau": self.tau,
             "normalize_returns": self.normalize_returns,
             "enable_popart": self.enable_popart,
@@ -350,6 +350,8 @@ def build_train(q_func, ob_space, ac_space, optimizer, sess, grad_norm_clipping=
             observation. See the top of the file for details.
         train: (function (Any, numpy float, numpy float, Any, numpy bool, numpy float): numpy float)
             optimize the error in Bellman's equation. See the top of the file for details.
+            The discounts of the next values can be passed as an extra argument (e.g. for n-step returns),
+            they default to gamma.
         update_target: (function) copy the parameters from optimized Q function to the target Q function.
             See the top of the file for details.
         step_model: (DQNPolicy) Policy for evaluation
@@ -392,6 +394,7 @@ def build_train(q_func, ob_space, ac_space, optimizer, sess, grad_norm_clipping=
         rew_t_ph = tf.placeholder(tf.float32, [None], name="reward")
         done_mask_ph = tf.placeholder(tf.float32, [None], name="done")
         importance_weights_ph = tf.placeholder(tf.float32, [None], name="weight")
+        discount_ph = tf.placeholder_with_default(gamma * tf.ones_like(done_mask_ph), [None], name="discount")
 
         # q scores for actions which we know were selected in the given state.
         q_t_selected = tf.reduce_sum(step_model.q_values * tf.one_hot(act_t_ph, n_actions), axis=1)
@@ -405,7 +408,7 @@ def build_train(q_func, ob_space, ac_space, optimizer, sess, grad_norm_clipping=
         q_tp1_best_masked = (1.0 - done_mask_ph) * q_tp1_best
 
         # compute RHS of bellman equation
-        q_t_selected_target = rew_t_ph + gamma * q_tp1_best_masked
+        q_t_selected_target = rew_t_ph + discount_ph * q_tp1_best_masked
 
         # compute the error (potentially clipped)
         td_error = q_t_selected - tf.stop_gradient(q_t_selected_target)
@@ -457,7 +460,8 @@ def build_train(q_func, ob_space, ac_space, optimizer, sess, grad_norm_clipping=
             target_policy.obs_ph,
             double_obs_ph,
             done_mask_ph,
-            importance_weights_ph
+            importance_weights_ph,
+            discount_ph
         ],
         outputs=[summary, td_error],
         updates=[optimize_expr]
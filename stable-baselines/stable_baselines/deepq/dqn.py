@@ -9,7 +9,8 @@ from stable_baselines.common import tf_util, OffPolicyRLModel, SetVerbosity, Ten
 from stable_baselines.common.vec_env import VecEnv
 from stable_baselines.common.schedules import LinearSchedule
 from stable_baselines.deepq.build_graph import build_train
-from stable_baselines.deepq.replay_buffer import ReplayBuffer, PrioritizedReplayBuffer
+from stable_baselines.deepq.replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, NStepReplayBuffer, \
+    FramePoolReplayBuffer
 from stable_baselines.deepq.policies import DQNPolicy
 from stable_baselines.a2c.utils import total_episode_reward_logger
 
@@ -23,7 +24,8 @@ class DQN(OffPolicyRLModel):
     Prioritized Experience Replay: https://arxiv.org/abs/1511.05952
 
     :param policy: (DQNPolicy or str) The policy model to use (MlpPolicy, CnnPolicy, LnMlpPolicy, ...)
-    :param env: (Gym environment or str) The environment to learn from (if registered in Gym, can be str)
+    :param env: (Gym environment or str) The environment to learn from (if registered in Gym, can be str),
+        or a VecEnv with several environments
     :param gamma: (float) discount factor
     :param learning_rate: (float) learning rate for adam optimizer
     :param buffer_size: (int) size of the replay buffer
@@ -32,6 +34,7 @@ class DQN(OffPolicyRLModel):
     :param exploration_final_eps: (float) final value of random action probability
     :param exploration_initial_eps: (float) initial value of random action probability
     :param train_freq: (int) update the model every `train_freq` steps. set to None to disable printing
+        Steps are env steps: a step of a VecEnv is `n_envs` steps.
     :param batch_size: (int) size of a batched sampled from replay buffer for training
     :param double_q: (bool) Whether to enable Double-Q learning or not.
     :param learning_starts: (int) how many steps of the model to collect transitions for before learning starts
@@ -54,6 +57,12 @@ class DQN(OffPolicyRLModel):
         results, you must set `n_cpu_tf_sess` to 1.
     :param n_cpu_tf_sess: (int) The number of threads for TensorFlow operations
         If None, the number of cpu of the current machine will be used.
+    :param n_step: (int) the number of rewards in the targets (n-step returns), uses a NStepReplayBuffer if > 1
+    :param prefetch_batches: (int) number of minibatches sampled ahead from the replay buffer on a background thread
+        (0 to sample them synchronously). The prefetched minibatches depend on the thread scheduling,
+        so a seeded run is not exactly reproducible with prefetching
+    :param frame_pool: (bool) Store each frame of the stacked observations once (e.g. the LazyFrames of
+        FrameStack), uses a FramePoolReplayBuffer
     """
     def __init__(self, policy, env, gamma=0.99, learning_rate=5e-4, buffer_size=50000, exploration_fraction=0.1,
                  exploration_final_eps=0.02, exploration_initial_eps=1.0, train_freq=1, batch_size=32, double_q=True,
@@ -61,11 +70,13 @@ class DQN(OffPolicyRLModel):
                  prioritized_replay_alpha=0.6, prioritized_replay_beta0=0.4, prioritized_replay_beta_iters=None,
                  prioritized_replay_eps=1e-6, param_noise=False,
                  n_cpu_tf_sess=None, verbose=0, tensorboard_log=None,
-                 _init_setup_model=True, policy_kwargs=None, full_tensorboard_log=False, seed=None):
+                 _init_setup_model=True, policy_kwargs=None, full_tensorboard_log=False, seed=None, n_step=1,
+                 prefetch_batches=0, frame_pool=False):
 
         # TODO: replay_buffer refactoring
         super(DQN, self).__init__(policy=policy, env=env, replay_buffer=None, verbose=verbose, policy_base=DQNPolicy,
-                                  requires_vec_env=False, policy_kwargs=policy_kwargs, seed=seed, n_cpu_tf_sess=n_cpu_tf_sess)
+                                  requires_vec_env=False, policy_kwargs=policy_kwargs, seed=seed, n_cpu_tf_sess=n_cpu_tf_sess,
+                                  supports_vec_env=True)
 
         self.param_noise = param_noise
         self.learning_starts = learning_starts
@@ -83,6 +94,9 @@ class DQN(OffPolicyRLModel):
         self.buffer_size = buffer_size
         self.learning_rate = learning_rate
         self.gamma = gamma
+        self.n_step = n_step
+        self.prefetch_batches = prefetch_batches
+        self.frame_pool = frame_pool
         self.tensorboard_log = tensorboard_log
         self.full_tensorboard_log = full_tensorboard_log
         self.double_q = double_q
@@ -155,27 +169,36 @@ class DQN(OffPolicyRLModel):
 
         new_tb_log = self._init_num_timesteps(reset_num_timesteps)
 
-        with SetVerbosity(self.verbose), TensorboardWriter(self.graph, self.tensorboard_log, tb_log_name, new_tb_log) \
-                as writer:
-            self._setup_learn()
-
-            # Create the replay buffer
-            if self.prioritized_replay:
-                self.replay_buffer = PrioritizedReplayBuffer(self.buffer_size, alpha=self.prioritized_replay_alpha)
-                if self.prioritized_replay_beta_iters is None:
-                    prioritized_replay_beta_iters = total_timesteps
-                else:
-                    prioritized_replay_beta_iters = self.prioritized_replay_beta_iters
-                self.beta_schedule = LinearSchedule(prioritized_replay_beta_iters,
-                                                    initial_p=self.prioritized_replay_beta0,
-                                                    final_p=1.0)
+        # Create the replay buffer (before the block sampling it in the background)
+        if self.prioritized_replay:
+            assert self.n_step == 1, "n-step returns are not supported with prioritized replay"
+            assert not self.frame_pool, "The frame pool is not supported with prioritized replay"
+            self.replay_buffer = PrioritizedReplayBuffer(self.buffer_size, alpha=self.prioritized_replay_alpha)
+            if self.prioritized_replay_beta_iters is None:
+                prioritized_replay_beta_iters = total_timesteps
             else:
-                self.replay_buffer = ReplayBuffer(self.buffer_size)
-                self.beta_schedule = None
+                prioritized_replay_beta_iters = self.prioritized_replay_beta_iters
+            self.beta_schedule = LinearSchedule(prioritized_replay_beta_iters,
+                                                initial_p=self.prioritized_replay_beta0,
+                                                final_p=1.0)
+        elif self.n_step > 1:
+            assert not self.frame_pool, "The frame pool is not supported with n-step returns"
+            self.replay_buffer = NStepReplayBuffer(self.buffer_size, n_step=self.n_step, gamma=self.gamma)
+            self.beta_schedule = None
+        elif self.frame_pool:
+            self.replay_buffer = FramePoolReplayBuffer(self.buffer_size)
+            self.beta_schedule = None
+        else:
+            self.replay_buffer = ReplayBuffer(self.buffer_size)
+            self.beta_schedule = None
+
+        if replay_wrapper is not None:
+            assert not self.prioritized_replay, "Prioritized replay buffer is not supported by HER"
+            self.replay_buffer = replay_wrapper(self.replay_buffer)
 
-            if replay_wrapper is not None:
-                assert not self.prioritized_replay, "Prioritized replay buffer is not supported by HER"
-                self.replay_buffer = replay_wrapper(self.replay_buffer)
+        with SetVerbosity(self.verbose), TensorboardWriter(self.graph, self.tensorboard_log, tb_log_name, new_tb_log) \
+                as writer, self._prefetch_replay(self.batch_size, self.prefetch_batches):
+            self._setup_learn()
 
             # Create the schedule for exploration starting from 1.
             self.exploration = LinearSchedule(schedule_timesteps=int(self.exploration_fraction * total_timesteps),
@@ -186,8 +209,11 @@ class DQN(OffPolicyRLModel):
             episode_successes = []
             obs = self.env.reset()
             reset = True
+            # With several environments, each step of the VecEnv is n_envs env steps
+            vec_env = self.n_envs > 1
+            running_rewards = np.zeros(self.n_envs)
 
-            for _ in range(total_timesteps):
+            for _ in range(0, total_timesteps, self.n_envs):
                 if callback is not None:
                     # Only stop training if return value is False, not when it is None. This is for backwards
                     # compatibility with callbacks that have no return statement.
@@ -211,35 +237,49 @@ class DQN(OffPolicyRLModel):
                     kwargs['update_param_noise_threshold'] = update_param_noise_threshold
                     kwargs['update_param_noise_scale'] = True
                 with self.sess.as_default():
-                    action = self.act(np.array(obs)[None], update_eps=update_eps, **kwargs)[0]
+                    if vec_env:
+                        # One forward pass for all the envs
+                        action = self.act(np.array(obs), update_eps=update_eps, **kwargs)
+                    else:
+                        action = self.act(np.array(obs)[None], update_eps=update_eps, **kwargs)[0]
                 env_action = action
                 reset = False
                 new_obs, rew, done, info = self.env.step(env_action)
                 # Store transition in the replay buffer.
-                self.replay_buffer.add(obs, action, rew, new_obs, float(done))
+                if vec_env:
+                    self._store_vec_transitions(obs, action, rew, new_obs, done, info)
+                else:
+                    self.replay_buffer.add(obs, action, rew, new_obs, float(done))
                 obs = new_obs
 
                 if writer is not None:
-                    ep_rew = np.array([rew]).reshape((1, -1))
-                    ep_done = np.array([done]).reshape((1, -1))
+                    ep_rew = np.array([rew]).reshape((self.n_envs, -1))
+                    ep_done = np.array([done]).reshape((self.n_envs, -1))
                     total_episode_reward_logger(self.episode_reward, ep_rew, ep_done, writer,
                                                 self.num_timesteps)
 
-                episode_rewards[-1] += rew
-                if done:
-                    maybe_is_success = info.get('is_success')
-                    if maybe_is_success is not None:
-                        episode_successes.append(float(maybe_is_success))
-                    if not isinstance(self.env, VecEnv):
-                        obs = self.env.reset()
-                    episode_rewards.append(0.0)
-                    reset = True
+                if vec_env:
+                    n_ended = self._vec_episodes_bookkeeping(running_rewards, rew, done, info,
+                                                             episode_rewards, episode_successes)
+                    reset = n_ended > 0
+                else:
+                    n_ended = int(done)
+                    episode_rewards[-1] += rew
+                    if done:
+                        maybe_is_success = info.get('is_success')
+                        if maybe_is_success is not None:
+                            episode_successes.append(float(maybe_is_success))
+                        if not isinstance(self.env, VecEnv):
+                            obs = self.env.reset()
+                        episode_rewards.append(0.0)
+                        reset = True
 
                 # Do not train if the warmup phase is not over
                 # or if there are not enough samples in the replay buffer
                 can_sample = self.replay_buffer.can_sample(self.batch_size)
-                if can_sample and self.num_timesteps > self.learning_starts \
-                        and self.num_timesteps % self.train_freq == 0:
+                # train_freq is in env steps: one training step per multiple of train_freq
+                train_rounds = self._train_rounds(self.num_timesteps, self.train_freq)
+                for _ in range(train_rounds if can_sample and self.num_timesteps > self.learning_starts else 0):
                     # Minimize the error in Bellman's equation on a batch sampled from replay buffer.
                     # pytype:disable=bad-unpacking
                     if self.prioritized_replay:
@@ -248,8 +288,11 @@ class DQN(OffPolicyRLModel):
                         experience = self.replay_buffer.sample(self.batch_size,
                                                                beta=self.beta_schedule.value(self.num_timesteps))
                         (obses_t, actions, rewards, obses_tp1, dones, weights, batch_idxes) = experience
+                        discounts = []
                     else:
-                        obses_t, actions, rewards, obses_tp1, dones = self.replay_buffer.sample(self.batch_size)
+                        # With n-step returns, the discounts are sampled too
+                        obses_t, actions, rewards, obses_tp1, dones, *discounts = self.replay_buffer.sample(
+                            self.batch_size)
                         weights, batch_idxes = np.ones_like(rewards), None
                     # pytype:enable=bad-unpacking
 
@@ -260,16 +303,16 @@ class DQN(OffPolicyRLModel):
                             run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
                             run_metadata = tf.RunMetadata()
                             summary, td_errors = self._train_step(obses_t, actions, rewards, obses_tp1, obses_tp1,
-                                                                  dones, weights, sess=self.sess, options=run_options,
-                                                                  run_metadata=run_metadata)
+                                                                  dones, weights, *discounts, sess=self.sess,
+                                                                  options=run_options, run_metadata=run_metadata)
                             writer.add_run_metadata(run_metadata, 'step%d' % self.num_timesteps)
                         else:
                             summary, td_errors = self._train_step(obses_t, actions, rewards, obses_tp1, obses_tp1,
-                                                                  dones, weights, sess=self.sess)
+                                                                  dones, weights, *discounts, sess=self.sess)
                         writer.add_summary(summary, self.num_timesteps)
                     else:
                         _, td_errors = self._train_step(obses_t, actions, rewards, obses_tp1, obses_tp1, dones, weights,
-                                                        sess=self.sess)
+                                                        *discounts, sess=self.sess)
 
                     if self.prioritized_replay:
                         new_priorities = np.abs(td_errors) + self.prioritized_replay_eps
@@ -277,7 +320,7 @@ class DQN(OffPolicyRLModel):
                         self.replay_buffer.update_priorities(batch_idxes, new_priorities)
 
                 if can_sample and self.num_timesteps > self.learning_starts and \
-                        self.num_timesteps % self.target_network_update_freq == 0:
+                        self._train_rounds(self.num_timesteps, self.target_network_update_freq) > 0:
                     # Update target network periodically.
                     self.update_target(sess=self.sess)
 
@@ -287,7 +330,8 @@ class DQN(OffPolicyRLModel):
                     mean_100ep_reward = round(float(np.mean(episode_rewards[-101:-1])), 1)
 
                 num_episodes = len(episode_rewards)
-                if self.verbose >= 1 and done and log_interval is not None and len(episode_rewards) % log_interval == 0:
+                if self.verbose >= 1 and n_ended > 0 and log_interval is not None and \
+                        num_episodes // log_interval > (num_episodes - n_ended) // log_interval:
                     logger.record_tabular("steps", self.num_timesteps)
                     logger.record_tabular("episodes", num_episodes)
                     if len(episode_successes) > 0:
@@ -297,7 +341,7 @@ class DQN(OffPolicyRLModel):
                                           int(100 * self.exploration.value(self.num_timesteps)))
                     logger.dump_tabular()
 
-                self.num_timesteps += 1
+                self.num_timesteps += self.n_envs
 
         return self
 
@@ -360,6 +404,9 @@ class DQN(OffPolicyRLModel):
             "exploration_fraction": self.exploration_fraction,
             "learning_rate": self.learning_rate,
             "gamma": self.gamma,
+            "n_step": self.n_step,
+            "prefetch_batches": self.prefetch_batches,
+            "frame_pool": self.frame_pool,
             "verbose": self.verbose,
             "observation_space": self.observation_space,
             "action_space": self.action_space,
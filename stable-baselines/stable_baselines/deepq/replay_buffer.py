@@ -1,4 +1,8 @@
-import random
+import os
+import pickle
+import queue
+import shutil
+import threading
 
 import numpy as np
 
@@ -6,24 +10,46 @@ from stable_baselines.common.segment_tree import SumSegmentTree, MinSegmentTree
 
 
 class ReplayBuffer(object):
-    def __init__(self, size):
+    def __init__(self, size, dedup_obs=False):
         """
         Implements a ring buffer (FIFO).
 
+        Transitions are stored column-wise, in one preallocated array per field. The arrays are allocated
+        when the first transition is added, with the shapes and dtypes of its observation and action.
+
         :param size: (int)  Max number of transitions to store in the buffer. When the buffer overflows the old
             memories are dropped.
+        :param dedup_obs: (bool) Store each observation once: the observations are kept as a single stream
+            (with one extra slot), and the next observation of a transition is the observation that follows it
+            in the stream. Next observations that are not the following observation (e.g. terminal observations)
+            are stored separately. This halves the memory used by observations when the transitions of an episode
+            are added consecutively, i.e. from a single environment. With several environments, nearly every next
+            observation would be stored separately, so ``extend`` refuses the batches that interleave streams
+            (e.g. one step of a VecEnv).
         """
-        self._storage = []
         self._maxsize = size
+        self._dedup_obs = dedup_obs
         self._next_idx = 0
+        self._len = 0
+        self._obses_t = None
+        self._actions = None
+        self._rewards = None
+        self._obses_tp1 = None
+        self._dones = None
+        # Observation stream, when deduplicating observations
+        self._n_added = 0
+        self._prev_idx = None
+        self._obs_slots = None
+        self._next_obs_apart = None
+        self._apart_next_obses = {}
 
     def __len__(self):
-        return len(self._storage)
+        return self._len
 
     @property
     def storage(self):
         """[(Union[np.ndarray, int], Union[np.ndarray, int], float, Union[np.ndarray, int], bool)]: content of the replay buffer"""
-        return self._storage
+        return _TransitionsView(self)
 
     @property
     def buffer_size(self):
@@ -48,6 +74,38 @@ class ReplayBuffer(object):
         """
         return len(self) == self.buffer_size
 
+    def _make_array(self, name, shape, dtype):
+        """
+        Allocate the storage of a field
+
+        :param name: (str) the name of the field
+        :param shape: (tuple) the shape of the storage, the first dimension indexes the transitions
+        :param dtype: (np.dtype) the dtype of the field
+        :return: (np.ndarray) an array of the given shape and dtype
+        """
+        return np.zeros(shape, dtype=dtype)
+
+    def _setup_storage(self, obs, action):
+        """
+        Allocate the storage of all the fields, from a single observation and action
+
+        :param obs: (np.ndarray) an observation
+        :param action: (np.ndarray) an action
+        """
+        obs, action = np.asarray(obs), np.asarray(action)
+        size = self._maxsize
+        self._actions = self._make_array('actions', (size,) + action.shape, action.dtype)
+        self._rewards = self._make_array('rewards', (size,), np.float32)
+        self._dones = self._make_array('dones', (size,), np.float32)
+        if self._dedup_obs:
+            # The stream has one more slot than transitions, for the next observation of the last transition
+            self._obses_t = self._make_array('obses_t', (size + 1,) + obs.shape, obs.dtype)
+            self._obs_slots = self._make_array('obs_slots', (size,), np.int64)
+            self._next_obs_apart = self._make_array('next_obs_apart', (size,), np.bool_)
+        else:
+            self._obses_t = self._make_array('obses_t', (size,) + obs.shape, obs.dtype)
+            self._obses_tp1 = self._make_array('obses_tp1', (size,) + obs.shape, obs.dtype)
+
     def add(self, obs_t, action, reward, obs_tp1, done):
         """
         add a new transition to the buffer
@@ -58,31 +116,126 @@ class ReplayBuffer(object):
         :param obs_tp1: (Union[np.ndarray, int]) the current observation
         :param done: (bool) is the episode done
         """
-        data = (obs_t, action, reward, obs_tp1, done)
-
-        if self._next_idx >= len(self._storage):
-            self._storage.append(data)
+        if self._obses_t is None:
+            self._setup_storage(obs_t, action)
+        idx = self._next_idx
+        if self._dedup_obs:
+            self._add_obs(idx, obs_t, obs_tp1, done)
         else:
-            self._storage[self._next_idx] = data
+            self._obses_t[idx] = obs_t
+            self._obses_tp1[idx] = obs_tp1
+        self._actions[idx] = action
+        self._rewards[idx] = reward
+        self._dones[idx] = done
         self._next_idx = (self._next_idx + 1) % self._maxsize
+        self._len = min(self._len + 1, self._maxsize)
+
+    def _add_obs(self, idx, obs_t, obs_tp1, done):
+        """
+        Write the observations of a transition in the observation stream
+
+        :param idx: (int) the index of the transition
+        :param obs_t: (np.ndarray) the last observation
+        :param obs_tp1: (np.ndarray) the current observation
+        :param done: (bool) is the episode done
+        """
+        n_slots = self._maxsize + 1
+        slot = self._n_added % n_slots
+        prev_idx = self._prev_idx
+        if prev_idx is not None and not self._next_obs_apart[prev_idx] \
+                and not np.array_equal(self._obses_t[slot], obs_t):
+            # The stream is broken: keep the next observation of the previous transition apart
+            self._apart_next_obses[prev_idx] = self._obses_t[slot].copy()
+            self._next_obs_apart[prev_idx] = True
+        # The transition that is overwritten does not need its next observation anymore
+        self._apart_next_obses.pop(idx, None)
+        self._next_obs_apart[idx] = bool(done)
+        self._obses_t[slot] = obs_t
+        self._obs_slots[idx] = slot
+        if done:
+            # The next observation in the stream will be the first one of another episode
+            self._apart_next_obses[idx] = np.array(obs_tp1, dtype=self._obses_t.dtype)
+        else:
+            # Overwrites the slot of the oldest transition, which has just been replaced
+            self._obses_t[(slot + 1) % n_slots] = obs_tp1
+        self._prev_idx = idx
+        self._n_added += 1
+
+    def extend(self, obs_t, action, reward, obs_tp1, done):
+        """
+        add a batch of transitions to the buffer, e.g. one per environment of a VecEnv
+
+        :param obs_t: (np.ndarray) the last observations
+        :param action: (np.ndarray) the actions
+        :param reward: (np.ndarray) the rewards of the transitions
+        :param obs_tp1: (np.ndarray) the current observations
+        :param done: (np.ndarray) whether the episodes are done
+        """
+        if self._dedup_obs:
+            obs_t, obs_tp1, done = np.asarray(obs_t), np.asarray(obs_tp1), np.asarray(done)
+            n_transitions = len(obs_t)
+            follows = (obs_tp1[:-1] == obs_t[1:]).reshape(max(n_transitions - 1, 0), -1).all(axis=1)
+            if not np.all(follows | (done[:-1] != 0)):
+                raise ValueError("A replay buffer with dedup_obs only stores consecutive transitions of a single "
+                                 "environment, use dedup_obs=False with several environments")
+            # The observation stream is written one transition at a time
+            for transition in zip(obs_t, action, reward, obs_tp1, done):
+                self.add(*transition)
+            return
+        obs_t, action, reward, obs_tp1, done = map(np.asarray, (obs_t, action, reward, obs_tp1, done))
+        if self._obses_t is None:
+            self._setup_storage(obs_t[0], action[0])
+        n_transitions = len(obs_t)
+        if n_transitions > self._maxsize:
+            # Only the last transitions would be kept
+            self._next_idx = (self._next_idx + n_transitions - self._maxsize) % self._maxsize
+            obs_t, action, reward, obs_tp1, done = (arr[-self._maxsize:] for arr in (obs_t, action, reward, obs_tp1,
+                                                                                     done))
+            n_transitions = self._maxsize
+        idxes = (self._next_idx + np.arange(n_transitions)) % self._maxsize
+        self._obses_t[idxes] = obs_t
+        self._actions[idxes] = action
+        self._rewards[idxes] = reward
+        self._obses_tp1[idxes] = obs_tp1
+        self._dones[idxes] = done
+        self._next_idx = (self._next_idx + n_transitions) % self._maxsize
+        self._len = min(self._len + n_transitions, self._maxsize)
+
+    def _encode_obs(self, idxes):
+        """
+        Gather the observations and next observations of transitions
+
+        :param idxes: (np.ndarray) the indexes of the transitions
+        :return: (np.ndarray, np.ndarray) the observations and the next observations
+        """
+        if not self._dedup_obs:
+            return self._obses_t[idxes], self._obses_tp1[idxes]
+        slots = self._obs_slots[idxes]
+        obses_t = self._obses_t[slots]
+        obses_tp1 = self._obses_t[(slots + 1) % (self._maxsize + 1)]
+        for i in np.flatnonzero(self._next_obs_apart[idxes]):
+            obses_tp1[i] = self._apart_next_obses[idxes[i]]
+        return obses_t, obses_tp1
+
+    def ordered_idxes(self):
+        """
+        The indexes of the stored transitions, from the oldest to the newest
+
+        :return: (np.ndarray) the indexes
+        """
+        start = self._next_idx if self.is_full() else 0
+        return (start + np.arange(len(self))) % self._maxsize
 
     def _encode_sample(self, idxes):
-        obses_t, actions, rewards, obses_tp1, dones = [], [], [], [], []
-        for i in idxes:
-            data = self._storage[i]
-            obs_t, action, reward, obs_tp1, done = data
-            obses_t.append(np.array(obs_t, copy=False))
-            actions.append(np.array(action, copy=False))
-            rewards.append(reward)
-            obses_tp1.append(np.array(obs_tp1, copy=False))
-            dones.append(done)
-        return np.array(obses_t), np.array(actions), np.array(rewards), np.array(obses_tp1), np.array(dones)
-
-    def sample(self, batch_size, **_kwargs):
+        obses_t, obses_tp1 = self._encode_obs(idxes)
+        return obses_t, self._actions[idxes], self._rewards[idxes], obses_tp1, self._dones[idxes]
+
+    def sample(self, batch_size, rng=None, **_kwargs):
         """
         Sample a batch of experiences.
 
         :param batch_size: (int) How many transitions to sample.
+        :param rng: (np.random.RandomState) the random generator to sample with, the global one if None
         :return:
             - obs_batch: (np.ndarray) batch of observations
             - act_batch: (numpy float) batch of actions executed given obs_batch
@@ -91,12 +244,37 @@ class ReplayBuffer(object):
             - done_mask: (numpy bool) done_mask[i] = 1 if executing act_batch[i] resulted in the end of an episode
                 and 0 otherwise.
         """
-        idxes = [random.randint(0, len(self._storage) - 1) for _ in range(batch_size)]
+        idxes = (np.random if rng is None else rng).randint(0, len(self), size=batch_size)
         return self._encode_sample(idxes)
 
 
+class _TransitionsView(object):
+    def __init__(self, replay_buffer):
+        """
+        Read-only sequence of the transitions of a replay buffer, as (obs_t, action, reward, obs_tp1, done) tuples
+
+        :param replay_buffer: (ReplayBuffer) the replay buffer
+        """
+        self.replay_buffer = replay_buffer
+
+    def __len__(self):
+        return len(self.replay_buffer)
+
+    def __getitem__(self, idx):
+        """
+        :param idx: (Union[int, np.ndarray]) the index of a transition, or an array of indexes
+        :return: (tuple) the transition, or the batch of transitions for an array of indexes
+        """
+        idxes = np.asarray(idx)
+        if np.any(idxes < -len(self)) or np.any(idxes >= len(self)):
+            raise IndexError("replay buffer index out of range")
+        if idxes.ndim > 0:
+            return self.replay_buffer._encode_sample(idxes % len(self))
+        return tuple(field[0] for field in self.replay_buffer._encode_sample(np.array([idx % len(self)])))
+
+
 class PrioritizedReplayBuffer(ReplayBuffer):
-    def __init__(self, size, alpha):
+    def __init__(self, size, alpha, dedup_obs=False, stratified=False):
         """
         Create Prioritized Replay buffer.
 
@@ -105,10 +283,14 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         :param size: (int) Max number of transitions to store in the buffer. When the buffer overflows the old memories
             are dropped.
         :param alpha: (float) how much prioritization is used (0 - no prioritization, 1 - full prioritization)
+        :param dedup_obs: (bool) Store each observation once, see ReplayBuffer.__init__
+        :param stratified: (bool) Sample one transition in each of `batch_size` segments of equal priority mass
+            (as in the prioritized experience replay paper), instead of sampling them independently
         """
-        super(PrioritizedReplayBuffer, self).__init__(size)
+        super(PrioritizedReplayBuffer, self).__init__(size, dedup_obs=dedup_obs)
         assert alpha >= 0
         self._alpha = alpha
+        self._stratified = stratified
 
         it_capacity = 1
         while it_capacity < size:
@@ -133,13 +315,24 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         self._it_sum[idx] = self._max_priority ** self._alpha
         self._it_min[idx] = self._max_priority ** self._alpha
 
+    def extend(self, obs_t, action, reward, obs_tp1, done):
+        """
+        add a batch of transitions to the buffer, with the maximum priority
+
+        :param obs_t: (np.ndarray) the last observations
+        :param action: (np.ndarray) the actions
+        :param reward: (np.ndarray) the rewards of the transitions
+        :param obs_tp1: (np.ndarray) the current observations
+        :param done: (np.ndarray) whether the episodes are done
+        """
+        n_stored = min(len(obs_t), self._maxsize)
+        super().extend(obs_t, action, reward, obs_tp1, done)
+        idxes = (self._next_idx - n_stored + np.arange(n_stored)) % self._maxsize
+        self._it_sum[idxes] = self._max_priority ** self._alpha
+        self._it_min[idxes] = self._max_priority ** self._alpha
+
     def _sample_proportional(self, batch_size):
-        mass = []
-        total = self._it_sum.sum(0, len(self._storage) - 1)
-        # TODO(szymon): should we ensure no repeats?
-        mass = np.random.random(size=batch_size) * total
-        idx = self._it_sum.find_prefixsum_idx(mass)
-        return idx
+        return self._it_sum.sample(batch_size, stratified=self._stratified, end=len(self))
 
     def sample(self, batch_size, beta=0):
         """
@@ -165,11 +358,12 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         assert beta > 0
 
         idxes = self._sample_proportional(batch_size)
-        weights = []
-        p_min = self._it_min.min() / self._it_sum.sum()
-        max_weight = (p_min * len(self._storage)) ** (-beta)
-        p_sample = self._it_sum[idxes] / self._it_sum.sum()
-        weights = (p_sample * len(self._storage)) ** (-beta) / max_weight
+        # The reductions over the whole trees are read from their roots
+        total = self._it_sum.sum()
+        p_min = self._it_min.min() / total
+        max_weight = (p_min * len(self)) ** (-beta)
+        p_sample = self._it_sum[idxes] / total
+        weights = (p_sample * len(self)) ** (-beta) / max_weight
         encoded_sample = self._encode_sample(idxes)
         return tuple(list(encoded_sample) + [weights, idxes])
 
@@ -187,9 +381,528 @@ class PrioritizedReplayBuffer(ReplayBuffer):
         assert len(idxes) == len(priorities)
         assert np.min(priorities) > 0
         assert np.min(idxes) >= 0
-        assert np.max(idxes) < len(self.storage)
+        assert np.max(idxes) < len(self)
         self._it_sum[idxes] = priorities ** self._alpha
         self._it_min[idxes] = priorities ** self._alpha
 
         self._max_priority = max(self._max_priority, np.max(priorities))
 
+
+class NStepReplayBuffer(ReplayBuffer):
+    def __init__(self, size, n_step, gamma):
+        """
+        Replay buffer of n-step transitions: the reward of a transition is the discounted sum of the rewards of
+        the next `n_step` steps (or until the end of the episode), its next observation is the observation
+        `n_step` steps later, and the discount to apply to the value of that observation is stored along.
+
+        The transitions are added one step at a time, for one env (``add``) or for all the envs of a VecEnv
+        (``extend``), and are stored once their `n_step` rewards are known (or the episode is done).
+        ``sample`` returns the discounts as a sixth field.
+
+        See Also ReplayBuffer.__init__
+
+        :param size: (int) Max number of transitions to store in the buffer. When the buffer overflows the old memories
+            are dropped.
+        :param n_step: (int) the number of rewards summed in each transition
+        :param gamma: (float) the discount factor
+        """
+        super(NStepReplayBuffer, self).__init__(size)
+        assert n_step >= 1, "n_step must be positive"
+        self.n_step = n_step
+        self.gamma = gamma
+        self._discounts = None
+        # The last transitions of each env, waiting for their rewards, in a ring of n_step slots shared by the envs
+        self._step = 0
+        self._n_pending = None
+        self._pending_obs = None
+        self._pending_actions = None
+        self._pending_returns = None
+
+    def _setup_storage(self, obs, action):
+        super(NStepReplayBuffer, self)._setup_storage(obs, action)
+        self._discounts = self._make_array('discounts', (self._maxsize,), np.float32)
+
+    def _setup_pending(self, obs_t, action):
+        n_envs = len(obs_t)
+        self._n_pending = np.zeros(n_envs, dtype=np.int64)
+        self._pending_obs = np.zeros((self.n_step,) + obs_t.shape, dtype=obs_t.dtype)
+        self._pending_actions = np.zeros((self.n_step,) + action.shape, dtype=action.dtype)
+        self._pending_returns = np.zeros((self.n_step, n_envs), dtype=np.float64)
+
+    def add(self, obs_t, action, reward, obs_tp1, done):
+        """
+        add the transition of a step of a single env
+
+        :param obs_t: (Union[np.ndarray, int]) the last observation
+        :param action: (Union[np.ndarray, int]) the action
+        :param reward: (float) the reward of the transition
+        :param obs_tp1: (Union[np.ndarray, int]) the current observation
+        :param done: (bool) is the episode done
+        """
+        self.extend(*([field] for field in (obs_t, action, reward, obs_tp1, done)))
+
+    def extend(self, obs_t, action, reward, obs_tp1, done):
+        """
+        add the transitions of a step of all the envs of a VecEnv
+
+        :param obs_t: (np.ndarray) the last observations, one per env
+        :param action: (np.ndarray) the actions
+        :param reward: (np.ndarray) the rewards of the transitions
+        :param obs_tp1: (np.ndarray) the current observations
+        :param done: (np.ndarray) whether the episodes are done
+        """
+        obs_t, action, reward, obs_tp1, done = map(np.asarray, (obs_t, action, reward, obs_tp1, done))
+        done = done.astype(bool)
+        if self._n_pending is None:
+            self._setup_pending(obs_t, action)
+        assert len(obs_t) == len(self._n_pending), "the number of envs cannot change"
+
+        slot = self._step % self.n_step
+        self._pending_obs[slot] = obs_t
+        self._pending_actions[slot] = action
+        self._pending_returns[slot] = 0.0
+        self._n_pending += 1
+
+        # Number of steps since each slot was added, the slots older than the pending transitions are not valid
+        ages = (slot - np.arange(self.n_step)) % self.n_step
+        valid = ages[:, None] < self._n_pending[None, :]
+        self._pending_returns += np.where(valid, self.gamma ** ages[:, None] * reward[None, :], 0.0)
+
+        # Store the transitions with n_step rewards, and all the transitions of the episodes that are done
+        ready = valid & ((ages[:, None] == self.n_step - 1) | done[None, :])
+        # From the oldest to the newest
+        slots, envs = np.nonzero(ready)
+        order = np.lexsort((envs, -ages[slots]))
+        slots, envs = slots[order], envs[order]
+        if len(slots) > 0:
+            self._store(self._pending_obs[slots, envs], self._pending_actions[slots, envs],
+                        self._pending_returns[slots, envs], obs_tp1[envs], done[envs],
+                        self.gamma ** (ages[slots] + 1))
+        self._n_pending -= np.sum(ready, axis=0)
+        self._step += 1
+
+    def _store(self, obs_t, action, reward, obs_tp1, done, discount):
+        """
+        Store n-step transitions
+
+        :param obs_t: (np.ndarray) the first observations of the transitions
+        :param action: (np.ndarray) the first actions
+        :param reward: (np.ndarray) the discounted sums of rewards
+        :param obs_tp1: (np.ndarray) the observations to bootstrap from
+        :param done: (np.ndarray) whether the episodes are done
+        :param discount: (np.ndarray) the discounts of the values of the bootstrap observations
+        """
+        n_stored = min(len(obs_t), self._maxsize)
+        super(NStepReplayBuffer, self).extend(obs_t, action, reward, obs_tp1, done)
+        idxes = (self._next_idx - n_stored + np.arange(n_stored)) % self._maxsize
+        self._discounts[idxes] = discount[-n_stored:]
+
+    def _encode_sample(self, idxes):
+        return super(NStepReplayBuffer, self)._encode_sample(idxes) + (self._discounts[idxes],)
+
+
+class FramePoolReplayBuffer(ReplayBuffer):
+    def __init__(self, size):
+        """
+        Replay buffer for stacked frames (e.g. the ``LazyFrames`` of ``FrameStack``), storing each frame once.
+
+        The frames are kept in a pool with reference counts, and each transition stores the indexes of the frames of
+        its observation and next observation, the stacks being concatenated (along the last axis) when sampling.
+        A frame of an observation with a ``frames`` list (like ``LazyFrames``) is shared with the frames of the
+        previous transition that are the same object, so consecutive stacks of an episode add one frame each.
+        An observation that is the next observation of the previous transition shares all its frames with it, even
+        if it was converted to an array since (which drops the frames of ``LazyFrames``, e.g. when the policy reads
+        it). The other converted ``LazyFrames`` share their frames that are equal to the frames of their next
+        observation, shifted by one. Other observations are split in the same number of frames, stored without
+        sharing.
+
+        See Also ReplayBuffer.__init__
+
+        :param size: (int) Max number of transitions to store in the buffer. When the buffer overflows the old memories
+            are dropped.
+        """
+        super(FramePoolReplayBuffer, self).__init__(size)
+        self._n_frames = None
+        self._frames = None
+        self._frame_counts = None
+        self._frame_refs = None
+        self._free_frames = []
+        # Pool slots of the frames of the last transition, by frame id (the frames are kept alive along)
+        self._recent_frames = {}
+        # Next observation of the last transition, and the pool slots of its frames
+        self._last_obs_tp1 = None
+        self._last_slots_tp1 = None
+
+    def _get_frames(self, obs):
+        """
+        :param obs: (Union[LazyFrames, np.ndarray]) a stacked observation
+        :return: ([np.ndarray]) its frames
+        """
+        frames = getattr(obs, 'frames', None)
+        if frames is None:
+            frames = np.split(np.asarray(obs), self._n_frames or 1, axis=-1)
+        return frames
+
+    def _setup_storage(self, obs, action):
+        frames = self._get_frames(obs)
+        frame, action = np.asarray(frames[0]), np.asarray(action)
+        size = self._maxsize
+        self._n_frames = len(frames)
+        self._actions = self._make_array('actions', (size,) + action.shape, action.dtype)
+        self._rewards = self._make_array('rewards', (size,), np.float32)
+        self._dones = self._make_array('dones', (size,), np.float32)
+        # Pool slots of the frames of the observation and next observation of each transition
+        self._frame_refs = self._make_array('frame_refs', (size, 2, self._n_frames), np.int64)
+        # About one new frame per transition, the pool grows if needed
+        self._grow_pool(frame, size + 2 * self._n_frames)
+
+    def _grow_pool(self, frame, capacity):
+        """
+        Reallocate the frame pool with a larger capacity
+
+        :param frame: (np.ndarray) a frame
+        :param capacity: (int) the new number of frames of the pool
+        """
+        old_capacity = 0 if self._frames is None else len(self._frames)
+        frames = np.zeros((capacity,) + frame.shape, dtype=frame.dtype)
+        frame_counts = np.zeros(capacity, dtype=np.int64)
+        if old_capacity > 0:
+            frames[:old_capacity] = self._frames
+            frame_counts[:old_capacity] = self._frame_counts
+        self._frames, self._frame_counts = frames, frame_counts
+        # The lowest slots are allocated first
+        self._free_frames.extend(range(capacity - 1, old_capacity - 1, -1))
+
+    def _ref_frames(self, frames, known_frames):
+        """
+        Get the pool slots of the frames of an observation, writing its new frames to the pool
+
+        :param frames: ([np.ndarray]) the frames of a stacked observation
+        :param known_frames: (dict) the (frame, slot) of the frames already in the pool, by frame id, updated
+        :return: ([int]) the slots of the frames
+        """
+        slots = []
+        for frame in frames:
+            known = known_frames.get(id(frame))
+            if known is not None and known[0] is frame:
+                slot = known[1]
+            else:
+                if not self._free_frames:
+                    # One frame per episode in the buffer is not shared, grow by small steps
+                    capacity = len(self._frames)
+                    self._grow_pool(np.asarray(frame), capacity + capacity // 8 + 2 * self._n_frames)
+                slot = self._free_frames.pop()
+                self._frames[slot] = frame
+                known_frames[id(frame)] = (frame, slot)
+            self._frame_counts[slot] += 1
+            slots.append(slot)
+        return slots
+
+    def add(self, obs_t, action, reward, obs_tp1, done):
+        if self._frames is None:
+            # The first observation may already have been converted to an array, not the next one
+            self._setup_storage(obs_tp1, action)
+        idx = self._next_idx
+        known_frames = dict(self._recent_frames)
+        # Read before anything converts the next observation to an array
+        frames_tp1 = self._get_frames(obs_tp1)
+        slots_tp1 = self._ref_frames(frames_tp1, known_frames)
+        if obs_t is self._last_obs_tp1 and hasattr(obs_t, 'frames'):
+            slots_t = self._last_slots_tp1
+            np.add.at(self._frame_counts, slots_t, 1)
+        else:
+            frames_t = self._get_frames(obs_t)
+            if hasattr(obs_t, 'frames') and obs_t.frames is None:
+                # Converted to an array (e.g. the first observation of an episode, read by the policy): the stack
+                # is shifted by one frame in the next observation, whose frames are shared when they are equal
+                frames_t = frames_t[:1] + [frame_tp1 if np.array_equal(frame, frame_tp1) else frame
+                                           for frame, frame_tp1 in zip(frames_t[1:], frames_tp1)]
+            slots_t = self._ref_frames(frames_t, known_frames)
+        refs = [slots_t, slots_tp1]
+        if idx < self._len:
+            # Release the frames of the overwritten transition, after referencing the new ones that it may share
+            old_refs = self._frame_refs[idx].ravel()
+            np.subtract.at(self._frame_counts, old_refs, 1)
+            old_refs = np.unique(old_refs)
+            self._free_frames.extend(old_refs[self._frame_counts[old_refs] == 0].tolist())
+        self._frame_refs[idx] = refs
+        self._recent_frames = {id(frame): known_frames[id(frame)] for frame in frames_tp1}
+        self._last_obs_tp1, self._last_slots_tp1 = obs_tp1, refs[1]
+        self._actions[idx] = action
+        self._rewards[idx] = reward
+        self._dones[idx] = done
+        self._next_idx = (self._next_idx + 1) % self._maxsize
+        self._len = min(self._len + 1, self._maxsize)
+
+    def extend(self, obs_t, action, reward, obs_tp1, done):
+        for transition in zip(obs_t, action, reward, obs_tp1, done):
+            self.add(*transition)
+
+    def _encode_obs(self, idxes):
+        # [batch_size, 2, n_frames, ..., n_channels] -> [batch_size, 2, ..., n_frames * n_channels]
+        obses = np.moveaxis(self._frames[self._frame_refs[idxes]], 2, -2)
+        obses = obses.reshape(obses.shape[:-2] + (-1,))
+        return obses[:, 0], obses[:, 1]
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    # Name of the file holding the position of the ring buffer
+    STATE_FILE = "replay_buffer_state.pkl"
+    FIELDS = ('obses_t', 'actions', 'rewards', 'obses_tp1', 'dones', 'obs_slots', 'next_obs_apart')
+
+    def __init__(self, size, path, dedup_obs=False):
+        """
+        Replay buffer stored in memory-mapped ``.npy`` files, one per field, so that it can be larger than the RAM
+        and survive the process. Use ``MemmapReplayBuffer.load`` to reopen an existing buffer.
+
+        See Also ReplayBuffer.__init__
+
+        :param size: (int) Max number of transitions to store in the buffer. When the buffer overflows the old memories
+            are dropped.
+        :param path: (str) the directory of the files, existing files of a buffer are overwritten
+        :param dedup_obs: (bool) Store each observation once, see ReplayBuffer.__init__
+        """
+        super(MemmapReplayBuffer, self).__init__(size, dedup_obs=dedup_obs)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        state_path = os.path.join(path, self.STATE_FILE)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+    def _make_array(self, name, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(self.path, name + ".npy"), mode='w+', dtype=dtype,
+                                         shape=shape)
+
+    def sample(self, batch_size, rng=None, **_kwargs):
+        """
+        Sample a batch of experiences, sorted by index so that the files are read in order.
+
+        See Also ReplayBuffer.sample
+
+        :param batch_size: (int) How many transitions to sample.
+        :param rng: (np.random.RandomState) the random generator to sample with, the global one if None
+        :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) obs_batch, act_batch, rew_batch,
+            next_obs_batch, done_mask
+        """
+        idxes = np.sort((np.random if rng is None else rng).randint(0, len(self), size=batch_size))
+        return self._encode_sample(idxes)
+
+    def _get_state(self):
+        return {
+            "size": self._maxsize,
+            "dedup_obs": self._dedup_obs,
+            "next_idx": self._next_idx,
+            "len": self._len,
+            "n_added": self._n_added,
+            "prev_idx": self._prev_idx,
+            "apart_next_obses": self._apart_next_obses,
+        }
+
+    def flush(self):
+        """
+        Write the transitions and the position of the buffer to disk, so that it can be reopened with
+        ``MemmapReplayBuffer.load``
+        """
+        for name in self.FIELDS:
+            array = getattr(self, '_' + name)
+            if array is not None:
+                array.flush()
+        # Write then rename, so that a crash never leaves a truncated state file
+        state_path = os.path.join(self.path, self.STATE_FILE)
+        with open(state_path + ".tmp", "wb") as file_handler:
+            pickle.dump(self._get_state(), file_handler)
+        os.replace(state_path + ".tmp", state_path)
+
+    def snapshot(self, path):
+        """
+        Flush the buffer and copy its files to another directory, e.g. next to a saved model
+
+        :param path: (str) the directory of the snapshot
+        """
+        self.flush()
+        if os.path.abspath(path) == os.path.abspath(self.path):
+            return
+        os.makedirs(path, exist_ok=True)
+        for name in self.FIELDS:
+            if getattr(self, '_' + name) is not None:
+                shutil.copyfile(os.path.join(self.path, name + ".npy"), os.path.join(path, name + ".npy"))
+        shutil.copyfile(os.path.join(self.path, self.STATE_FILE), os.path.join(path, self.STATE_FILE))
+
+    @classmethod
+    def load(cls, path, mode='r+'):
+        """
+        Reopen a buffer that was flushed or snapshotted to a directory
+
+        :param path: (str) the directory of the buffer
+        :param mode: (str) the mode of the memory maps, 'r+' to keep adding transitions to the files, 'c' to add
+            them in memory only (copy-on-write), leaving the files untouched
+        :return: (MemmapReplayBuffer) the buffer
+        """
+        with open(os.path.join(path, cls.STATE_FILE), "rb") as file_handler:
+            state = pickle.load(file_handler)
+        buffer = cls.__new__(cls)
+        ReplayBuffer.__init__(buffer, state["size"], dedup_obs=state["dedup_obs"])
+        buffer.path = path
+        buffer._next_idx = state["next_idx"]
+        buffer._len = state["len"]
+        buffer._n_added = state["n_added"]
+        buffer._prev_idx = state["prev_idx"]
+        buffer._apart_next_obses = state["apart_next_obses"]
+        for name in cls.FIELDS:
+            file_path = os.path.join(path, name + ".npy")
+            if os.path.exists(file_path):
+                setattr(buffer, '_' + name, np.lib.format.open_memmap(file_path, mode=mode))
+        return buffer
+
+    @classmethod
+    def from_buffer(cls, replay_buffer, path):
+        """
+        Copy the transitions of a replay buffer to a new memory-mapped buffer.
+        The fields and the position of the ring buffer (and of the observation stream, with ``dedup_obs``) are
+        copied as they are, so that adding transitions to the copy continues the stream of the buffer.
+
+        :param replay_buffer: (ReplayBuffer) the buffer to copy
+        :param path: (str) the directory of the new buffer
+        :return: (MemmapReplayBuffer) the buffer, flushed to disk
+        """
+        if isinstance(replay_buffer, NStepReplayBuffer):
+            raise ValueError("The discounts of n-step transitions cannot be copied to a MemmapReplayBuffer")
+        buffer = cls(replay_buffer.buffer_size, path, dedup_obs=replay_buffer._dedup_obs)
+        if isinstance(replay_buffer, FramePoolReplayBuffer):
+            # The frames are kept in a pool: copy the stacked observations
+            if len(replay_buffer) > 0:
+                buffer.extend(*replay_buffer._encode_sample(replay_buffer.ordered_idxes()))
+        elif replay_buffer._obses_t is not None:
+            for name in cls.FIELDS:
+                array = getattr(replay_buffer, '_' + name)
+                if array is not None:
+                    copy = buffer._make_array(name, array.shape, array.dtype)
+                    copy[...] = array
+                    setattr(buffer, '_' + name, copy)
+            buffer._next_idx = replay_buffer._next_idx
+            buffer._len = replay_buffer._len
+            buffer._n_added = replay_buffer._n_added
+            buffer._prev_idx = replay_buffer._prev_idx
+            buffer._apart_next_obses = {idx: obs.copy() for idx, obs in replay_buffer._apart_next_obses.items()}
+        buffer.flush()
+        return buffer
+
+
+class PrefetchReplayBuffer(object):
+    def __init__(self, replay_buffer, batch_size, n_batches=2):
+        """
+        Wraps a replay buffer to sample the next minibatches on a background thread, into a bounded queue,
+        so that the learner finds a minibatch ready and the NumPy gathers overlap with the TensorFlow computations.
+
+        Transitions are added under a lock shared with the sampling thread. A prefetched minibatch does not contain
+        the transitions added after it was sampled (it is at most `n_batches` minibatches ahead).
+
+        The sampling thread draws from its own random generator, seeded from the global one when the wrapper is
+        created, so that it does not change the draws of the main thread (e.g. for exploration). The transitions
+        stored when a minibatch is sampled still depend on the thread scheduling: a seeded run is not exactly
+        reproducible with prefetching.
+
+        :param replay_buffer: (ReplayBuffer) the replay buffer to sample from (or a wrapper, e.g. for HER)
+        :param batch_size: (int) the size of the prefetched minibatches, other sizes are sampled synchronously
+        :param n_batches: (int) the number of minibatches sampled ahead
+        """
+        if isinstance(replay_buffer, PrioritizedReplayBuffer):
+            raise ValueError("A PrioritizedReplayBuffer cannot be prefetched, "
+                             "its priorities are updated after each minibatch")
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self._rng = np.random.RandomState(np.random.randint(2 ** 31))
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=n_batches)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self.replay_buffer)
+
+    def __getattr__(self, attr):
+        if attr == 'replay_buffer':
+            # Not set yet (e.g. when unpickling)
+            raise AttributeError(attr)
+        return getattr(self.replay_buffer, attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, obs_t, action, reward, obs_tp1, done):
+        """
+        add a new transition to the buffer
+
+        :param obs_t: (Any) the last observation
+        :param action: ([float]) the action
+        :param reward: (float) the reward of the transition
+        :param obs_tp1: (Any) the current observation
+        :param done: (bool) is the episode done
+        """
+        with self._lock:
+            self.replay_buffer.add(obs_t, action, reward, obs_tp1, done)
+
+    def extend(self, obs_t, action, reward, obs_tp1, done):
+        """
+        add a batch of transitions to the buffer
+
+        :param obs_t: (np.ndarray) the last observations
+        :param action: (np.ndarray) the actions
+        :param reward: (np.ndarray) the rewards of the transitions
+        :param obs_tp1: (np.ndarray) the current observations
+        :param done: (np.ndarray) whether the episodes are done
+        """
+        with self._lock:
+            self.replay_buffer.extend(obs_t, action, reward, obs_tp1, done)
+
+    def sample(self, batch_size, **kwargs):
+        """
+        Sample a batch of experiences, prefetched if it has the size of the prefetched minibatches.
+
+        :param batch_size: (int) How many transitions to sample.
+        :param kwargs: extra arguments of the `sample` method of the replay buffer (sampled synchronously)
+        :return: (tuple) the batch, as returned by the replay buffer
+        """
+        if batch_size != self.batch_size or kwargs:
+            with self._lock:
+                return self.replay_buffer.sample(batch_size, **kwargs)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="replay-prefetch", daemon=True)
+            self._thread.start()
+        batch = self._queue.get()
+        if isinstance(batch, Exception):
+            # Raised by the sampling thread
+            self.close()
+            raise batch
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self._lock:
+                    batch = self.replay_buffer.sample(self.batch_size, rng=self._rng)
+            except Exception as error:  # pylint: disable=broad-except
+                batch = error
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(batch, Exception):
+                return
+
+    def close(self):
+        """
+        Stop the sampling thread and drop the prefetched minibatches
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._stop.clear()
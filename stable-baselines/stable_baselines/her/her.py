@@ -18,10 +18,14 @@ class HER(BaseRLModel):
         currently supported: DQN, DDPG, SAC
     :param n_sampled_goal: (int)
     :param goal_selection_strategy: (GoalSelectionStrategy or str)
+    :param lazy_relabelling: (bool) Store each real transition once and substitute the goals when sampling,
+        instead of storing n_sampled_goal artificial transitions per real transition
+    :param vectorized_reward: (bool) Compute the rewards of the relabelled goals in a single call to the
+        `compute_reward` method of the env, which must accept batches of goals (see HindsightExperienceReplayWrapper)
     """
 
     def __init__(self, policy, env, model_class, n_sampled_goal=4,
-                 goal_selection_strategy='future', *args, **kwargs):
+                 goal_selection_strategy='future', *args, lazy_relabelling=False, vectorized_reward=False, **kwargs):
 
         assert not isinstance(env, VecEnvWrapper), "HER does not support VecEnvWrapper"
 
@@ -42,6 +46,8 @@ class HER(BaseRLModel):
 
         self.n_sampled_goal = n_sampled_goal
         self.goal_selection_strategy = goal_selection_strategy
+        self.lazy_relabelling = lazy_relabelling
+        self.vectorized_reward = vectorized_reward
 
         if self.env is not None:
             self._create_replay_wrapper(self.env)
@@ -69,7 +75,9 @@ class HER(BaseRLModel):
         self.replay_wrapper = functools.partial(HindsightExperienceReplayWrapper,
                                                 n_sampled_goal=self.n_sampled_goal,
                                                 goal_selection_strategy=self.goal_selection_strategy,
-                                                wrapped_env=self.env)
+                                                wrapped_env=self.env,
+                                                lazy_relabelling=self.lazy_relabelling,
+                                                vectorized_reward=self.vectorized_reward)
 
     def set_env(self, env):
         assert not isinstance(env, VecEnvWrapper), "HER does not support VecEnvWrapper"
@@ -135,6 +143,8 @@ class HER(BaseRLModel):
         # it will not work with VecEnv
         data['n_sampled_goal'] = self.n_sampled_goal
         data['goal_selection_strategy'] = self.goal_selection_strategy
+        data['lazy_relabelling'] = self.lazy_relabelling
+        data['vectorized_reward'] = self.vectorized_reward
         data['model_class'] = self.model_class
         data['her_obs_space'] = self.observation_space
         data['her_action_space'] = self.action_space
@@ -155,6 +165,8 @@ class HER(BaseRLModel):
         model = cls(policy=data["policy"], env=env, model_class=data['model_class'],
                     n_sampled_goal=data['n_sampled_goal'],
                     goal_selection_strategy=data['goal_selection_strategy'],
+                    lazy_relabelling=data.get('lazy_relabelling', False),
+                    vectorized_reward=data.get('vectorized_reward', False),
                     _init_setup_model=False)
         model.__dict__['observation_space'] = data['her_obs_space']
         model.__dict__['action_space'] = data['her_action_space']
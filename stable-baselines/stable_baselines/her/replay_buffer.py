@@ -1,8 +1,9 @@
-import copy
 from enum import Enum
 
 import numpy as np
 
+from stable_baselines.deepq.replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, NStepReplayBuffer
+
 
 class GoalSelectionStrategy(Enum):
     """
@@ -44,21 +45,56 @@ class HindsightExperienceReplayWrapper(object):
         the goals for the artificial transitions.
     :param wrapped_env: (HERGoalEnvWrapper) the GoalEnv wrapped using HERGoalEnvWrapper,
         that enables to convert observation to dict, and vice versa
+    :param lazy_relabelling: (bool) Only store the real transitions, and substitute the goals when sampling:
+        a sampled transition is relabelled with probability n_sampled_goal / (n_sampled_goal + 1), the proportion of
+        artificial transitions otherwise stored. Requires a (non-prioritized) ReplayBuffer.
+    :param vectorized_reward: (bool) Compute the rewards of a batch of goals in a single call to the
+        `compute_reward` method of the env, which must then accept batches of goals and return one reward per goal
     """
 
-    def __init__(self, replay_buffer, n_sampled_goal, goal_selection_strategy, wrapped_env):
+    def __init__(self, replay_buffer, n_sampled_goal, goal_selection_strategy, wrapped_env, lazy_relabelling=False,
+                 vectorized_reward=False):
         super(HindsightExperienceReplayWrapper, self).__init__()
 
         assert isinstance(goal_selection_strategy, GoalSelectionStrategy), "Invalid goal selection strategy," \
                                                                            "please use one of {}".format(
             list(GoalSelectionStrategy))
 
+        previous_wrapper = None
+        if isinstance(replay_buffer, HindsightExperienceReplayWrapper):
+            # Wrapped again by a new call to `learn`: wrap the same replay buffer, instead of relabelling twice
+            previous_wrapper, replay_buffer = replay_buffer, replay_buffer.replay_buffer
+
+        assert not isinstance(replay_buffer, NStepReplayBuffer), "n-step returns are not supported by HER"
+
         self.n_sampled_goal = n_sampled_goal
         self.goal_selection_strategy = goal_selection_strategy
         self.env = wrapped_env
         # Buffer for storing transitions of the current episode
         self.episode_transitions = []
         self.replay_buffer = replay_buffer
+        self.vectorized_reward = vectorized_reward
+        self.lazy_relabelling = lazy_relabelling
+        if lazy_relabelling:
+            assert isinstance(replay_buffer, ReplayBuffer) and not isinstance(replay_buffer, PrioritizedReplayBuffer), \
+                "Lazy relabelling requires a ReplayBuffer"
+            if previous_wrapper is not None and previous_wrapper.lazy_relabelling:
+                self._n_added = previous_wrapper._n_added
+                self._episode_starts = previous_wrapper._episode_starts
+                self._episode_ends = previous_wrapper._episode_ends
+            else:
+                # Number of transitions added so far, and the episode of each stored transition,
+                # as the range [start, end) of the numbers of its transitions.
+                # Transitions already in the buffer are considered as one-step episodes.
+                n_stored = len(replay_buffer)
+                self._n_added = replay_buffer.ordered_idxes()[-1] + 1 if n_stored > 0 else 0
+                if replay_buffer.is_full():
+                    self._n_added += replay_buffer.buffer_size
+                numbers = self._n_added - n_stored + np.arange(n_stored)
+                self._episode_starts = np.zeros(replay_buffer.buffer_size, dtype=np.int64)
+                self._episode_ends = np.zeros(replay_buffer.buffer_size, dtype=np.int64)
+                self._episode_starts[numbers % replay_buffer.buffer_size] = numbers
+                self._episode_ends[numbers % replay_buffer.buffer_size] = numbers + 1
 
     def add(self, obs_t, action, reward, obs_tp1, done):
         """
@@ -75,11 +111,16 @@ class HindsightExperienceReplayWrapper(object):
         self.episode_transitions.append((obs_t, action, reward, obs_tp1, done))
         if done:
             # Add transitions (and imagined ones) to buffer only when an episode is over
-            self._store_episode()
+            if self.lazy_relabelling:
+                self._store_real_episode()
+            else:
+                self._store_episode()
             # Reset episode buffer
             self.episode_transitions = []
 
     def sample(self, *args, **kwargs):
+        if self.lazy_relabelling:
+            return self._sample_relabelled(*args, **kwargs)
         return self.replay_buffer.sample(*args, **kwargs)
 
     def can_sample(self, n_samples):
@@ -95,47 +136,77 @@ class HindsightExperienceReplayWrapper(object):
     def __len__(self):
         return len(self.replay_buffer)
 
+    def _goal_slices(self):
+        """
+        The slices of the achieved and desired goals in the (concatenated) observations
 
-    def _sample_achieved_goal(self, episode_transitions, transition_idx):
+        :return: (slice, slice) achieved goal slice, desired goal slice
         """
-        Sample an achieved goal according to the sampling strategy.
+        obs_dim, goal_dim = self.env.obs_dim, self.env.goal_dim
+        return slice(obs_dim, obs_dim + goal_dim), slice(obs_dim + goal_dim, None)
 
-        :param episode_transitions: ([tuple]) a list of all the transitions in the current episode
-        :param transition_idx: (int) the transition to start sampling from
-        :return: (np.ndarray) an achieved goal
+    def _sample_goal_obs(self, observations, n_relabelled):
         """
+        Sample the observations whose achieved goals are used as new goals, according to the sampling strategy.
+
+        :param observations: (np.ndarray) the observations of the current episode
+        :param n_relabelled: (int) the number of transitions (from the start of the episode) to relabel
+        :return: (np.ndarray) the sampled observations, of shape (n_relabelled, n_sampled_goal, obs_size)
+        """
+        n_transitions = len(observations)
+        shape = (n_relabelled, self.n_sampled_goal)
         if self.goal_selection_strategy == GoalSelectionStrategy.FUTURE:
             # Sample a goal that was observed in the same episode after the current step
-            selected_idx = np.random.choice(np.arange(transition_idx + 1, len(episode_transitions)))
-            selected_transition = episode_transitions[selected_idx]
+            transition_idx = np.arange(n_relabelled)[:, None]
+            n_future = n_transitions - 1 - transition_idx
+            selected_idx = transition_idx + 1 + (np.random.random(shape) * n_future).astype(np.int64)
         elif self.goal_selection_strategy == GoalSelectionStrategy.FINAL:
             # Choose the goal achieved at the end of the episode
-            selected_transition = episode_transitions[-1]
+            selected_idx = np.full(shape, n_transitions - 1)
         elif self.goal_selection_strategy == GoalSelectionStrategy.EPISODE:
             # Random goal achieved during the episode
-            selected_idx = np.random.choice(np.arange(len(episode_transitions)))
-            selected_transition = episode_transitions[selected_idx]
+            selected_idx = np.random.randint(0, n_transitions, size=shape)
         elif self.goal_selection_strategy == GoalSelectionStrategy.RANDOM:
-            # Random goal achieved, from the entire replay buffer
-            selected_idx = np.random.choice(np.arange(len(self.replay_buffer)))
-            selected_transition = self.replay_buffer.storage[selected_idx]
+            # Random goal achieved, from the entire replay buffer and the current episode
+            n_stored = len(self.replay_buffer)
+            selected_idx = np.random.randint(0, n_stored + n_transitions, size=shape)
+            in_buffer = selected_idx < n_stored
+            selected_obs = observations[np.maximum(selected_idx - n_stored, 0)]
+            if np.any(in_buffer):
+                selected_obs[in_buffer] = self._stored_observations(selected_idx[in_buffer])
+            return selected_obs
         else:
             raise ValueError("Invalid goal selection strategy,"
                              "please use one of {}".format(list(GoalSelectionStrategy)))
-        return self.env.convert_obs_to_dict(selected_transition[0])['achieved_goal']
+        return observations[selected_idx]
 
-    def _sample_achieved_goals(self, episode_transitions, transition_idx):
+    def _stored_observations(self, idxes):
         """
-        Sample a batch of achieved goals according to the sampling strategy.
+        Gather the observations of transitions of the replay buffer
 
-        :param episode_transitions: ([tuple]) list of the transitions in the current episode
-        :param transition_idx: (int) the transition to start sampling from
-        :return: (np.ndarray) an achieved goal
+        :param idxes: (np.ndarray) the indexes of the transitions
+        :return: (np.ndarray) the observations
         """
-        return [
-            self._sample_achieved_goal(episode_transitions, transition_idx)
-            for _ in range(self.n_sampled_goal)
-        ]
+        if isinstance(self.replay_buffer, ReplayBuffer):
+            return self.replay_buffer.storage[idxes][0]
+        return np.array([self.replay_buffer.storage[idx][0] for idx in idxes])
+
+    def _compute_rewards(self, goals, achieved_goals):
+        """
+        Compute the rewards of a batch of new goals, with a single call to `compute_reward` if `vectorized_reward`.
+
+        :param goals: (np.ndarray) the new desired goals
+        :param achieved_goals: (np.ndarray) the goals achieved in the next observations
+        :return: (np.ndarray) the rewards
+        """
+        if not self.vectorized_reward or len(goals) == 0:
+            return np.array([self.env.compute_reward(goal, achieved_goal, None)
+                             for goal, achieved_goal in zip(goals, achieved_goals)])
+        rewards = np.asarray(self.env.compute_reward(goals, achieved_goals, None))
+        if rewards.shape != (len(goals),):
+            raise ValueError("compute_reward returned rewards of shape {} for {} goals, it must return one reward "
+                             "per goal with vectorized_reward".format(rewards.shape, len(goals)))
+        return rewards
 
     def _store_episode(self):
         """
@@ -143,42 +214,103 @@ class HindsightExperienceReplayWrapper(object):
         episode in the replay buffer.
         This method is called only after each end of episode.
         """
-        # For each transition in the last episode,
-        # create a set of artificial transitions
-        for transition_idx, transition in enumerate(self.episode_transitions):
-
-            obs_t, action, reward, obs_tp1, done = transition
+        obs_t, actions, rewards, obs_tp1, dones = (np.array(field) for field in zip(*self.episode_transitions))
+        n_transitions = len(obs_t)
+        # We cannot sample a goal from the future in the last step of an episode
+        if self.goal_selection_strategy == GoalSelectionStrategy.FUTURE:
+            n_relabelled = n_transitions - 1
+        else:
+            n_relabelled = n_transitions
+        achieved_slice, desired_slice = self._goal_slices()
+
+        # Sampled n goals per transition, where n is `n_sampled_goal`
+        # this is called k in the paper
+        goals = self._sample_goal_obs(obs_t, n_relabelled)[..., achieved_slice]
+
+        # Artificial transitions, of shape (n_relabelled, n_sampled_goal, ...), with the sampled desired goals
+        def relabel(array):
+            return np.repeat(array[:n_relabelled, None], self.n_sampled_goal, axis=1)
+
+        new_obs_t, new_actions, new_obs_tp1 = map(relabel, (obs_t, actions, obs_tp1))
+        new_obs_t[..., desired_slice] = goals
+        new_obs_tp1[..., desired_slice] = goals
+        # Update the reward according to the new desired goal
+        new_rewards = self._compute_rewards(goals.reshape((-1,) + goals.shape[2:]),
+                                            new_obs_tp1[..., achieved_slice].reshape((-1,) + goals.shape[2:]))
+        new_rewards = new_rewards.reshape(n_relabelled, self.n_sampled_goal)
+        # Can we use achieved_goal == desired_goal?
+        new_dones = np.zeros((n_relabelled, self.n_sampled_goal))
+
+        # Each real transition is followed by its artificial transitions, the same order as adding them one by one
+        batch = []
+        for real, artificial in zip((obs_t, actions, rewards, obs_tp1, dones),
+                                    (new_obs_t, new_actions, new_rewards, new_obs_tp1, new_dones)):
+            interleaved = np.concatenate([real[:n_relabelled, None], artificial.astype(real.dtype)], axis=1)
+            batch.append(np.concatenate([interleaved.reshape((-1,) + real.shape[1:]), real[n_relabelled:]]))
+
+        if hasattr(self.replay_buffer, 'extend'):
+            self.replay_buffer.extend(*batch)
+        else:
+            for transition in zip(*batch):
+                self.replay_buffer.add(*transition)
 
-            # Add to the replay buffer
-            self.replay_buffer.add(obs_t, action, reward, obs_tp1, done)
+    def _store_real_episode(self):
+        """
+        Store the real transitions of the current episode in the replay buffer, and the range of the episode.
+        This method is called only after each end of episode, with lazy relabelling.
+        """
+        n_transitions = len(self.episode_transitions)
+        buffer_size = self.replay_buffer.buffer_size
+        idxes = (self._n_added + np.arange(n_transitions)) % buffer_size
+        self._episode_starts[idxes] = self._n_added
+        self._episode_ends[idxes] = self._n_added + n_transitions
+        self.replay_buffer.extend(*(np.array(field) for field in zip(*self.episode_transitions)))
+        self._n_added += n_transitions
+
+    def _sample_relabelled(self, batch_size, rng=None, **_kwargs):
+        """
+        Sample a batch of real transitions, and substitute the goals of some of them according to the
+        sampling strategy.
 
+        :param batch_size: (int) How many transitions to sample.
+        :param rng: (np.random.RandomState) the random generator to sample with, the global one if None
+        :return: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) obs_batch, act_batch, rew_batch,
+            next_obs_batch, done_mask
+        """
+        buffer_size = self.replay_buffer.buffer_size
+        n_stored = len(self.replay_buffer)
+        # Number of the oldest stored transition
+        oldest = self._n_added - n_stored
+        rng = np.random if rng is None else rng
+        numbers = oldest + rng.randint(0, n_stored, size=batch_size)
+        idxes = numbers % buffer_size
+        obs_t, actions, rewards, obs_tp1, dones = self.replay_buffer.storage[idxes]
+        starts, ends = self._episode_starts[idxes], self._episode_ends[idxes]
+
+        relabel = rng.random_sample(batch_size) < self.n_sampled_goal / (self.n_sampled_goal + 1)
+        uniform = rng.random_sample(batch_size)
+        if self.goal_selection_strategy == GoalSelectionStrategy.FUTURE:
             # We cannot sample a goal from the future in the last step of an episode
-            if (transition_idx == len(self.episode_transitions) - 1 and
-                    self.goal_selection_strategy == GoalSelectionStrategy.FUTURE):
-                break
-
-            # Sampled n goals per transition, where n is `n_sampled_goal`
-            # this is called k in the paper
-            sampled_goals = self._sample_achieved_goals(self.episode_transitions, transition_idx)
-            # For each sampled goals, store a new transition
-            for goal in sampled_goals:
-                # Copy transition to avoid modifying the original one
-                obs, action, reward, next_obs, done = copy.deepcopy(transition)
-
-                # Convert concatenated obs to dict, so we can update the goals
-                obs_dict, next_obs_dict = map(self.env.convert_obs_to_dict, (obs, next_obs))
-
-                # Update the desired goal in the transition
-                obs_dict['desired_goal'] = goal
-                next_obs_dict['desired_goal'] = goal
-
-                # Update the reward according to the new desired goal
-                reward = self.env.compute_reward(goal, next_obs_dict['achieved_goal'], None)
-                # Can we use achieved_goal == desired_goal?
-                done = False
-
-                # Transform back to ndarrays
-                obs, next_obs = map(self.env.convert_dict_to_obs, (obs_dict, next_obs_dict))
-
-                # Add artificial transition to the replay buffer
-                self.replay_buffer.add(obs, action, reward, next_obs, done)
+            relabel &= numbers < ends - 1
+            goal_numbers = numbers + 1 + (uniform * (ends - 1 - numbers)).astype(np.int64)
+        elif self.goal_selection_strategy == GoalSelectionStrategy.FINAL:
+            goal_numbers = ends - 1
+        elif self.goal_selection_strategy == GoalSelectionStrategy.EPISODE:
+            # The beginning of the episode may have been overwritten
+            starts = np.maximum(starts, oldest)
+            goal_numbers = starts + (uniform * (ends - starts)).astype(np.int64)
+        elif self.goal_selection_strategy == GoalSelectionStrategy.RANDOM:
+            goal_numbers = oldest + rng.randint(0, n_stored, size=batch_size)
+        else:
+            raise ValueError("Invalid goal selection strategy,"
+                             "please use one of {}".format(list(GoalSelectionStrategy)))
+        if not np.any(relabel):
+            return obs_t, actions, rewards, obs_tp1, dones
+
+        achieved_slice, desired_slice = self._goal_slices()
+        goals = self.replay_buffer.storage[goal_numbers[relabel] % buffer_size][0][:, achieved_slice]
+        obs_t[relabel, desired_slice] = goals
+        obs_tp1[relabel, desired_slice] = goals
+        rewards[relabel] = self._compute_rewards(goals, obs_tp1[relabel, achieved_slice])
+        dones[relabel] = False
+        return obs_t, actions, rewards, obs_tp1, dones
@@ -2,13 +2,19 @@ import os
 import sys
 import shutil
 import json
+import csv
 import time
 import datetime
 import tempfile
+import threading
 import warnings
+import atexit
+import queue
+import weakref
 from collections import defaultdict
 from typing import Optional
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.python import pywrap_tensorflow
 from tensorflow.core.util import event_pb2
@@ -23,6 +29,9 @@ ERROR = 40
 
 DISABLED = 50
 
+# Percentiles of the histograms written at each dump
+HISTOGRAM_PERCENTILES = (50, 90, 99)
+
 
 class KVWriter(object):
     """
@@ -36,6 +45,15 @@ class KVWriter(object):
         """
         raise NotImplementedError
 
+    def writehistograms(self, histograms):
+        """
+        write the histograms of a dump, called before writekvs. By default only their percentiles are written,
+        as key values
+
+        :param histograms: ({str: StreamingHistogram}) the histograms, by key
+        """
+        pass
+
 
 class SeqWriter(object):
     """
@@ -148,48 +166,80 @@ class JSONOutputFormat(KVWriter):
         self.file.close()
 
 
+# The csv logs being written, closed (so that their header is updated) at exit
+_CSV_OUTPUTS = weakref.WeakSet()
+
+
 class CSVOutputFormat(KVWriter):
-    def __init__(self, filename):
+    # Extension of the file holding the keys, once new keys appeared after the header was written
+    KEYS_EXT = ".keys"
+
+    def __init__(self, filename, flush_interval=1.0):
         """
         log to a file, in a CSV format
 
+        The file is only appended to: the header is written with the first row, and the keys that appear later are
+        added (in alphabetical order) at the end of the next rows. Each time the keys change, the full list of keys
+        is appended as a line to a ``<filename>.keys`` file, whose last line is used by ``read_csv``. The header is
+        updated (and the keys file removed) when the logger is closed, or at exit.
+
         :param filename: (str) the file to write the log to
+        :param flush_interval: (float) the rows are flushed to the file at most every flush_interval seconds
+            (the first row is flushed at once)
         """
-        self.file = open(filename, 'w+t')
+        self.filename = filename
+        self.file = open(filename, 'wt', newline='')
+        self.writer = csv.writer(self.file, lineterminator='\n')
         self.keys = []
-        self.sep = ','
+        self.flush_interval = flush_interval
+        self._last_flush = None
+        self._header_keys = None
+        self._keys_file = None
+        _CSV_OUTPUTS.add(self)
 
     def writekvs(self, kvs):
         # Add our current row to the history
-        extra_keys = kvs.keys() - self.keys
-        if extra_keys:
-            self.keys.extend(extra_keys)
-            self.file.seek(0)
-            lines = self.file.readlines()
-            self.file.seek(0)
-            for (i, key) in enumerate(self.keys):
-                if i > 0:
-                    self.file.write(',')
-                self.file.write(key)
-            self.file.write('\n')
-            for line in lines[1:]:
-                self.file.write(line[:-1])
-                self.file.write(self.sep * len(extra_keys))
-                self.file.write('\n')
-        for i, key in enumerate(self.keys):
-            if i > 0:
-                self.file.write(',')
-            value = kvs.get(key)
-            if value is not None:
-                self.file.write(str(value))
-        self.file.write('\n')
-        self.file.flush()
+        extra_keys = sorted(kvs.keys() - self.keys)
+        self.keys.extend(extra_keys)
+        if self._header_keys is None:
+            self._header_keys = list(self.keys)
+            self.writer.writerow(self.keys)
+        elif extra_keys:
+            # Flush the previous rows, so that the keys file never describes rows that are not written
+            self.file.flush()
+            self._write_keys()
+        self.writer.writerow(['' if kvs.get(key) is None else str(kvs.get(key)) for key in self.keys])
+        if self._last_flush is None or time.time() - self._last_flush >= self.flush_interval:
+            self.file.flush()
+            self._last_flush = time.time()
+
+    def _write_keys(self):
+        """
+        Append all the keys to the keys file
+        """
+        if self._keys_file is None:
+            self._keys_file = open(self.filename + self.KEYS_EXT, 'wt', newline='')
+        csv.writer(self._keys_file, lineterminator='\n').writerow(self.keys)
+        self._keys_file.flush()
 
     def close(self):
         """
-        closes the file
+        closes the file, updating its header if new keys appeared
         """
         self.file.close()
+        if self._keys_file is not None:
+            # Single pass over the file: the new header followed by the rows
+            with open(self.filename, 'rt', newline='') as file_handler, \
+                    open(self.filename + ".tmp", 'wt', newline='') as new_file_handler:
+                file_handler.readline()
+                csv.writer(new_file_handler, lineterminator='\n').writerow(self.keys)
+                shutil.copyfileobj(file_handler, new_file_handler)
+            os.replace(self.filename + ".tmp", self.filename)
+            self._keys_file.close()
+            os.remove(self.filename + self.KEYS_EXT)
+            self._keys_file = None
+            self._header_keys = list(self.keys)
+        _CSV_OUTPUTS.discard(self)
 
 
 def summary_val(key, value):
@@ -228,9 +278,22 @@ class TensorBoardOutputFormat(KVWriter):
         prefix = 'events'
         path = os.path.join(os.path.abspath(folder), prefix)
         self.writer = pywrap_tensorflow.EventsWriter(compat.as_bytes(path))  # type: pywrap_tensorflow.EventsWriter
+        self.histograms = {}
+
+    def writehistograms(self, histograms):
+        # Written in the same event as the key values
+        self.histograms = histograms
 
     def writekvs(self, kvs):
-        summary = tf.Summary(value=[summary_val(k, v) for k, v in kvs.items() if valid_float_value(v)])
+        values = [summary_val(k, v) for k, v in kvs.items() if valid_float_value(v)]
+        for key, histogram in self.histograms.items():
+            _, bucket_limit, bucket = histogram.buckets()
+            histo = tf.HistogramProto(min=histogram.min, max=histogram.max, num=histogram.count, sum=histogram.sum,
+                                      sum_squares=histogram.sum_squares, bucket_limit=bucket_limit.tolist(),
+                                      bucket=bucket.tolist())
+            values.append(tf.Summary.Value(tag=key, histo=histo))
+        self.histograms = {}
+        summary = tf.Summary(value=values)
         event = event_pb2.Event(wall_time=time.time(), summary=summary)
         event.step = self.step  # is there any reason why you'd want to specify the step?
         if self.writer is None:
@@ -308,6 +371,37 @@ def logkvs(key_values):
         logkv(key, value)
 
 
+def counter(key, value=1):
+    """
+    Increment a counter. Unlike logkv, the counters are not cleared by dumpkvs: their total is written at each dump.
+
+    :param key: (Any) the counter key
+    :param value: (Number) the increment
+    """
+    Logger.CURRENT.counter(key, value)
+
+
+def gauge(key, value):
+    """
+    Set a gauge. Unlike logkv, the gauges are not cleared by dumpkvs: their last value is written at each dump.
+
+    :param key: (Any) the gauge key
+    :param value: (Number) the value
+    """
+    Logger.CURRENT.gauge(key, value)
+
+
+def histogram(key, values):
+    """
+    Add values to the histogram of a key, until the next dumpkvs. The dump writes the percentiles of the values
+    (key + "/p50", "/p90" and "/p99") and, in TensorBoard, the histogram itself.
+
+    :param key: (Any) the histogram key
+    :param values: (float or np.ndarray) a value, or an array of values
+    """
+    Logger.CURRENT.histogram(key, values)
+
+
 def dumpkvs():
     """
     Write all of the diagnostics from the current iteration
@@ -450,6 +544,233 @@ def profile(name):
     return decorator_with_name
 
 
+class _NullProfileScope:
+    """
+    Context manager that does nothing, returned by a disabled Profiler
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, _type, value, traceback):
+        pass
+
+
+_NULL_PROFILE_SCOPE = _NullProfileScope()
+
+
+class _ProfileScope:
+    def __init__(self, profiler, name):
+        """
+        Time a scope and record it in a Profiler
+
+        :param profiler: (Profiler) the profiler to record to
+        :param name: (str) the profiling name
+        """
+        self.profiler = profiler
+        self.name = name
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, _type, value, traceback):
+        self.profiler.record(self.name, self.start_time, time.perf_counter())
+
+
+# The enabled profilers, whose timings are written by the dumps
+_PROFILERS = weakref.WeakSet()
+
+
+class Profiler:
+    def __init__(self, enabled=True, trace_path=None, histograms=False):
+        """
+        Time named scopes, like ProfileKV, and optionally export them as a Chrome trace.
+        The time spent in a scope is accumulated in the profiler, and written under "time_" + name
+        by the next dumpkvs. When disabled, scopes are a shared no-op context manager.
+
+        Usage:
+        profiler = logger.Profiler(trace_path="trace.json")
+        with profiler("interesting_scope"):
+            code
+        profiler.close()
+
+        :param enabled: (bool) whether to time the scopes
+        :param trace_path: (str) if not None, write every timed scope to this file,
+            in the Chrome trace event format (open it with chrome://tracing)
+        :param histograms: (bool) also add the durations of the scopes to the "time_" + name histograms of the
+            current logger, to log their percentiles (e.g. the tail latency of the environment steps)
+        """
+        self.enabled = enabled
+        self.histograms = histograms
+        self.trace_file = None
+        self._totals = defaultdict(float)  # time spent in the scopes since the last dump
+        self._n_events = 0
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        if enabled:
+            _PROFILERS.add(self)
+        if enabled and trace_path is not None:
+            self.trace_file = open(trace_path, 'wt')
+            self.trace_file.write('[')
+
+    def __call__(self, name):
+        """
+        :param name: (str) the profiling name
+        :return: (context manager) timing the scope if the profiler is enabled
+        """
+        if not self.enabled:
+            return _NULL_PROFILE_SCOPE
+        return _ProfileScope(self, name)
+
+    def record(self, name, start_time, end_time):
+        """
+        Record a timed scope
+
+        :param name: (str) the profiling name
+        :param start_time: (float) the start of the scope, from time.perf_counter()
+        :param end_time: (float) the end of the scope, from time.perf_counter()
+        """
+        # scopes can be timed from several threads (e.g. a background rollout)
+        with self._lock:
+            self._totals["time_" + name] += end_time - start_time
+            if self.trace_file is not None:
+                event = {"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                         "ts": (start_time - self._origin) * 1e6, "dur": (end_time - start_time) * 1e6}
+                self.trace_file.write((',\n' if self._n_events > 0 else '\n') + json.dumps(event))
+                self._n_events += 1
+        # Outside of the profiler lock, which the dumps take while holding the logger's
+        if self.histograms:
+            Logger.CURRENT.histogram("time_" + name, end_time - start_time)
+
+    def pop_totals(self):
+        """
+        Return the time spent in the scopes since the last call, and reset it
+
+        :return: ({str: float}) the time spent in each scope, by "time_" + name
+        """
+        with self._lock:
+            totals, self._totals = self._totals, defaultdict(float)
+        return totals
+
+    def close(self):
+        """
+        closes the trace file
+        """
+        with self._lock:
+            if self.trace_file is not None:
+                self.trace_file.write('\n]\n')
+                self.trace_file.close()
+                self.trace_file = None
+
+
+class StreamingHistogram(object):
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048, buffer_size=1024):
+        """
+        Histogram of a stream of values in a fixed memory. The absolute values are counted in logarithmic buckets
+        (as in DDSketch), so that the quantiles are within relative_accuracy of the exact ones. If more than
+        max_buckets buckets (per sign) are needed, the buckets of the smallest absolute values are merged.
+        Single values are buffered, and counted buffer_size at a time.
+
+        :param relative_accuracy: (float) the relative accuracy of the quantiles
+        :param max_buckets: (int) the maximum number of buckets of the positive, and of the negative values
+        :param buffer_size: (int) the number of buffered values that triggers their counting
+        """
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self._gamma)
+        # Counts of the buckets (gamma^(i-1), gamma^i] of the absolute values, by i
+        self._positive = {}
+        self._negative = {}
+        self.n_zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        """
+        Count values
+
+        :param values: (float or np.ndarray) a value, or an array of values
+        """
+        if np.ndim(values) == 0:
+            self._buffer.append(values)
+            if len(self._buffer) >= self.buffer_size:
+                self._add_buffer()
+            return
+        self._add(np.asarray(values, dtype=np.float64).ravel())
+
+    def _add_buffer(self):
+        """
+        Count the buffered values
+        """
+        values, self._buffer = self._buffer, []
+        self._add(np.array(values, dtype=np.float64))
+
+    def _add(self, values):
+        """
+        :param values: (np.ndarray) the values to count, a flat array
+        """
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.sum += float(np.sum(values))
+        self.sum_squares += float(np.dot(values, values))
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+        self.n_zeros += int(np.count_nonzero(values == 0))
+        for buckets, sign_values in ((self._positive, values[values > 0]), (self._negative, -values[values < 0])):
+            if len(sign_values) == 0:
+                continue
+            idxes, counts = np.unique(np.ceil(np.log(sign_values) / self._log_gamma).astype(np.int64),
+                                      return_counts=True)
+            for idx, count in zip(idxes.tolist(), counts.tolist()):
+                buckets[idx] = buckets.get(idx, 0) + count
+            if len(buckets) > self.max_buckets:
+                # Merge the buckets of the smallest absolute values
+                idxes = sorted(buckets)
+                n_merged = len(idxes) - self.max_buckets + 1
+                buckets[idxes[n_merged - 1]] = sum(buckets.pop(idx) for idx in idxes[:n_merged])
+
+    def buckets(self):
+        """
+        The buckets of the values, in increasing order
+
+        :return: (np.ndarray, np.ndarray, np.ndarray) the lower and upper limits of the buckets, and their counts
+        """
+        self._add_buffer()
+        negative_idxes = np.array(sorted(self._negative, reverse=True), dtype=np.int64)
+        positive_idxes = np.array(sorted(self._positive), dtype=np.int64)
+        lower = np.concatenate((-self._gamma ** negative_idxes, [0.0] * (self.n_zeros > 0),
+                                self._gamma ** (positive_idxes - 1)))
+        upper = np.concatenate((-self._gamma ** (negative_idxes - 1), [0.0] * (self.n_zeros > 0),
+                                self._gamma ** positive_idxes))
+        counts = np.array([self._negative[idx] for idx in negative_idxes.tolist()] + [self.n_zeros] * (self.n_zeros > 0)
+                          + [self._positive[idx] for idx in positive_idxes.tolist()], dtype=np.int64)
+        return lower, upper, counts
+
+    def percentiles(self, percentiles):
+        """
+        Estimate percentiles of the values
+
+        :param percentiles: ([float]) the percentiles, between 0 and 100
+        :return: (np.ndarray) the estimated percentiles (nan if no value was added)
+        """
+        self._add_buffer()
+        if self.count == 0:
+            return np.full(len(percentiles), np.nan)
+        lower, upper, counts = self.buckets()
+        # Middle of the buckets in relative terms, the exact value for the zeros
+        values = 2 * np.where(np.abs(upper) > np.abs(lower), upper, lower) / (self._gamma + 1)
+        ranks = np.asarray(percentiles, dtype=np.float64) / 100 * (self.count - 1)
+        idxes = np.searchsorted(np.cumsum(counts), ranks, side='right')
+        return np.clip(values[np.minimum(idxes, len(values) - 1)], self.min, self.max)
+
+
 # ================================================================
 # Backend
 # ================================================================
@@ -461,18 +782,38 @@ class Logger(object):
     # Current logger being used by the free functions above
     CURRENT = None  # type: Optional["Logger"]
 
-    def __init__(self, folder, output_formats):
+    def __init__(self, folder, output_formats, async_queue_size=0, backpressure='block'):
         """
         the logger class
 
         :param folder: (str) the logging location
         :param output_formats: ([str]) the list of output format
+        :param async_queue_size: (int) if > 0, the dumps and log messages are put in a queue of this size, and
+            written to the output formats by a background thread. The queue is drained when the logger is flushed
+            or closed (e.g. by ``reset``, and at exit)
+        :param backpressure: (str) what to do when the queue is full: 'block' to wait for the writer thread, or
+            'drop' to drop the dump (the number of dropped dumps is counted in ``n_dropped``)
         """
+        assert backpressure in ('block', 'drop'), "Unknown backpressure policy {}".format(backpressure)
         self.name2val = defaultdict(float)  # values this iteration
         self.name2cnt = defaultdict(int)
+        self.counters = defaultdict(float)  # totals since the creation of the logger
+        self.gauges = {}  # last values
+        self.histograms = {}  # values this iteration
+        self._metrics_lock = threading.Lock()
         self.level = INFO
         self.dir = folder
         self.output_formats = output_formats
+        self.backpressure = backpressure
+        self.n_dropped = 0
+        self._queue = None
+        self._writer_thread = None
+        self._writer_error = None
+        if async_queue_size > 0:
+            self._queue = queue.Queue(maxsize=async_queue_size)
+            self._writer_thread = threading.Thread(target=self._write_queued, name="logger-writer", daemon=True)
+            self._writer_thread.start()
+            _ASYNC_LOGGERS.add(self)
 
     # Logging API, forwarded
     # ----------------------------------------
@@ -501,15 +842,61 @@ class Logger(object):
         self.name2val[key] = oldval * cnt / (cnt + 1) + val / (cnt + 1)
         self.name2cnt[key] = cnt + 1
 
+    def counter(self, key, value=1):
+        """
+        Increment a counter, whose total is written at each dump
+
+        :param key: (Any) the counter key
+        :param value: (Number) the increment
+        """
+        with self._metrics_lock:
+            self.counters[key] += value
+
+    def gauge(self, key, value):
+        """
+        Set a gauge, whose last value is written at each dump
+
+        :param key: (Any) the gauge key
+        :param value: (Number) the value
+        """
+        self.gauges[key] = value
+
+    def histogram(self, key, values):
+        """
+        Add values to the histogram of a key, whose percentiles are written at the next dump
+
+        :param key: (Any) the histogram key
+        :param values: (float or np.ndarray) a value, or an array of values
+        """
+        # values can be recorded from several threads (e.g. by a Profiler)
+        with self._metrics_lock:
+            if key not in self.histograms:
+                self.histograms[key] = StreamingHistogram()
+            self.histograms[key].add(values)
+
     def dumpkvs(self):
         """
         Write all of the diagnostics from the current iteration
         """
+        with self._metrics_lock:
+            histograms, self.histograms = self.histograms, {}
+            counters = dict(self.counters)
+            timings = [profiler.pop_totals() for profiler in list(_PROFILERS)]
         if self.level == DISABLED:
             return
-        for fmt in self.output_formats:
-            if isinstance(fmt, KVWriter):
-                fmt.writekvs(self.name2val)
+        kvs = dict(self.name2val)
+        for totals in timings:
+            for key, value in totals.items():
+                kvs[key] = kvs.get(key, 0.0) + value
+        kvs.update(counters)
+        kvs.update(self.gauges)
+        for key, hist in histograms.items():
+            for percentile, value in zip(HISTOGRAM_PERCENTILES, hist.percentiles(HISTOGRAM_PERCENTILES)):
+                kvs["{}/p{}".format(key, percentile)] = float(value)
+        if self._queue is None:
+            self._write_kvs(kvs, histograms)
+        else:
+            self._enqueue((self._write_kvs, (kvs, histograms)))
         self.name2val.clear()
         self.name2cnt.clear()
 
@@ -546,12 +933,27 @@ class Logger(object):
         """
         return self.dir
 
+    def flush(self):
+        """
+        Wait until the background writer thread has written all the queued dumps and log messages
+        """
+        if self._queue is not None:
+            self._queue.join()
+            self._raise_writer_error()
+
     def close(self):
         """
         closes the file
         """
+        if self._writer_thread is not None:
+            # Drain the queue, then stop the thread
+            self._queue.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+            _ASYNC_LOGGERS.discard(self)
         for fmt in self.output_formats:
             fmt.close()
+        self._raise_writer_error()
 
     # Misc
     # ----------------------------------------
@@ -561,21 +963,105 @@ class Logger(object):
 
         :param args: (list) the arguments to log
         """
+        if self._queue is None:
+            self._write_seq(args)
+        else:
+            # Through the queue too, to keep the order of the messages and the dumps
+            self._enqueue((self._write_seq, (args,)))
+
+    def _write_kvs(self, kvs, histograms):
+        """
+        :param kvs: (dict) the values to write to the key value output formats
+        :param histograms: ({str: StreamingHistogram}) the histograms to write to the key value output formats
+        """
+        for fmt in self.output_formats:
+            if isinstance(fmt, KVWriter):
+                if histograms:
+                    fmt.writehistograms(histograms)
+                fmt.writekvs(kvs)
+
+    def _write_seq(self, args):
+        """
+        :param args: (list) the arguments to write to the sequence output formats
+        """
         for fmt in self.output_formats:
             if isinstance(fmt, SeqWriter):
                 fmt.writeseq(map(str, args))
 
+    def _enqueue(self, item):
+        """
+        Queue a write for the background writer thread, following the backpressure policy if the queue is full
+
+        :param item: ((callable, tuple)) the write function and its arguments
+        """
+        self._raise_writer_error()
+        if self._writer_thread is None:
+            raise ValueError("Attempt to log after close().")
+        if self.backpressure == 'block':
+            self._queue.put(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if self.n_dropped == 0:
+                warnings.warn("The logger queue is full, dropping the dumps until the writer thread catches up")
+            self.n_dropped += 1
+
+    def _write_queued(self):
+        """
+        Background writer thread: write the queued items until the None sentinel
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._writer_error is None:
+                    write, args = item
+                    write(*args)
+            except Exception as error:
+                # Raised in the training thread by the next dump, flush or close
+                self._writer_error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise_writer_error(self):
+        """
+        Raise the error of the background writer thread, if any
+        """
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise error
+
 
 Logger.DEFAULT = Logger.CURRENT = Logger(folder=None, output_formats=[HumanOutputFormat(sys.stdout)])
 
+# The loggers with a background writer thread, drained and closed at exit
+_ASYNC_LOGGERS = weakref.WeakSet()
 
-def configure(folder=None, format_strs=None):
+
+@atexit.register
+def _close_at_exit():
+    for async_logger in list(_ASYNC_LOGGERS):
+        async_logger.close()
+    # Terminate the trace files of the profilers that were not closed
+    for profiler in list(_PROFILERS):
+        profiler.close()
+    # Update the header of the csv logs that were not closed
+    for csv_output in list(_CSV_OUTPUTS):
+        csv_output.close()
+
+
+def configure(folder=None, format_strs=None, async_queue_size=0, backpressure='block'):
     """
     configure the current logger
 
     :param folder: (str) the save location (if None, $OPENAI_LOGDIR, if still None, tempdir/openai-[date & time])
     :param format_strs: (list) the output logging format
         (if None, $OPENAI_LOG_FORMAT, if still None, ['stdout', 'log', 'csv'])
+    :param async_queue_size: (int) if > 0, write to the output formats in a background thread, through a queue of
+        this size (see Logger)
+    :param backpressure: (str) when the queue is full, 'block' to wait or 'drop' to drop the dump
     """
     if folder is None:
         folder = os.getenv('OPENAI_LOGDIR')
@@ -595,7 +1081,8 @@ def configure(folder=None, format_strs=None):
     format_strs = filter(None, format_strs)
     output_formats = [make_output_format(f, folder, log_suffix) for f in format_strs]
 
-    Logger.CURRENT = Logger(folder=folder, output_formats=output_formats)
+    Logger.CURRENT = Logger(folder=folder, output_formats=output_formats, async_queue_size=async_queue_size,
+                            backpressure=backpressure)
     log('Logging to %s' % folder)
 
 
@@ -610,7 +1097,7 @@ def reset():
 
 
 class ScopedConfigure(object):
-    def __init__(self, folder=None, format_strs=None):
+    def __init__(self, folder=None, format_strs=None, async_queue_size=0, backpressure='block'):
         """
         Class for using context manager while logging
 
@@ -620,14 +1107,20 @@ class ScopedConfigure(object):
 
         :param folder: (str) the logging folder
         :param format_strs: ([str]) the list of output logging format
+        :param async_queue_size: (int) if > 0, write to the output formats in a background thread, through a queue of
+            this size (see Logger)
+        :param backpressure: (str) when the queue is full, 'block' to wait or 'drop' to drop the dump
         """
         self.dir = folder
         self.format_strs = format_strs
+        self.async_queue_size = async_queue_size
+        self.backpressure = backpressure
         self.prevlogger = None
 
     def __enter__(self):
         self.prevlogger = Logger.CURRENT
-        configure(folder=self.dir, format_strs=self.format_strs)
+        configure(folder=self.dir, format_strs=self.format_strs, async_queue_size=self.async_queue_size,
+                  backpressure=self.backpressure)
 
     def __exit__(self, *args):
         Logger.CURRENT.close()
@@ -678,68 +1171,247 @@ def _demo():
 # Readers
 # ================================================================
 
-def read_json(fname):
+def read_json(fname, tags=None):
     """
     read a json file using pandas
 
     :param fname: (str) the file path to read
+    :param tags: ([str]) if not None, only read these keys
     :return: (pandas DataFrame) the data in the json
     """
     import pandas
-    data = []
-    with open(fname, 'rt') as file_handler:
-        for line in file_handler:
-            data.append(json.loads(line))
-    return pandas.DataFrame(data)
+    if os.path.getsize(fname) == 0:
+        return pandas.DataFrame()
+    # The keys are kept as they are, not parsed as dates
+    data = pandas.read_json(fname, lines=True, convert_dates=False)
+    if tags is not None:
+        data = data[[tag for tag in data.columns if tag in tags]]
+    return data
 
 
-def read_csv(fname):
+def read_csv(fname, tags=None):
     """
     read a csv file using pandas
 
     :param fname: (str) the file path to read
+    :param tags: ([str]) if not None, only read these keys
     :return: (pandas DataFrame) the data in the csv
     """
     import pandas
-    return pandas.read_csv(fname, index_col=None, comment='#')
-
-
-def read_tb(path):
+    usecols = None if tags is None else (lambda key: key in tags)
+    keys_fname = fname + CSVOutputFormat.KEYS_EXT
+    if os.path.exists(keys_fname):
+        # Log being written, whose keys changed after the header: the last line holds all the keys
+        with open(keys_fname, 'rt', newline='') as file_handler:
+            # The last element is empty, or a line being written
+            lines = file_handler.read().split('\n')[:-1]
+        if lines:
+            keys = next(csv.reader(lines[-1:]))
+            return pandas.read_csv(fname, index_col=None, comment='#', skiprows=1, header=None, names=keys,
+                                   usecols=usecols)
+    return pandas.read_csv(fname, index_col=None, comment='#', usecols=usecols)
+
+
+def _tb_files(path):
     """
-    read a tensorboard output
-
     :param path: (str) a tensorboard file OR a directory, where we will find all TB files of the form events.
-    :return: (pandas DataFrame) the tensorboad data
+    :return: ([str]) the tensorboard files
     """
-    import pandas
-    import numpy as np
     from glob import glob
-    # from collections import defaultdict
-    import tensorflow as tf
     if os.path.isdir(path):
-        fnames = glob(os.path.join(path, "events.*"))
+        return sorted(glob(os.path.join(path, "events.*")))
     elif os.path.basename(path).startswith("events."):
-        fnames = [path]
-    else:
-        raise NotImplementedError("Expected tensorboard file or directory containing them. Got %s" % path)
-    tag2pairs = defaultdict(list)
-    maxstep = 0
+        return [path]
+    raise NotImplementedError("Expected tensorboard file or directory containing them. Got %s" % path)
+
+
+def _read_tb_scalars(fnames, tags=None):
+    """
+    read the scalars of tensorboard files
+
+    :param fnames: ([str]) the tensorboard files
+    :param tags: ([str]) if not None, only read these tags
+    :return: ({str: (np.ndarray, np.ndarray)}) the steps and the values of each tag
+    """
+    tag2steps = defaultdict(list)
+    tag2values = defaultdict(list)
     for fname in fnames:
         for summary in tf.train.summary_iterator(fname):
             if summary.step > 0:
                 for value in summary.summary.value:
-                    pair = (summary.step, value.simple_value)
-                    tag2pairs[value.tag].append(pair)
-                maxstep = max(summary.step, maxstep)
-    data = np.empty((maxstep, len(tag2pairs)))
-    data[:] = np.nan
+                    # Skip the histograms and the tags that were not requested
+                    if value.HasField('simple_value') and (tags is None or value.tag in tags):
+                        tag2steps[value.tag].append(summary.step)
+                        tag2values[value.tag].append(value.simple_value)
+    return {tag: (np.array(tag2steps[tag], dtype=np.int64), np.array(tag2values[tag], dtype=np.float64))
+            for tag in tag2steps}
+
+
+def read_tb(path, tags=None):
+    """
+    read a tensorboard output
+
+    :param path: (str) a tensorboard file OR a directory, where we will find all TB files of the form events.
+    :param tags: ([str]) if not None, only read these tags
+    :return: (pandas DataFrame) the tensorboad data
+    """
+    import pandas
+    tag2pairs = _read_tb_scalars(_tb_files(path), tags)
+    maxstep = max((steps.max() for steps, _ in tag2pairs.values()), default=0)
     tags = sorted(tag2pairs.keys())
+    data = np.full((maxstep, len(tags)), np.nan)
     for (colidx, tag) in enumerate(tags):
-        pairs = tag2pairs[tag]
-        for (step, value) in pairs:
-            data[step - 1, colidx] = value
+        steps, values = tag2pairs[tag]
+        data[steps - 1, colidx] = values
     return pandas.DataFrame(data, columns=tags)
 
 
+# Extension of the caches of the logs read by read_logs, next to the logs
+LOG_CACHE_EXT = ".cache.npz"
+# Log files of a run directory, by format
+LOG_FILES = {'csv': 'progress.csv', 'json': 'progress.json', 'tensorboard': 'events.*'}
+
+
+def _read_numeric_log(fname):
+    """
+    read the numeric values of a log file
+
+    :param fname: (str) a csv, json or tensorboard log file
+    :return: ({str: (np.ndarray, np.ndarray)}) the steps (the dumps, from 1, for csv and json logs) and the
+        values of each key
+    """
+    import pandas
+    if os.path.basename(fname).startswith("events."):
+        return _read_tb_scalars([fname])
+    data = read_json(fname) if fname.endswith(".json") else read_csv(fname)
+    steps = np.arange(1, len(data) + 1, dtype=np.int64)
+    tag2pairs = {}
+    for tag in data.columns:
+        try:
+            values = pandas.to_numeric(data[tag], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        except TypeError:
+            # e.g. logged lists
+            continue
+        valid = ~np.isnan(values)
+        if valid.any():
+            tag2pairs[str(tag)] = (steps[valid], values[valid])
+    return tag2pairs
+
+
+def _read_log_long(fname, tags=None, cache=True):
+    """
+    read the numeric values of a log file in long format, through a cache (``<fname>.cache.npz``) which is rebuilt
+    when the log file changes
+
+    :param fname: (str) a csv, json or tensorboard log file
+    :param tags: ([str]) if not None, only return these keys
+    :param cache: (bool) use and update the cache
+    :return: ([str], np.ndarray, np.ndarray, np.ndarray) the keys of the log, and the key index, step and value
+        of each row
+    """
+    stat = os.stat(fname)
+    file_meta = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    cache_name = fname + LOG_CACHE_EXT
+    columns = None
+    if cache and os.path.exists(cache_name):
+        try:
+            with np.load(cache_name) as cache_file:
+                meta = json.loads(str(cache_file['meta']))
+                if meta['file'] == file_meta:
+                    all_tags = meta['tags']
+                    columns = [cache_file[name] for name in ('tag_idx', 'step', 'value')]
+        except (OSError, ValueError, KeyError):
+            # Unreadable cache, it is rebuilt
+            columns = None
+    if columns is None:
+        tag2pairs = _read_numeric_log(fname)
+        all_tags = sorted(tag2pairs.keys())
+        columns = [np.concatenate([np.full(len(tag2pairs[tag][0]), idx, dtype=np.int32)
+                                   for idx, tag in enumerate(all_tags)] + [np.zeros(0, dtype=np.int32)]),
+                   np.concatenate([tag2pairs[tag][0] for tag in all_tags] + [np.zeros(0, dtype=np.int64)]),
+                   np.concatenate([tag2pairs[tag][1] for tag in all_tags] + [np.zeros(0, dtype=np.float64)])]
+        if cache:
+            try:
+                # Write then rename, so that a concurrent read never reads a truncated cache
+                with open(cache_name + ".tmp", "wb") as file_handler:
+                    np.savez(file_handler, meta=json.dumps({"file": file_meta, "tags": all_tags}),
+                             tag_idx=columns[0], step=columns[1], value=columns[2])
+                os.replace(cache_name + ".tmp", cache_name)
+            except OSError:
+                # e.g. read-only log directory
+                pass
+    if tags is not None:
+        mask = np.isin(columns[0], [idx for idx, tag in enumerate(all_tags) if tag in tags])
+        columns = [column[mask] for column in columns]
+    return (all_tags,) + tuple(columns)
+
+
+def _read_run_logs(path, tags, log_format, cache):
+    """
+    :param path: (str) a run directory, or a log file
+    :param tags: ([str]) if not None, only read these keys
+    :param log_format: (str) the format of the logs of the run directories
+    :param cache: (bool) use and update the caches
+    :return: ([([str], np.ndarray, np.ndarray, np.ndarray)]) the logs of the run, in long format
+    """
+    from glob import glob
+    fnames = sorted(glob(os.path.join(path, LOG_FILES[log_format]))) if os.path.isdir(path) else [path]
+    return [_read_log_long(fname, tags, cache) for fname in fnames if not fname.endswith(LOG_CACHE_EXT)]
+
+
+def read_logs(paths, tags=None, log_format='csv', n_workers=None, cache=True, start_method=None):
+    """
+    read the logs of several runs (e.g. a sweep) on a process pool, in long format: one row per run, key and step.
+    Only the numeric values are read, and the parsed logs are cached next to them (``<log>.cache.npz``)
+    so that reading them again only loads arrays.
+
+    :param paths: ([str]) the run directories (or log files)
+    :param tags: ([str]) if not None, only read these keys
+    :param log_format: (str) the format of the logs in the run directories: 'csv' (progress.csv), 'json'
+        (progress.json) or 'tensorboard' (events.*)
+    :param n_workers: (int) the number of processes reading the logs, defaults to the number of CPUs.
+        The logs are read in this process if it is 1
+    :param cache: (bool) use and update the caches
+    :param start_method: (str) method used to start the processes, defaults to 'forkserver' on available
+        platforms, and 'spawn' otherwise (see SubprocVecEnv)
+    :return: (pandas DataFrame) the 'run' (the path), 'tag', 'step' (the tensorboard step, or the dump number
+        from 1 for csv and json logs) and 'value' of every logged value
+    """
+    import pandas
+    import multiprocessing
+    assert log_format in LOG_FILES, "Unknown log format {}".format(log_format)
+    paths = list(paths)
+    assert len(set(paths)) == len(paths), "The runs must be different paths"
+    args = [(path, tags, log_format, cache) for path in paths]
+    if n_workers is None:
+        n_workers = min(len(paths), multiprocessing.cpu_count())
+    if n_workers <= 1:
+        run_logs = [_read_run_logs(*run_args) for run_args in args]
+    else:
+        if start_method is None:
+            forkserver_available = 'forkserver' in multiprocessing.get_all_start_methods()
+            start_method = 'forkserver' if forkserver_available else 'spawn'
+        with multiprocessing.get_context(start_method).Pool(n_workers) as pool:
+            run_logs = pool.starmap(_read_run_logs, args)
+
+    # Concatenate the logs, with the codes of the runs and of the tags
+    all_tags = sorted({tag for logs in run_logs for log in logs for tag in log[0]})
+    tag_codes = {tag: code for code, tag in enumerate(all_tags)}
+    run_idx, tag_idx, steps, values = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int32)], \
+        [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+    for run, logs in enumerate(run_logs):
+        for log_tags, log_tag_idx, log_steps, log_values in logs:
+            run_idx.append(np.full(len(log_steps), run, dtype=np.int32))
+            tag_idx.append(np.array([tag_codes[tag] for tag in log_tags] + [0], dtype=np.int32)[log_tag_idx])
+            steps.append(log_steps)
+            values.append(log_values)
+    return pandas.DataFrame({
+        "run": pandas.Categorical.from_codes(np.concatenate(run_idx), categories=paths),
+        "tag": pandas.Categorical.from_codes(np.concatenate(tag_idx), categories=all_tags),
+        "step": np.concatenate(steps),
+        "value": np.concatenate(values),
+    })
+
+
 if __name__ == "__main__":
     _demo()
@@ -1,4 +1,6 @@
 import time
+from contextlib import closing, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
 import gym
 import numpy as np
@@ -6,7 +8,8 @@ import tensorflow as tf
 
 from stable_baselines import logger
 from stable_baselines.common import explained_variance, ActorCriticRLModel, tf_util, SetVerbosity, TensorboardWriter
-from stable_baselines.common.runners import AbstractEnvRunner
+from stable_baselines.common.runners import AbstractEnvRunner, RolloutStorage, compute_gae
+from stable_baselines.common.vec_env import VecFrameStack
 from stable_baselines.common.policies import ActorCriticPolicy, RecurrentActorCriticPolicy
 from stable_baselines.a2c.utils import total_episode_reward_logger
 
@@ -147,10 +150,10 @@ class PPOModel():
             self.value = act_model.value
             self.initial_state = act_model.initial_state
 
-    def _train_step(self, learning_rate, cliprange, obs, returns, masks, actions, values, neglogpacs, update,
-                    writer, states=None, cliprange_vf=None):
+    def _train_feed_dict(self, learning_rate, cliprange, obs, returns, masks, actions, values, neglogpacs,
+                         states=None, cliprange_vf=None):
         """
-        Training of PPO2 Algorithm
+        Build the feed dict of a training step of this model
 
         :param learning_rate: (float) learning rate
         :param cliprange: (float) Clipping factor
@@ -160,14 +163,10 @@ class PPOModel():
         :param actions: (np.ndarray) the actions
         :param values: (np.ndarray) the values
         :param neglogpacs: (np.ndarray) Negative Log-likelihood probability of Actions
-        :param update: (int) the current step iteration
-        :param writer: (TensorFlow Summary.writer) the writer for tensorboard
         :param states: (np.ndarray) For recurrent policies, the internal state of the recurrent model
-        :return: policy gradient loss, value function loss, policy entropy,
-                approximation of kl divergence, updated clipping range, training update operation
         :param cliprange_vf: (float) Clipping factor for the value function
+        :return: (dict) the feed dict
         """
-        self.n_batch = self.parent.n_envs * self.parent.n_steps
         advs = returns - values
         advs = (advs - advs.mean()) / (advs.std() + 1e-8)
         td_map = {self.train_model.obs_ph: obs, self.action_ph: actions,
@@ -180,6 +179,31 @@ class PPOModel():
 
         if cliprange_vf is not None and cliprange_vf >= 0:
             td_map[self.clip_range_vf_ph] = cliprange_vf
+        return td_map
+
+    def _train_step(self, learning_rate, cliprange, obs, returns, masks, actions, values, neglogpacs, update,
+                    writer, states=None, cliprange_vf=None):
+        """
+        Training of PPO2 Algorithm
+
+        :param learning_rate: (float) learning rate
+        :param cliprange: (float) Clipping factor
+        :param obs: (np.ndarray) The current observation of the environment
+        :param returns: (np.ndarray) the rewards
+        :param masks: (np.ndarray) The last masks for done episodes (used in recurent policies)
+        :param actions: (np.ndarray) the actions
+        :param values: (np.ndarray) the values
+        :param neglogpacs: (np.ndarray) Negative Log-likelihood probability of Actions
+        :param update: (int) the current step iteration
+        :param writer: (TensorFlow Summary.writer) the writer for tensorboard
+        :param states: (np.ndarray) For recurrent policies, the internal state of the recurrent model
+        :return: policy gradient loss, value function loss, policy entropy,
+                approximation of kl divergence, updated clipping range, training update operation
+        :param cliprange_vf: (float) Clipping factor for the value function
+        """
+        self.n_batch = self.parent.n_envs * self.parent.n_steps
+        td_map = self._train_feed_dict(learning_rate, cliprange, obs, returns, masks, actions, values, neglogpacs,
+                                       states=states, cliprange_vf=cliprange_vf)
 
         if states is None:
             update_fac = self.n_batch // self.parent.nminibatches // self.parent.noptepochs + 1
@@ -249,11 +273,20 @@ class PPO2(ActorCriticRLModel):
         results, you must set `n_cpu_tf_sess` to 1.
     :param n_cpu_tf_sess: (int) The number of threads for TensorFlow operations
         If None, the number of cpu of the current machine will be used.
+    :param fuse_agent_updates: (bool) For multi-agent environments, train all the agents on the same minibatch
+        indices in a single session call per minibatch, instead of one call per agent and minibatch.
+        Not supported for recurrent policies.
+    :param pipeline_rollouts: (bool) Collect the next rollout in a background thread while training on the current
+        one. The next rollout is then collected with parameters that are being updated, so it is slightly
+        off-policy, which the clipped surrogate objective accounts for. Training is not reproducible in this mode.
+    :param profiler: (logger.Profiler) times the phases of training (rollout, policy_step, env_step, gae, shuffle,
+        train_step, logging, callback) and logs them as "time_<phase>". If None, profiling is disabled.
     """
     def __init__(self, policy, env, gamma=0.99, n_steps=128, ent_coef=0.01, learning_rate=2.5e-4, vf_coef=0.5,
                  max_grad_norm=0.5, lam=0.95, nminibatches=4, noptepochs=4, cliprange=0.2, cliprange_vf=None,
                  verbose=0, tensorboard_log=None, _init_setup_model=True, policy_kwargs=None,
-                 full_tensorboard_log=False, seed=None, n_cpu_tf_sess=None, _num_agents=None, _is_multi_env=None):
+                 full_tensorboard_log=False, seed=None, n_cpu_tf_sess=None, fuse_agent_updates=False,
+                 pipeline_rollouts=False, profiler=None, _num_agents=None, _is_multi_env=None):
 
         self.learning_rate = learning_rate
         self.cliprange = cliprange
@@ -268,6 +301,9 @@ class PPO2(ActorCriticRLModel):
         self.noptepochs = noptepochs
         self.tensorboard_log = tensorboard_log
         self.full_tensorboard_log = full_tensorboard_log
+        self.fuse_agent_updates = fuse_agent_updates
+        self.pipeline_rollouts = pipeline_rollouts
+        self.profiler = profiler if profiler is not None else logger.Profiler(enabled=False)
 
         self.summary = None
 
@@ -304,6 +340,18 @@ class PPO2(ActorCriticRLModel):
                 with tf.variable_scope(f'submodel_{e.i}', reuse=False):
                     e.setup_model()
 
+            if self.is_multi_env:
+                # Stack the outputs of all the agents' policies in the graph,
+                # so that a rollout step is a single session call
+                act_models = [e.act_model for e in self.models]
+                with tf.variable_scope("multi_agent", reuse=False):
+                    self._multi_action = tf.stack([m.action for m in act_models], axis=1)
+                    self._multi_deterministic_action = tf.stack([m.deterministic_action for m in act_models], axis=1)
+                    self._multi_value = tf.stack([m.value_flat for m in act_models], axis=1)
+                    self._multi_neglogp = tf.stack([m.neglogp for m in act_models], axis=1)
+                    # The agents have disjoint parameters, so their updates can run in the same graph execution
+                    self._multi_train = tf.group(*[e._train for e in self.models])
+
             tf.global_variables_initializer().run(session=self.sess)  # pylint: disable=E1101
 
             self.summary = tf.summary.merge_all()
@@ -311,8 +359,9 @@ class PPO2(ActorCriticRLModel):
         self.params = sum([e.params for e in self.models], [])
 
     def _make_runner(self):
+        # When pipelining, the next rollout is written while the learner still reads the current one
         return Runner(env=self.env, model=self, n_steps=self.n_steps,
-                      gamma=self.gamma, lam=self.lam)
+                      gamma=self.gamma, lam=self.lam, n_buffers=2 if self.pipeline_rollouts else 1)
 
     def _get_pretrain_placeholders(self):
         placeholders = []
@@ -320,33 +369,98 @@ class PPO2(ActorCriticRLModel):
             placeholders += list(model._get_pretrain_placeholders())
         return tuple(placeholders)
 
+    def _multi_agent_feed_dict(self, obs):
+        """
+        Split a multi-agent observation between the agents' policies
+
+        :param obs: (np.ndarray) the observation, with shape (n_envs, n_agents, ...) or (n_agents, ...) when predicting
+        :return: (dict, bool) the feed dict for the act models, and whether a single observation was given
+        """
+        is_predict = len(obs.shape) < 3
+        feed_dict = {model.act_model.obs_ph: obs[None, i, ...] if is_predict else obs[:, i, ...]
+                     for i, model in enumerate(self.models)}
+        return feed_dict, is_predict
+
     def _mystep(self, obs, states, dones, deterministic=False):
         if not self.is_multi_env:
             return self.models[0].step(obs, states, dones, deterministic=deterministic)
         else:
-            actions, values, states, neglogpacs = [], [], None, []
-            is_predict = len(obs.shape) < 3
-            for i, model in enumerate(self.models):
-                assert states == [] or states is None, 'Recurrent states are not yet handled for multiagent.'
-                o = obs[:, i, ...] if not is_predict else obs[None, i, ...]
-                a, v, s, n = model.step(o, states, dones, deterministic=deterministic)
-                actions.append(a)
-                values.append(v)
-                neglogpacs.append(n)
+            assert states == [] or states is None, 'Recurrent states are not yet handled for multiagent.'
+            feed_dict, is_predict = self._multi_agent_feed_dict(obs)
+            action = self._multi_deterministic_action if deterministic else self._multi_action
+            actions, values, neglogpacs = self.sess.run([action, self._multi_value, self._multi_neglogp], feed_dict)
             if is_predict:
-                return np.stack(actions, axis=1)[0], np.stack(values, axis=1)[0], states, np.stack(neglogpacs, axis=1)[0]
-            return np.stack(actions, axis=1), np.stack(values, axis=1), states, np.stack(neglogpacs, axis=1)
+                return actions[0], values[0], states, neglogpacs[0]
+            return actions, values, states, neglogpacs
 
     def _myvalue(self, obs, states, dones):
         if not self.is_multi_env:
             return self.models[0].value(obs, states, dones)
         else:
-            values = []
-            for i, model in enumerate(self.models):
-                assert states is None, 'Recurrent states are not yet handled for multiagent.'
-                values.append(model.value(obs[:, i, ...], states, dones))
-            # TODO: is it dangerous that this is np.array?
-            return np.stack(values, axis=1)
+            assert states is None, 'Recurrent states are not yet handled for multiagent.'
+            feed_dict, _ = self._multi_agent_feed_dict(obs)
+            return self.sess.run(self._multi_value, feed_dict)
+
+    def _fused_train_step(self, learning_rate, cliprange, obs, returns, masks, actions, values, neglogpacs, update,
+                          writer, cliprange_vf=None):
+        """
+        Training of all the agents of a multi-agent environment on a minibatch, in a single session call
+
+        :param learning_rate: (float) learning rate
+        :param cliprange: (float) Clipping factor
+        :param obs: (np.ndarray) The current observation of the environment, with shape (n_batch, n_agents, ...)
+        :param returns: (np.ndarray) the rewards, with shape (n_batch, n_agents)
+        :param masks: (np.ndarray) The last masks for done episodes
+        :param actions: (np.ndarray) the actions, with shape (n_batch, n_agents, ...)
+        :param values: (np.ndarray) the values, with shape (n_batch, n_agents)
+        :param neglogpacs: (np.ndarray) Negative Log-likelihood probability of Actions, with shape (n_batch, n_agents)
+        :param update: (int) the current step iteration
+        :param writer: (TensorFlow Summary.writer) the writer for tensorboard
+        :param cliprange_vf: (float) Clipping factor for the value function
+        :return: ([tuple]) for each agent: policy gradient loss, value function loss, policy entropy,
+                approximation of kl divergence, updated clipping range
+        """
+        td_map = {}
+        for i, model in enumerate(self.models):
+            td_map.update(model._train_feed_dict(learning_rate, cliprange, obs[:, i, ...], returns[:, i, ...], masks,
+                                                 actions[:, i, ...], values[:, i, ...], neglogpacs[:, i, ...],
+                                                 cliprange_vf=cliprange_vf))
+        loss_ops = [[model.pg_loss, model.vf_loss, model.entropy, model.approxkl, model.clipfrac]
+                    for model in self.models]
+
+        if writer is not None:
+            update_fac = self.n_batch // self.nminibatches // self.noptepochs + 1
+            summary, loss_vals, _ = self.sess.run([self.summary, loss_ops, self._multi_train], td_map)
+            writer.add_summary(summary, (update * update_fac))
+        else:
+            loss_vals, _ = self.sess.run([loss_ops, self._multi_train], td_map)
+
+        return [tuple(agent_loss_vals) for agent_loss_vals in loss_vals]
+
+    def _iter_rollouts(self, n_updates):
+        """
+        Yield the rollouts of `n_updates` updates.
+        With `pipeline_rollouts`, the next rollout is collected in a background thread
+        while the caller trains on the one that was yielded.
+
+        :param n_updates: (int) the number of rollouts to collect
+        :return: (generator) the outputs of `self.runner.run()`
+        """
+        # The runner copies the observations into its own array: the stacked frames do not need another copy
+        with self.env.obs_views() if isinstance(self.env, VecFrameStack) else ExitStack():
+            if not self.pipeline_rollouts:
+                for _ in range(n_updates):
+                    yield self.runner.run()
+                return
+
+            # Leaving the executor waits for a rollout in progress, also when the generator is closed early
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                future = executor.submit(self.runner.run)
+                for update in range(1, n_updates + 1):
+                    rollout = future.result()
+                    if update < n_updates:
+                        future = executor.submit(self.runner.run)
+                    yield rollout
 
     def learn(self, total_timesteps, callback=None, log_interval=1, tb_log_name="PPO2",
               reset_num_timesteps=True):
@@ -358,14 +472,15 @@ class PPO2(ActorCriticRLModel):
         cliprange_vf = get_schedule_fn(self.cliprange_vf)
 
         new_tb_log = self._init_num_timesteps(reset_num_timesteps)
+        n_updates = total_timesteps // self.n_batch
 
+        # Closing the rollouts stops the background rollout, also when training raises or is stopped early
         with SetVerbosity(self.verbose), TensorboardWriter(self.graph, self.tensorboard_log, tb_log_name, new_tb_log) \
-                as writer:
+                as writer, closing(self._iter_rollouts(n_updates)) as rollouts:
             self._setup_learn()
 
             t_first_start = time.time()
 
-            n_updates = total_timesteps // self.n_batch
             for update in range(1, n_updates + 1):
                 assert self.n_batch % self.nminibatches == 0, ("The number of minibatches (`nminibatches`) "
                                                                "is not a factor of the total number of samples "
@@ -379,46 +494,71 @@ class PPO2(ActorCriticRLModel):
                 cliprange_now = self.cliprange(frac)
                 cliprange_vf_now = cliprange_vf(frac)
                 # true_reward is the reward without discount
-                obs, returns, masks, actions, values, neglogpacs, states, ep_infos, true_reward = self.runner.run()
+                with self.profiler("rollout"):
+                    obs, returns, masks, actions, values, neglogpacs, states, ep_infos, true_reward = next(rollouts)
                 self.num_timesteps += self.n_batch
                 self.ep_info_buf.extend(ep_infos)
                 mb_loss_vals = []
-                for model_idx, model in enumerate(self.models):
-                    if states is None:  # nonrecurrent version
-                        update_fac = self.n_batch // self.nminibatches // self.noptepochs + 1
-                        inds = np.arange(self.n_batch)
-                        for epoch_num in range(self.noptepochs):
+                if self.is_multi_env and self.fuse_agent_updates and states is None:
+                    # One session call per minibatch for all the agents
+                    update_fac = self.n_batch // self.nminibatches // self.noptepochs + 1
+                    inds = np.arange(self.n_batch)
+                    for epoch_num in range(self.noptepochs):
+                        with self.profiler("shuffle"):
                             np.random.shuffle(inds)
-                            for start in range(0, self.n_batch, batch_size):
-                                timestep = self.num_timesteps // update_fac + ((self.noptepochs * self.n_batch + epoch_num *
-                                                                                self.n_batch + start) // batch_size)
-                                end = start + batch_size
-                                mbinds = inds[start:end]
-                                if self.is_multi_env:
-                                    slices = (arr[mbinds] for arr in (obs[:, model_idx, ...], returns[:, model_idx, ...], masks, actions[:, model_idx, ...], values[:, model_idx, ...], neglogpacs[:, model_idx, ...]))
-                                else:
-                                    slices = (arr[mbinds] for arr in (obs, returns, masks, actions, values, neglogpacs))
-                                mb_loss_vals.append(model._train_step(lr_now, cliprange_now, *slices, writer=writer,
-                                                                    update=timestep, cliprange_vf=cliprange_vf_now))
-                    else:  # recurrent version
-                        update_fac = self.n_batch // self.nminibatches // self.noptepochs // self.n_steps + 1
-                        assert self.n_envs % self.nminibatches == 0
-                        env_indices = np.arange(self.n_envs)
-                        flat_indices = np.arange(self.n_envs * self.n_steps).reshape(self.n_envs, self.n_steps)
-                        envs_per_batch = batch_size // self.n_steps
-                        for epoch_num in range(self.noptepochs):
-                            np.random.shuffle(env_indices)
-                            for start in range(0, self.n_envs, envs_per_batch):
-                                timestep = self.num_timesteps // update_fac + ((self.noptepochs * self.n_envs + epoch_num *
-                                                                                self.n_envs + start) // envs_per_batch)
-                                end = start + envs_per_batch
-                                mb_env_inds = env_indices[start:end]
-                                mb_flat_inds = flat_indices[mb_env_inds].ravel()
-                                slices = (arr[mb_flat_inds] for arr in (obs, returns, masks, actions, values, neglogpacs))
-                                mb_states = states[mb_env_inds]
-                                mb_loss_vals.append(model._train_step(lr_now, cliprange_now, *slices, update=timestep,
-                                                                    writer=writer, states=mb_states,
-                                                                    cliprange_vf=cliprange_vf_now))
+                        for start in range(0, self.n_batch, batch_size):
+                            timestep = self.num_timesteps // update_fac + ((self.noptepochs * self.n_batch + epoch_num *
+                                                                            self.n_batch + start) // batch_size)
+                            end = start + batch_size
+                            mbinds = inds[start:end]
+                            slices = (arr[mbinds] for arr in (obs, returns, masks, actions, values, neglogpacs))
+                            with self.profiler("train_step"):
+                                mb_loss_vals.extend(self._fused_train_step(lr_now, cliprange_now, *slices,
+                                                                           writer=writer, update=timestep,
+                                                                           cliprange_vf=cliprange_vf_now))
+                else:
+                    for model_idx, model in enumerate(self.models):
+                        if states is None:  # nonrecurrent version
+                            update_fac = self.n_batch // self.nminibatches // self.noptepochs + 1
+                            inds = np.arange(self.n_batch)
+                            for epoch_num in range(self.noptepochs):
+                                with self.profiler("shuffle"):
+                                    np.random.shuffle(inds)
+                                for start in range(0, self.n_batch, batch_size):
+                                    timestep = self.num_timesteps // update_fac + ((self.noptepochs * self.n_batch + epoch_num *
+                                                                                    self.n_batch + start) // batch_size)
+                                    end = start + batch_size
+                                    mbinds = inds[start:end]
+                                    if self.is_multi_env:
+                                        slices = (arr[mbinds] for arr in (obs[:, model_idx, ...], returns[:, model_idx, ...], masks, actions[:, model_idx, ...], values[:, model_idx, ...], neglogpacs[:, model_idx, ...]))
+                                    else:
+                                        slices = (arr[mbinds] for arr in (obs, returns, masks, actions, values, neglogpacs))
+                                    with self.profiler("train_step"):
+                                        mb_loss_vals.append(model._train_step(lr_now, cliprange_now, *slices,
+                                                                              writer=writer, update=timestep,
+                                                                              cliprange_vf=cliprange_vf_now))
+                        else:  # recurrent version
+                            update_fac = self.n_batch // self.nminibatches // self.noptepochs // self.n_steps + 1
+                            assert self.n_envs % self.nminibatches == 0
+                            env_indices = np.arange(self.n_envs)
+                            flat_indices = np.arange(self.n_envs * self.n_steps).reshape(self.n_envs, self.n_steps)
+                            envs_per_batch = batch_size // self.n_steps
+                            for epoch_num in range(self.noptepochs):
+                                with self.profiler("shuffle"):
+                                    np.random.shuffle(env_indices)
+                                for start in range(0, self.n_envs, envs_per_batch):
+                                    timestep = self.num_timesteps // update_fac + ((self.noptepochs * self.n_envs + epoch_num *
+                                                                                    self.n_envs + start) // envs_per_batch)
+                                    end = start + envs_per_batch
+                                    mb_env_inds = env_indices[start:end]
+                                    mb_flat_inds = flat_indices[mb_env_inds].ravel()
+                                    slices = (arr[mb_flat_inds] for arr in (obs, returns, masks, actions, values, neglogpacs))
+                                    mb_states = states[mb_env_inds]
+                                    with self.profiler("train_step"):
+                                        mb_loss_vals.append(model._train_step(lr_now, cliprange_now, *slices,
+                                                                              update=timestep, writer=writer,
+                                                                              states=mb_states,
+                                                                              cliprange_vf=cliprange_vf_now))
 
                 loss_vals = np.mean(mb_loss_vals, axis=0)
                 total_loss.append(np.sum(loss_vals.tolist()) / len(loss_vals.tolist()))
@@ -445,12 +585,15 @@ class PPO2(ActorCriticRLModel):
                     logger.logkv('time_elapsed', t_start - t_first_start)
                     for (loss_val, loss_name) in zip(loss_vals, self.models[0].loss_names):
                         logger.logkv(loss_name, loss_val)
-                    logger.dumpkvs()
+                    with self.profiler("logging"):
+                        logger.dumpkvs()
 
                 if callback is not None:
                     # Only stop training if return value is False, not when it is None. This is for backwards
                     # compatibility with callbacks that have no return statement.
-                    if callback(locals(), globals()) is False:
+                    with self.profiler("callback"):
+                        keep_training = callback(locals(), globals())
+                    if keep_training is False:
                         break
 
             return total_loss
@@ -477,6 +620,8 @@ class PPO2(ActorCriticRLModel):
             "seed": self.seed,
             "_vectorize_action": self._vectorize_action,
             "policy_kwargs": self.policy_kwargs,
+            "fuse_agent_updates": self.fuse_agent_updates,
+            "pipeline_rollouts": self.pipeline_rollouts,
             "num_agents": self.num_agents,
             "is_multi_env": self.is_multi_env
         }
@@ -487,7 +632,7 @@ class PPO2(ActorCriticRLModel):
 
 
 class Runner(AbstractEnvRunner):
-    def __init__(self, *, env, model, n_steps, gamma, lam):
+    def __init__(self, *, env, model, n_steps, gamma, lam, n_buffers=1):
         """
         A runner to learn the policy of an environment for a model
 
@@ -496,10 +641,14 @@ class Runner(AbstractEnvRunner):
         :param n_steps: (int) The number of steps to run for each environment
         :param gamma: (float) Discount factor
         :param lam: (float) Factor for trade-off of bias vs variance for Generalized Advantage Estimator
+        :param n_buffers: (int) The number of rollout storages used in turn,
+            i.e. the number of consecutive rollouts that stay valid
         """
         super().__init__(env=env, model=model, n_steps=n_steps)
         self.lam = lam
         self.gamma = gamma
+        self.storages = [RolloutStorage(env.num_envs, n_steps) for _ in range(n_buffers)]
+        self.storage = self.storages[-1]
 
     def run(self):
         """
@@ -514,53 +663,45 @@ class Runner(AbstractEnvRunner):
             - negative log probabilities: (np.ndarray)
             - states: (np.ndarray) the internal states of the recurrent policies
             - infos: (dict) the extra information of the model
+
+        The returned arrays are views on `self.storage`: they are overwritten when the storage is used again,
+        i.e. `n_buffers` calls to `run` later.
         """
-        # mb stands for minibatch
-        mb_obs, mb_rewards, mb_actions, mb_values, mb_dones, mb_neglogpacs = [], [], [], [], [], []
+        self.storage = storage = self.storages[(self.storages.index(self.storage) + 1) % len(self.storages)]
+        profiler = self.model.profiler
         mb_states = self.states
         ep_infos = []
-        for _ in range(self.n_steps):
-            actions, values, self.states, neglogpacs = self.model.step(self.obs, self.states, self.dones)
-            mb_obs.append(self.obs.copy())
-            mb_actions.append(actions)
-            mb_values.append(values)
-            mb_neglogpacs.append(neglogpacs)
-            mb_dones.append(self.dones)
+        for step in range(self.n_steps):
+            with profiler("policy_step"):
+                actions, values, self.states, neglogpacs = self.model.step(self.obs, self.states, self.dones)
+            storage.store(step, 'obs', self.obs)
+            storage.store(step, 'actions', actions)
+            storage.store(step, 'values', values, np.float32)
+            storage.store(step, 'neglogpacs', neglogpacs, np.float32)
+            storage.store(step, 'dones', self.dones, np.bool_)
             clipped_actions = actions
             # Clip the actions to avoid out of bound error
             if isinstance(self.env.action_space, gym.spaces.Box):
                 clipped_actions = np.clip(actions, self.env.action_space.low, self.env.action_space.high)
-            self.obs[:], rewards, self.dones, infos = self.env.step(clipped_actions)
+            with profiler("env_step"):
+                self.obs[:], rewards, self.dones, infos = self.env.step(clipped_actions)
             for info in infos:
                 maybe_ep_info = info.get('episode')
                 if maybe_ep_info is not None:
                     ep_infos.append(maybe_ep_info)
-            mb_rewards.append(rewards)
-        # batch of steps to batch of rollouts
-        mb_obs = np.asarray(mb_obs, dtype=self.obs.dtype)
-        mb_rewards = np.asarray(mb_rewards, dtype=np.float32)
-        mb_actions = np.asarray(mb_actions)
-        mb_values = np.asarray(mb_values, dtype=np.float32)
-        mb_neglogpacs = np.asarray(mb_neglogpacs, dtype=np.float32)
-        mb_dones = np.asarray(mb_dones, dtype=np.bool)
-        last_values = self.model.value(self.obs, self.states, self.dones)
-        # discount/bootstrap off value fn
-        mb_advs = np.zeros_like(mb_rewards)
-        true_reward = np.copy(mb_rewards)
-        last_gae_lam = 0
-        for step in reversed(range(self.n_steps)):
-            if step == self.n_steps - 1:
-                nextnonterminal = 1.0 - self.dones
-                nextvalues = last_values
-            else:
-                nextnonterminal = 1.0 - mb_dones[step + 1]
-                nextvalues = mb_values[step + 1]
-            delta = mb_rewards[step] + self.gamma * nextvalues * nextnonterminal[:, None] - mb_values[step]
-            mb_advs[step] = last_gae_lam = delta + self.gamma * self.lam * nextnonterminal[:, None] * last_gae_lam
-        mb_returns = mb_advs + mb_values
-
+            storage.store(step, 'rewards', rewards, np.float32)
+        with profiler("policy_step"):
+            last_values = self.model.value(self.obs, self.states, self.dones)
+        # discount/bootstrap off value fn, the advantages are written in place and then turned into returns
+        with profiler("gae"):
+            mb_returns = storage.allocate('returns', storage['rewards'].shape[2:], np.float32)
+            compute_gae(storage['rewards'], storage['values'], storage['dones'], last_values, self.dones,
+                        self.gamma, self.lam, out=mb_returns)
+            mb_returns += storage['values']
+
+        # the storage is env-major, so flattening does not copy
         mb_obs, mb_returns, mb_dones, mb_actions, mb_values, mb_neglogpacs, true_reward = \
-            map(swap_and_flatten, (mb_obs, mb_returns, mb_dones, mb_actions, mb_values, mb_neglogpacs, true_reward))
+            map(storage.flat, ('obs', 'returns', 'dones', 'actions', 'values', 'neglogpacs', 'rewards'))
 
         return mb_obs, mb_returns, mb_dones, mb_actions, mb_values, mb_neglogpacs, mb_states, ep_infos, true_reward
 
@@ -583,18 +724,6 @@ def get_schedule_fn(value_schedule):
     return value_schedule
 
 
-# obs, returns, masks, actions, values, neglogpacs, states = runner.run()
-def swap_and_flatten(arr):
-    """
-    swap and then flatten axes 0 and 1
-
-    :param arr: (np.ndarray)
-    :return: (np.ndarray)
-    """
-    shape = arr.shape
-    return arr.swapaxes(0, 1).reshape(shape[0] * shape[1], *shape[2:])
-
-
 def constfn(val):
     """
     Create a function that returns a constant
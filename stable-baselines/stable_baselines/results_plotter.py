@@ -12,6 +12,8 @@ X_EPISODES = 'episodes'
 X_WALLTIME = 'walltime_hrs'
 POSSIBLE_X_AXES = [X_TIMESTEPS, X_EPISODES, X_WALLTIME]
 EPISODES_WINDOW = 100
+# Maximum number of points plotted per curve
+MAX_POINTS = 10000
 COLORS = ['blue', 'green', 'red', 'cyan', 'magenta', 'yellow', 'black', 'purple', 'pink',
           'brown', 'orange', 'teal', 'coral', 'lightblue', 'lime', 'lavender', 'turquoise',
           'darkgreen', 'tan', 'salmon', 'gold', 'lightpurple', 'darkred', 'darkblue']
@@ -40,11 +42,30 @@ def window_func(var_1, var_2, window, func):
     :param func: (numpy function) function to apply on the rolling window on variable 2 (such as np.mean)
     :return: (np.ndarray, np.ndarray)  the rolling output with applied function
     """
+    if func is np.mean:
+        # Difference of the running sums, instead of a sum per window
+        cumsum = np.cumsum(np.insert(np.asarray(var_2, dtype=np.float64), 0, 0))
+        return var_1[window - 1:], (cumsum[window:] - cumsum[:-window]) / window
     var_2_window = rolling_window(var_2, window)
     function_on_var2 = func(var_2_window, axis=-1)
     return var_1[window - 1:], function_on_var2
 
 
+def downsample(var_1, var_2, max_points):
+    """
+    keep at most max_points evenly spaced points of 2 arrays, e.g. before plotting them
+
+    :param var_1: (np.ndarray) variable 1
+    :param var_2: (np.ndarray) variable 2
+    :param max_points: (int) the maximum number of points
+    :return: (np.ndarray, np.ndarray) the kept points
+    """
+    if len(var_1) <= max_points:
+        return var_1, var_2
+    idxes = np.round(np.linspace(0, len(var_1) - 1, max_points)).astype(np.int64)
+    return var_1[idxes], var_2[idxes]
+
+
 def ts2xy(timesteps, xaxis):
     """
     Decompose a timesteps variable to x ans ys
@@ -68,7 +89,7 @@ def ts2xy(timesteps, xaxis):
     return x_var, y_var
 
 
-def plot_curves(xy_list, xaxis, title):
+def plot_curves(xy_list, xaxis, title, max_points=MAX_POINTS):
     """
     plot the curves
 
@@ -76,6 +97,8 @@ def plot_curves(xy_list, xaxis, title):
     :param xaxis: (str) the axis for the x and y output
         (can be X_TIMESTEPS='timesteps', X_EPISODES='episodes' or X_WALLTIME='walltime_hrs')
     :param title: (str) the title of the plot
+    :param max_points: (int) the maximum number of points plotted per curve, the rolling mean is computed on
+        all the points before downsampling
     """
 
     plt.figure(figsize=(8, 2))
@@ -83,12 +106,12 @@ def plot_curves(xy_list, xaxis, title):
     minx = 0
     for (i, (x, y)) in enumerate(xy_list):
         color = COLORS[i]
-        plt.scatter(x, y, s=2)
+        plt.scatter(*downsample(x, y, max_points), s=2)
         # Do not plot the smoothed curve at all if the timeseries is shorter than window size.
         if x.shape[0] >= EPISODES_WINDOW:
             # Compute and plot rolling mean with window of size EPISODE_WINDOW
             x, y_mean = window_func(x, y, EPISODES_WINDOW, np.mean)
-            plt.plot(x, y_mean, color=color)
+            plt.plot(*downsample(x, y_mean, max_points), color=color)
     plt.xlim(minx, maxx)
     plt.title(title)
     plt.xlabel(xaxis)
@@ -109,9 +132,7 @@ def plot_results(dirs, num_timesteps, xaxis, task_name):
 
     tslist = []
     for folder in dirs:
-        timesteps = load_results(folder)
-        if num_timesteps is not None:
-            timesteps = timesteps[timesteps.l.cumsum() <= num_timesteps]
+        timesteps = load_results(folder, timesteps_range=None if num_timesteps is None else (None, num_timesteps))
         tslist.append(timesteps)
     xy_list = [ts2xy(timesteps_item, xaxis) for timesteps_item in tslist]
     plot_curves(xy_list, xaxis, task_name)
@@ -9,7 +9,7 @@ from stable_baselines.a2c.utils import total_episode_reward_logger
 from stable_baselines.common import tf_util, OffPolicyRLModel, SetVerbosity, TensorboardWriter
 from stable_baselines.common.vec_env import VecEnv
 from stable_baselines.common.math_util import unscale_action, scale_action
-from stable_baselines.deepq.replay_buffer import ReplayBuffer
+from stable_baselines.deepq.replay_buffer import ReplayBuffer, NStepReplayBuffer
 from stable_baselines.ppo2.ppo2 import safe_mean, get_schedule_fn
 from stable_baselines.sac.policies import SACPolicy
 from stable_baselines import logger
@@ -36,7 +36,8 @@ class SAC(OffPolicyRLModel):
     Introduction to SAC: https://spinningup.openai.com/en/latest/algorithms/sac.html
 
     :param policy: (SACPolicy or str) The policy model to use (MlpPolicy, CnnPolicy, LnMlpPolicy, ...)
-    :param env: (Gym environment or str) The environment to learn from (if registered in Gym, can be str)
+    :param env: (Gym environment or str) The environment to learn from (if registered in Gym, can be str),
+        or a VecEnv with several environments
     :param gamma: (float) the discount factor
     :param learning_rate: (float or callable) learning rate for adam optimizer,
         the same learning rate will be used for all networks (Q-Values, Actor and Value function)
@@ -48,6 +49,7 @@ class SAC(OffPolicyRLModel):
         inverse of reward scale in the original SAC paper.)  Controlling exploration/exploitation trade-off.
         Set it to 'auto' to learn it automatically (and 'auto_0.1' for using 0.1 as initial value)
     :param train_freq: (int) Update the model every `train_freq` steps.
+        Steps are env steps: a step of a VecEnv is `n_envs` steps.
     :param learning_starts: (int) how many steps of the model to collect transitions for before learning starts
     :param target_update_interval: (int) update the target network every `target_network_update_freq` steps.
     :param gradient_steps: (int) How many gradient update after each step
@@ -68,6 +70,13 @@ class SAC(OffPolicyRLModel):
         results, you must set `n_cpu_tf_sess` to 1.
     :param n_cpu_tf_sess: (int) The number of threads for TensorFlow operations
         If None, the number of cpu of the current machine will be used.
+    :param n_step: (int) the number of rewards in the targets (n-step returns), uses a NStepReplayBuffer if > 1
+    :param fused_gradient_steps: (int) number of gradient steps (with their target updates) run in a single
+        session call, on as many minibatches sampled at once. The gradient steps that do not fill a session call
+        are run with the next training rounds. It must be a multiple of `target_update_interval`.
+    :param prefetch_batches: (int) number of minibatches sampled ahead from the replay buffer on a background thread
+        (0 to sample them synchronously). The prefetched minibatches depend on the thread scheduling,
+        so a seeded run is not exactly reproducible with prefetching
     """
 
     def __init__(self, policy, env, gamma=0.99, learning_rate=3e-4, buffer_size=50000,
@@ -76,11 +85,12 @@ class SAC(OffPolicyRLModel):
                  gradient_steps=1, target_entropy='auto', action_noise=None,
                  random_exploration=0.0, verbose=0, tensorboard_log=None,
                  _init_setup_model=True, policy_kwargs=None, full_tensorboard_log=False,
-                 seed=None, n_cpu_tf_sess=None):
+                 seed=None, n_cpu_tf_sess=None, n_step=1, fused_gradient_steps=1,
+                 prefetch_batches=0):
 
         super(SAC, self).__init__(policy=policy, env=env, replay_buffer=None, verbose=verbose,
                                   policy_base=SACPolicy, requires_vec_env=False, policy_kwargs=policy_kwargs,
-                                  seed=seed, n_cpu_tf_sess=n_cpu_tf_sess)
+                                  seed=seed, n_cpu_tf_sess=n_cpu_tf_sess, supports_vec_env=True)
 
         self.buffer_size = buffer_size
         self.learning_rate = learning_rate
@@ -98,6 +108,9 @@ class SAC(OffPolicyRLModel):
         self.target_update_interval = target_update_interval
         self.gradient_steps = gradient_steps
         self.gamma = gamma
+        self.n_step = n_step
+        self.prefetch_batches = prefetch_batches
+        self.fused_gradient_steps = fused_gradient_steps
         self.action_noise = action_noise
         self.random_exploration = random_exploration
 
@@ -118,6 +131,7 @@ class SAC(OffPolicyRLModel):
         self.actions_ph = None
         self.rewards_ph = None
         self.terminals_ph = None
+        self.discounts_ph = None
         self.observations_ph = None
         self.action_target = None
         self.next_observations_ph = None
@@ -131,6 +145,10 @@ class SAC(OffPolicyRLModel):
         self.processed_obs_ph = None
         self.processed_next_obs_ph = None
         self.log_ent_coef = None
+        self.fused_policy_tf = None
+        self.fused_target_policy = None
+        self.fused_infos = None
+        self.fused_train_op = None
 
         if _init_setup_model:
             self.setup_model()
@@ -141,6 +159,65 @@ class SAC(OffPolicyRLModel):
         deterministic_action = unscale_action(self.action_space, self.deterministic_action)
         return policy.obs_ph, self.actions_ph, deterministic_action
 
+    def _make_losses(self, qf1, qf2, value_fn, qf1_pi, qf2_pi, logp_pi, value_target,
+                     rewards, terminals, discounts, ent_coef, log_ent_coef):
+        """
+        Create the losses of a training step
+
+        :param qf1: (TensorFlow Tensor) the first Q-Values of the actions
+        :param qf2: (TensorFlow Tensor) the second Q-Values of the actions
+        :param value_fn: (TensorFlow Tensor) the values of the observations
+        :param qf1_pi: (TensorFlow Tensor) the first Q-Values of the policy actions
+        :param qf2_pi: (TensorFlow Tensor) the second Q-Values of the policy actions
+        :param logp_pi: (TensorFlow Tensor) the log probabilities of the policy actions
+        :param value_target: (TensorFlow Tensor) the target values of the next observations
+        :param rewards: (TensorFlow Tensor) the rewards
+        :param terminals: (TensorFlow Tensor) whether the episodes are done
+        :param discounts: (TensorFlow Tensor) the discounts of the next values
+        :param ent_coef: (float or TensorFlow Tensor) the entropy coefficient
+        :param log_ent_coef: (TensorFlow Tensor) the log of the entropy coefficient (None if not learned)
+        :return: (TensorFlow Tensor, TensorFlow Tensor, TensorFlow Tensor, TensorFlow Tensor, TensorFlow Tensor)
+            the policy, first Q-Value, second Q-Value, value and entropy coefficient (None if not learned) losses
+        """
+        # Take the min of the two Q-Values (Double-Q Learning)
+        min_qf_pi = tf.minimum(qf1_pi, qf2_pi)
+
+        # Target for Q value regression
+        q_backup = tf.stop_gradient(
+            rewards +
+            (1 - terminals) * discounts * value_target
+        )
+
+        # Compute Q-Function loss
+        # TODO: test with huber loss (it would avoid too high values)
+        qf1_loss = 0.5 * tf.reduce_mean((q_backup - qf1) ** 2)
+        qf2_loss = 0.5 * tf.reduce_mean((q_backup - qf2) ** 2)
+
+        # Compute the entropy temperature loss
+        # it is used when the entropy coefficient is learned
+        ent_coef_loss = None
+        if log_ent_coef is not None:
+            ent_coef_loss = -tf.reduce_mean(
+                log_ent_coef * tf.stop_gradient(logp_pi + self.target_entropy))
+
+        # Compute the policy loss
+        # Alternative: policy_kl_loss = tf.reduce_mean(logp_pi - min_qf_pi)
+        policy_kl_loss = tf.reduce_mean(ent_coef * logp_pi - qf1_pi)
+
+        # NOTE: in the original implementation, they have an additional
+        # regularization loss for the Gaussian parameters
+        # this is not used for now
+        # policy_loss = (policy_kl_loss + policy_regularization_loss)
+        policy_loss = policy_kl_loss
+
+        # Target for value fn regression
+        # We update the vf towards the min of two Q-functions in order to
+        # reduce overestimation bias from function approximation error.
+        v_backup = tf.stop_gradient(min_qf_pi - ent_coef * logp_pi)
+        value_loss = 0.5 * tf.reduce_mean((value_fn - v_backup) ** 2)
+
+        return policy_loss, qf1_loss, qf2_loss, value_loss, ent_coef_loss
+
     def setup_model(self):
         with SetVerbosity(self.verbose):
             self.graph = tf.Graph()
@@ -148,7 +225,10 @@ class SAC(OffPolicyRLModel):
                 self.set_random_seed(self.seed)
                 self.sess = tf_util.make_session(num_cpu=self.n_cpu_tf_sess, graph=self.graph)
 
-                self.replay_buffer = ReplayBuffer(self.buffer_size)
+                if self.n_step > 1:
+                    self.replay_buffer = NStepReplayBuffer(self.buffer_size, n_step=self.n_step, gamma=self.gamma)
+                else:
+                    self.replay_buffer = ReplayBuffer(self.buffer_size)
 
                 with tf.variable_scope("input", reuse=False):
                     # Create policy and target TF objects
@@ -166,6 +246,9 @@ class SAC(OffPolicyRLModel):
                     self.action_target = self.target_policy.action_ph
                     self.terminals_ph = tf.placeholder(tf.float32, shape=(None, 1), name='terminals')
                     self.rewards_ph = tf.placeholder(tf.float32, shape=(None, 1), name='rewards')
+                    # Discount of the next value, fed for n-step transitions
+                    self.discounts_ph = tf.placeholder_with_default(self.gamma * tf.ones_like(self.terminals_ph),
+                                                                    shape=(None, 1), name='discounts')
                     self.actions_ph = tf.placeholder(tf.float32, shape=(None,) + self.action_space.shape,
                                                      name='actions')
                     self.learning_rate_ph = tf.placeholder(tf.float32, [], name="learning_rate_ph")
@@ -221,44 +304,13 @@ class SAC(OffPolicyRLModel):
                     self.value_target = value_target
 
                 with tf.variable_scope("loss", reuse=False):
-                    # Take the min of the two Q-Values (Double-Q Learning)
-                    min_qf_pi = tf.minimum(qf1_pi, qf2_pi)
-
-                    # Target for Q value regression
-                    q_backup = tf.stop_gradient(
-                        self.rewards_ph +
-                        (1 - self.terminals_ph) * self.gamma * self.value_target
-                    )
-
-                    # Compute Q-Function loss
-                    # TODO: test with huber loss (it would avoid too high values)
-                    qf1_loss = 0.5 * tf.reduce_mean((q_backup - qf1) ** 2)
-                    qf2_loss = 0.5 * tf.reduce_mean((q_backup - qf2) ** 2)
-
-                    # Compute the entropy temperature loss
-                    # it is used when the entropy coefficient is learned
-                    ent_coef_loss, entropy_optimizer = None, None
-                    if not isinstance(self.ent_coef, float):
-                        ent_coef_loss = -tf.reduce_mean(
-                            self.log_ent_coef * tf.stop_gradient(logp_pi + self.target_entropy))
-                        entropy_optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate_ph)
-
-                    # Compute the policy loss
-                    # Alternative: policy_kl_loss = tf.reduce_mean(logp_pi - min_qf_pi)
-                    policy_kl_loss = tf.reduce_mean(self.ent_coef * logp_pi - qf1_pi)
+                    policy_loss, qf1_loss, qf2_loss, value_loss, ent_coef_loss = self._make_losses(
+                        qf1, qf2, value_fn, qf1_pi, qf2_pi, logp_pi, self.value_target, self.rewards_ph,
+                        self.terminals_ph, self.discounts_ph, self.ent_coef, self.log_ent_coef)
 
-                    # NOTE: in the original implementation, they have an additional
-                    # regularization loss for the Gaussian parameters
-                    # this is not used for now
-                    # policy_loss = (policy_kl_loss + policy_regularization_loss)
-                    policy_loss = policy_kl_loss
-
-
-                    # Target for value fn regression
-                    # We update the vf towards the min of two Q-functions in order to
-                    # reduce overestimation bias from function approximation error.
-                    v_backup = tf.stop_gradient(min_qf_pi - self.ent_coef * logp_pi)
-                    value_loss = 0.5 * tf.reduce_mean((value_fn - v_backup) ** 2)
+                    entropy_optimizer = None
+                    if ent_coef_loss is not None:
+                        entropy_optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate_ph)
 
                     values_losses = qf1_loss + qf2_loss + value_loss
 
@@ -315,6 +367,9 @@ class SAC(OffPolicyRLModel):
 
                     tf.summary.scalar('learning_rate', tf.reduce_mean(self.learning_rate_ph))
 
+                if self.fused_gradient_steps > 1:
+                    self._setup_fused_train(policy_optimizer, value_optimizer, entropy_optimizer)
+
                 # Retrieve parameters that must be saved
                 self.params = get_vars("model")
                 self.target_params = get_vars("target/values_fn/vf")
@@ -326,10 +381,125 @@ class SAC(OffPolicyRLModel):
 
                 self.summary = tf.summary.merge_all()
 
+    def _setup_fused_train(self, policy_optimizer, value_optimizer, entropy_optimizer):
+        """
+        Create the ops running `fused_gradient_steps` training steps in a single session call,
+        each on its own minibatch of a batch of `fused_gradient_steps * batch_size` transitions.
+        The steps (and the target updates, every `target_update_interval` steps) are chained with control
+        dependencies, and read the variables after the updates of the previous step.
+
+        :param policy_optimizer: (TensorFlow Optimizer) the optimizer of the policy
+        :param value_optimizer: (TensorFlow Optimizer) the optimizer of the value functions
+        :param entropy_optimizer: (TensorFlow Optimizer) the optimizer of the entropy coefficient (None if fixed)
+        """
+        assert self.fused_gradient_steps % self.target_update_interval == 0, \
+            "fused_gradient_steps must be a multiple of target_update_interval"
+
+        with tf.variable_scope("input", reuse=False):
+            # Separate policy objects, as make_actor and make_critics keep their last outputs
+            self.fused_policy_tf = self.policy(self.sess, self.observation_space, self.action_space,
+                                               **self.policy_kwargs)
+            self.fused_target_policy = self.policy(self.sess, self.observation_space, self.action_space,
+                                                   **self.policy_kwargs)
+
+        source_params = get_vars("model/values_fn/vf")
+        target_params = get_vars("target/values_fn/vf")
+        step_infos = []
+        last_ops = []
+        for k in range(self.fused_gradient_steps):
+            minibatch = slice(k * self.batch_size, (k + 1) * self.batch_size)
+            obs = self.fused_policy_tf.processed_obs[minibatch]
+            with tf.control_dependencies(last_ops):
+                with tf.variable_scope("model", reuse=True, custom_getter=tf_util.fresh_read_getter):
+                    _, policy_out, logp_pi = self.fused_policy_tf.make_actor(obs, reuse=True)
+                    qf1, qf2, value_fn = self.fused_policy_tf.make_critics(obs, self.actions_ph[minibatch],
+                                                                           create_qf=True, create_vf=True,
+                                                                           reuse=True)
+                    qf1_pi, qf2_pi, _ = self.fused_policy_tf.make_critics(obs, policy_out, create_qf=True,
+                                                                          create_vf=False, reuse=True)
+                    if self.log_ent_coef is not None:
+                        log_ent_coef = tf.get_variable('log_ent_coef')
+                        ent_coef = tf.exp(log_ent_coef)
+                    else:
+                        log_ent_coef, ent_coef = None, self.ent_coef
+
+                with tf.variable_scope("target", reuse=True, custom_getter=tf_util.fresh_read_getter):
+                    _, _, value_target = self.fused_target_policy.make_critics(
+                        self.fused_target_policy.processed_obs[minibatch], create_qf=False, create_vf=True,
+                        reuse=True)
+
+                policy_loss, qf1_loss, qf2_loss, value_loss, ent_coef_loss = self._make_losses(
+                    qf1, qf2, value_fn, qf1_pi, qf2_pi, logp_pi, value_target, self.rewards_ph[minibatch],
+                    self.terminals_ph[minibatch], self.discounts_ph[minibatch], ent_coef, log_ent_coef)
+
+                policy_train_op = policy_optimizer.minimize(policy_loss, var_list=get_vars('model/pi'))
+                with tf.control_dependencies([policy_train_op]):
+                    train_values_op = value_optimizer.minimize(qf1_loss + qf2_loss + value_loss,
+                                                               var_list=get_vars('model/values_fn'))
+                last_ops = [train_values_op]
+                infos = [policy_loss, qf1_loss, qf2_loss, value_loss, tf.reduce_mean(self.fused_policy_tf.entropy)]
+                if ent_coef_loss is not None:
+                    with tf.control_dependencies([train_values_op]):
+                        last_ops = [entropy_optimizer.minimize(ent_coef_loss, var_list=self.log_ent_coef)]
+                    infos += [ent_coef_loss, ent_coef]
+                step_infos.append(tf.stack(infos))
+
+                if (k + 1) % self.target_update_interval == 0:
+                    # Polyak averaging for target variables
+                    with tf.control_dependencies(last_ops):
+                        last_ops = [
+                            tf.assign(target, (1 - self.tau) * target.read_value() + self.tau * source.read_value())
+                            for target, source in zip(target_params, source_params)
+                        ]
+
+        self.fused_infos = tf.stack(step_infos)
+        self.fused_train_op = tf.group(*last_ops)
+
+    def _fused_train_steps(self, step, writer, learning_rate):
+        """
+        Run `fused_gradient_steps` training steps in a single session call,
+        on minibatches sampled at once from the replay buffer
+
+        :param step: (int) the current step iteration
+        :param writer: (TensorFlow Summary.writer) the writer for tensorboard
+        :param learning_rate: (float) the learning rate
+        :return: (np.ndarray) the losses and entropy of each training step (cf ``infos_names``)
+        """
+        n_samples = self.fused_gradient_steps * self.batch_size
+        batch = self.replay_buffer.sample(n_samples)
+        batch_obs, batch_actions, batch_rewards, batch_next_obs, batch_dones, *batch_discounts = batch
+
+        feed_dict = {
+            self.fused_policy_tf.obs_ph: batch_obs,
+            self.actions_ph: batch_actions,
+            self.fused_target_policy.obs_ph: batch_next_obs,
+            self.rewards_ph: batch_rewards.reshape(n_samples, -1),
+            self.terminals_ph: batch_dones.reshape(n_samples, -1),
+            self.learning_rate_ph: learning_rate
+        }
+        if batch_discounts:
+            feed_dict[self.discounts_ph] = batch_discounts[0].reshape(n_samples, -1)
+
+        if writer is not None:
+            # The summaries are computed on the first minibatch, before the updates, as with a single training step
+            summary_feed_dict = {
+                self.observations_ph: batch_obs[:self.batch_size],
+                self.actions_ph: batch_actions[:self.batch_size],
+                self.next_observations_ph: batch_next_obs[:self.batch_size],
+                self.rewards_ph: feed_dict[self.rewards_ph][:self.batch_size],
+                self.terminals_ph: feed_dict[self.terminals_ph][:self.batch_size],
+                self.learning_rate_ph: learning_rate
+            }
+            if batch_discounts:
+                summary_feed_dict[self.discounts_ph] = feed_dict[self.discounts_ph][:self.batch_size]
+            writer.add_summary(self.sess.run(self.summary, summary_feed_dict), step)
+        infos, _ = self.sess.run([self.fused_infos, self.fused_train_op], feed_dict)
+        return infos
+
     def _train_step(self, step, writer, learning_rate):
         # Sample a batch from the replay buffer
         batch = self.replay_buffer.sample(self.batch_size)
-        batch_obs, batch_actions, batch_rewards, batch_next_obs, batch_dones = batch
+        batch_obs, batch_actions, batch_rewards, batch_next_obs, batch_dones, *batch_discounts = batch
 
         feed_dict = {
             self.observations_ph: batch_obs,
@@ -339,6 +509,8 @@ class SAC(OffPolicyRLModel):
             self.terminals_ph: batch_dones.reshape(self.batch_size, -1),
             self.learning_rate_ph: learning_rate
         }
+        if batch_discounts:
+            feed_dict[self.discounts_ph] = batch_discounts[0].reshape(self.batch_size, -1)
 
         # out  = [policy_loss, qf1_loss, qf2_loss,
         #         value_loss, qf1, qf2, value_fn, logp_pi,
@@ -373,7 +545,7 @@ class SAC(OffPolicyRLModel):
             self.replay_buffer = replay_wrapper(self.replay_buffer)
 
         with SetVerbosity(self.verbose), TensorboardWriter(self.graph, self.tensorboard_log, tb_log_name, new_tb_log) \
-                as writer:
+                as writer, self._prefetch_replay(self.fused_gradient_steps * self.batch_size, self.prefetch_batches):
 
             self._setup_learn()
 
@@ -389,9 +561,14 @@ class SAC(OffPolicyRLModel):
                 self.action_noise.reset()
             obs = self.env.reset()
             n_updates = 0
+            # Gradient steps due, not run yet
+            grad_steps_due = 0
             infos_values = []
+            # With several environments, each step of the VecEnv is n_envs env steps
+            vec_env = self.n_envs > 1
+            running_rewards = np.zeros(self.n_envs)
 
-            for step in range(total_timesteps):
+            for step in range(0, total_timesteps, self.n_envs):
                 if callback is not None:
                     # Only stop training if return value is False, not when it is None. This is for backwards
                     # compatibility with callbacks that have no return statement.
@@ -405,50 +582,75 @@ class SAC(OffPolicyRLModel):
                 if self.num_timesteps < self.learning_starts or np.random.rand() < self.random_exploration:
                     # actions sampled from action space are from range specific to the environment
                     # but algorithm operates on tanh-squashed actions therefore simple scaling is used
-                    unscaled_action = self.env.action_space.sample()
+                    if vec_env:
+                        unscaled_action = np.array([self.env.action_space.sample() for _ in range(self.n_envs)])
+                    else:
+                        unscaled_action = self.env.action_space.sample()
                     action = scale_action(self.action_space, unscaled_action)
                 else:
-                    action = self.policy_tf.step(obs[None], deterministic=False).flatten()
+                    if vec_env:
+                        # One forward pass for all the envs
+                        action = self.policy_tf.step(obs, deterministic=False)
+                    else:
+                        action = self.policy_tf.step(obs[None], deterministic=False).flatten()
                     # Add noise to the action (improve exploration,
                     # not needed in general)
                     if self.action_noise is not None:
-                        action = np.clip(action + self.action_noise(), -1, 1)
+                        noise = np.array([self.action_noise() for _ in range(self.n_envs)]) if vec_env \
+                            else self.action_noise()
+                        action = np.clip(action + noise, -1, 1)
                     # inferred actions need to be transformed to environment action_space before stepping
                     unscaled_action = unscale_action(self.action_space, action)
 
-                assert action.shape == self.env.action_space.shape
+                if vec_env:
+                    assert action.shape == (self.n_envs,) + self.env.action_space.shape
+                else:
+                    assert action.shape == self.env.action_space.shape
 
                 new_obs, reward, done, info = self.env.step(unscaled_action)
 
                 # Store transition in the replay buffer.
-                self.replay_buffer.add(obs, action, reward, new_obs, float(done))
+                if vec_env:
+                    self._store_vec_transitions(obs, action, reward, new_obs, done, info)
+                else:
+                    self.replay_buffer.add(obs, action, reward, new_obs, float(done))
                 obs = new_obs
 
                 # Retrieve reward and episode length if using Monitor wrapper
-                maybe_ep_info = info.get('episode')
-                if maybe_ep_info is not None:
-                    self.ep_info_buf.extend([maybe_ep_info])
+                for env_info in (info if vec_env else [info]):
+                    maybe_ep_info = env_info.get('episode')
+                    if maybe_ep_info is not None:
+                        self.ep_info_buf.extend([maybe_ep_info])
 
                 if writer is not None:
                     # Write reward per episode to tensorboard
-                    ep_reward = np.array([reward]).reshape((1, -1))
-                    ep_done = np.array([done]).reshape((1, -1))
+                    ep_reward = np.array([reward]).reshape((self.n_envs, -1))
+                    ep_done = np.array([done]).reshape((self.n_envs, -1))
                     total_episode_reward_logger(self.episode_reward, ep_reward,
                                                 ep_done, writer, self.num_timesteps)
 
-                if step % self.train_freq == 0:
+                # train_freq and gradient_steps are in env steps
+                train_rounds = self._train_rounds(step, self.train_freq)
+                if train_rounds > 0:
                     mb_infos_vals = []
+                    # Skip the gradient steps if the warmup phase is not over
+                    # or if there are not enough samples in the replay buffer
+                    if self.replay_buffer.can_sample(self.fused_gradient_steps * self.batch_size) \
+                            and self.num_timesteps >= self.learning_starts:
+                        grad_steps_due += self.gradient_steps * train_rounds
+                    # Run the gradient steps fused_gradient_steps at a time, the remaining ones in the next rounds
+                    n_grad_steps = grad_steps_due - grad_steps_due % self.fused_gradient_steps
+                    grad_steps_due -= n_grad_steps
                     # Update policy, critics and target networks
-                    for grad_step in range(self.gradient_steps):
-                        # Break if the warmup phase is not over
-                        # or if there are not enough samples in the replay buffer
-                        if not self.replay_buffer.can_sample(self.batch_size) \
-                           or self.num_timesteps < self.learning_starts:
-                            break
-                        n_updates += 1
+                    for grad_step in range(0, n_grad_steps, self.fused_gradient_steps):
+                        n_updates += self.fused_gradient_steps
                         # Compute current learning_rate
                         frac = 1.0 - step / total_timesteps
                         current_lr = self.learning_rate(frac)
+                        if self.fused_gradient_steps > 1:
+                            # Update policy, critics and target networks for several steps in one call
+                            mb_infos_vals.extend(self._fused_train_steps(step, writer, current_lr))
+                            continue
                         # Update policy and critics (q functions)
                         mb_infos_vals.append(self._train_step(step, writer, current_lr))
                         # Update target network
@@ -459,17 +661,24 @@ class SAC(OffPolicyRLModel):
                     if len(mb_infos_vals) > 0:
                         infos_values = np.mean(mb_infos_vals, axis=0)
 
-                episode_rewards[-1] += reward
-                if done:
-                    if self.action_noise is not None:
+                if vec_env:
+                    n_ended = self._vec_episodes_bookkeeping(running_rewards, reward, done, info,
+                                                             episode_rewards, episode_successes)
+                    if n_ended > 0 and self.action_noise is not None:
                         self.action_noise.reset()
-                    if not isinstance(self.env, VecEnv):
-                        obs = self.env.reset()
-                    episode_rewards.append(0.0)
-
-                    maybe_is_success = info.get('is_success')
-                    if maybe_is_success is not None:
-                        episode_successes.append(float(maybe_is_success))
+                else:
+                    n_ended = int(done)
+                    episode_rewards[-1] += reward
+                    if done:
+                        if self.action_noise is not None:
+                            self.action_noise.reset()
+                        if not isinstance(self.env, VecEnv):
+                            obs = self.env.reset()
+                        episode_rewards.append(0.0)
+
+                        maybe_is_success = info.get('is_success')
+                        if maybe_is_success is not None:
+                            episode_successes.append(float(maybe_is_success))
 
                 if len(episode_rewards[-101:-1]) == 0:
                     mean_reward = -np.inf
@@ -477,9 +686,10 @@ class SAC(OffPolicyRLModel):
                     mean_reward = round(float(np.mean(episode_rewards[-101:-1])), 1)
 
                 num_episodes = len(episode_rewards)
-                self.num_timesteps += 1
+                self.num_timesteps += self.n_envs
                 # Display training infos
-                if self.verbose >= 1 and done and log_interval is not None and len(episode_rewards) % log_interval == 0:
+                if self.verbose >= 1 and n_ended > 0 and log_interval is not None and \
+                        num_episodes // log_interval > (num_episodes - n_ended) // log_interval:
                     fps = int(step / (time.time() - start_time))
                     logger.logkv("episodes", num_episodes)
                     logger.logkv("mean 100 episode reward", mean_reward)
@@ -543,6 +753,9 @@ class SAC(OffPolicyRLModel):
             # with all transition inside
             # "replay_buffer": self.replay_buffer
             "gamma": self.gamma,
+            "n_step": self.n_step,
+            "prefetch_batches": self.prefetch_batches,
+            "fused_gradient_steps": self.fused_gradient_steps,
             "verbose": self.verbose,
             "observation_space": self.observation_space,
             "action_space": self.action_space,
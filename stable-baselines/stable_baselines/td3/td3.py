@@ -9,7 +9,7 @@ from stable_baselines.a2c.utils import total_episode_reward_logger
 from stable_baselines.common import tf_util, OffPolicyRLModel, SetVerbosity, TensorboardWriter
 from stable_baselines.common.vec_env import VecEnv
 from stable_baselines.common.math_util import unscale_action, scale_action
-from stable_baselines.deepq.replay_buffer import ReplayBuffer
+from stable_baselines.deepq.replay_buffer import ReplayBuffer, NStepReplayBuffer
 from stable_baselines.ppo2.ppo2 import safe_mean, get_schedule_fn
 from stable_baselines.sac.sac import get_vars
 from stable_baselines.td3.policies import TD3Policy
@@ -26,7 +26,8 @@ class TD3(OffPolicyRLModel):
     Introduction to TD3: https://spinningup.openai.com/en/latest/algorithms/td3.html
 
     :param policy: (TD3Policy or str) The policy model to use (MlpPolicy, CnnPolicy, LnMlpPolicy, ...)
-    :param env: (Gym environment or str) The environment to learn from (if registered in Gym, can be str)
+    :param env: (Gym environment or str) The environment to learn from (if registered in Gym, can be str),
+        or a VecEnv with several environments
     :param gamma: (float) the discount factor
     :param learning_rate: (float or callable) learning rate for adam optimizer,
         the same learning rate will be used for all networks (Q-Values and Actor networks)
@@ -41,6 +42,7 @@ class TD3(OffPolicyRLModel):
         (smoothing noise)
     :param target_noise_clip: (float) Limit for absolute value of target policy smoothing noise.
     :param train_freq: (int) Update the model every `train_freq` steps.
+        Steps are env steps: a step of a VecEnv is `n_envs` steps.
     :param learning_starts: (int) how many steps of the model to collect transitions for before learning starts
     :param gradient_steps: (int) How many gradient update after each step
     :param random_exploration: (float) Probability of taking a random action (as in an epsilon-greedy strategy)
@@ -57,6 +59,13 @@ class TD3(OffPolicyRLModel):
         results, you must set `n_cpu_tf_sess` to 1.
     :param n_cpu_tf_sess: (int) The number of threads for TensorFlow operations
         If None, the number of cpu of the current machine will be used.
+    :param n_step: (int) the number of rewards in the targets (n-step returns), uses a NStepReplayBuffer if > 1
+    :param fused_gradient_steps: (int) number of gradient steps (with their policy and target updates) run in a single
+        session call, on as many minibatches sampled at once. The gradient steps that do not fill a session call
+        are run with the next training rounds. It must be a multiple of `policy_delay`.
+    :param prefetch_batches: (int) number of minibatches sampled ahead from the replay buffer on a background thread
+        (0 to sample them synchronously). The prefetched minibatches depend on the thread scheduling,
+        so a seeded run is not exactly reproducible with prefetching
     """
     def __init__(self, policy, env, gamma=0.99, learning_rate=3e-4, buffer_size=50000,
                  learning_starts=100, train_freq=100, gradient_steps=100, batch_size=128,
@@ -64,11 +73,12 @@ class TD3(OffPolicyRLModel):
                  target_policy_noise=0.2, target_noise_clip=0.5,
                  random_exploration=0.0, verbose=0, tensorboard_log=None,
                  _init_setup_model=True, policy_kwargs=None,
-                 full_tensorboard_log=False, seed=None, n_cpu_tf_sess=None):
+                 full_tensorboard_log=False, seed=None, n_cpu_tf_sess=None, n_step=1, fused_gradient_steps=1,
+                 prefetch_batches=0):
 
         super(TD3, self).__init__(policy=policy, env=env, replay_buffer=None, verbose=verbose,
                                   policy_base=TD3Policy, requires_vec_env=False, policy_kwargs=policy_kwargs,
-                                  seed=seed, n_cpu_tf_sess=n_cpu_tf_sess)
+                                  seed=seed, n_cpu_tf_sess=n_cpu_tf_sess, supports_vec_env=True)
 
         self.buffer_size = buffer_size
         self.learning_rate = learning_rate
@@ -78,6 +88,9 @@ class TD3(OffPolicyRLModel):
         self.tau = tau
         self.gradient_steps = gradient_steps
         self.gamma = gamma
+        self.n_step = n_step
+        self.prefetch_batches = prefetch_batches
+        self.fused_gradient_steps = fused_gradient_steps
         self.action_noise = action_noise
         self.random_exploration = random_exploration
         self.policy_delay = policy_delay
@@ -99,6 +112,7 @@ class TD3(OffPolicyRLModel):
         self.actions_ph = None
         self.rewards_ph = None
         self.terminals_ph = None
+        self.discounts_ph = None
         self.observations_ph = None
         self.action_target = None
         self.next_observations_ph = None
@@ -112,6 +126,10 @@ class TD3(OffPolicyRLModel):
         self.policy_out = None
         self.policy_train_op = None
         self.policy_loss = None
+        self.fused_policy_tf = None
+        self.fused_target_policy_tf = None
+        self.fused_infos = None
+        self.fused_train_op = None
 
         if _init_setup_model:
             self.setup_model()
@@ -122,6 +140,50 @@ class TD3(OffPolicyRLModel):
         policy_out = unscale_action(self.action_space, self.policy_out)
         return policy.obs_ph, self.actions_ph, policy_out
 
+    def _smoothed_target_action(self, target_policy_out):
+        """
+        Target policy smoothing, by adding clipped noise to target actions
+
+        :param target_policy_out: (TensorFlow Tensor) the actions of the target policy
+        :return: (TensorFlow Tensor) the noisy target actions
+        """
+        target_noise = tf.random_normal(tf.shape(target_policy_out), stddev=self.target_policy_noise)
+        target_noise = tf.clip_by_value(target_noise, -self.target_noise_clip, self.target_noise_clip)
+        # Clip the noisy action to remain in the bounds [-1, 1] (output of a tanh)
+        return tf.clip_by_value(target_policy_out + target_noise, -1, 1)
+
+    def _make_losses(self, qf1, qf2, qf1_pi, qf1_target, qf2_target, rewards, terminals, discounts):
+        """
+        Create the losses of a training step
+
+        :param qf1: (TensorFlow Tensor) the first Q-Values of the actions
+        :param qf2: (TensorFlow Tensor) the second Q-Values of the actions
+        :param qf1_pi: (TensorFlow Tensor) the first Q-Values of the policy actions
+        :param qf1_target: (TensorFlow Tensor) the first target Q-Values of the next observations
+        :param qf2_target: (TensorFlow Tensor) the second target Q-Values of the next observations
+        :param rewards: (TensorFlow Tensor) the rewards
+        :param terminals: (TensorFlow Tensor) whether the episodes are done
+        :param discounts: (TensorFlow Tensor) the discounts of the next values
+        :return: (TensorFlow Tensor, TensorFlow Tensor, TensorFlow Tensor) the first Q-Value, second Q-Value
+            and policy losses
+        """
+        # Take the min of the two target Q-Values (clipped Double-Q Learning)
+        min_qf_target = tf.minimum(qf1_target, qf2_target)
+
+        # Targets for Q value regression
+        q_backup = tf.stop_gradient(
+            rewards +
+            (1 - terminals) * discounts * min_qf_target
+        )
+
+        # Compute Q-Function loss
+        qf1_loss = tf.reduce_mean((q_backup - qf1) ** 2)
+        qf2_loss = tf.reduce_mean((q_backup - qf2) ** 2)
+
+        # Policy loss: maximise q value
+        policy_loss = -tf.reduce_mean(qf1_pi)
+        return qf1_loss, qf2_loss, policy_loss
+
     def setup_model(self):
         with SetVerbosity(self.verbose):
             self.graph = tf.Graph()
@@ -129,7 +191,10 @@ class TD3(OffPolicyRLModel):
                 self.set_random_seed(self.seed)
                 self.sess = tf_util.make_session(num_cpu=self.n_cpu_tf_sess, graph=self.graph)
 
-                self.replay_buffer = ReplayBuffer(self.buffer_size)
+                if self.n_step > 1:
+                    self.replay_buffer = NStepReplayBuffer(self.buffer_size, n_step=self.n_step, gamma=self.gamma)
+                else:
+                    self.replay_buffer = ReplayBuffer(self.buffer_size)
 
                 with tf.variable_scope("input", reuse=False):
                     # Create policy and target TF objects
@@ -147,6 +212,9 @@ class TD3(OffPolicyRLModel):
                     self.action_target = self.target_policy_tf.action_ph
                     self.terminals_ph = tf.placeholder(tf.float32, shape=(None, 1), name='terminals')
                     self.rewards_ph = tf.placeholder(tf.float32, shape=(None, 1), name='rewards')
+                    # Discount of the next value, fed for n-step transitions
+                    self.discounts_ph = tf.placeholder_with_default(self.gamma * tf.ones_like(self.terminals_ph),
+                                                                    shape=(None, 1), name='discounts')
                     self.actions_ph = tf.placeholder(tf.float32, shape=(None,) + self.action_space.shape,
                                                      name='actions')
                     self.learning_rate_ph = tf.placeholder(tf.float32, [], name="learning_rate_ph")
@@ -163,33 +231,17 @@ class TD3(OffPolicyRLModel):
                 with tf.variable_scope("target", reuse=False):
                     # Create target networks
                     target_policy_out = self.target_policy_tf.make_actor(self.processed_next_obs_ph)
-                    # Target policy smoothing, by adding clipped noise to target actions
-                    target_noise = tf.random_normal(tf.shape(target_policy_out), stddev=self.target_policy_noise)
-                    target_noise = tf.clip_by_value(target_noise, -self.target_noise_clip, self.target_noise_clip)
-                    # Clip the noisy action to remain in the bounds [-1, 1] (output of a tanh)
-                    noisy_target_action = tf.clip_by_value(target_policy_out + target_noise, -1, 1)
+                    noisy_target_action = self._smoothed_target_action(target_policy_out)
                     # Q values when following the target policy
                     qf1_target, qf2_target = self.target_policy_tf.make_critics(self.processed_next_obs_ph,
                                                                                 noisy_target_action)
 
                 with tf.variable_scope("loss", reuse=False):
-                    # Take the min of the two target Q-Values (clipped Double-Q Learning)
-                    min_qf_target = tf.minimum(qf1_target, qf2_target)
-
-                    # Targets for Q value regression
-                    q_backup = tf.stop_gradient(
-                        self.rewards_ph +
-                        (1 - self.terminals_ph) * self.gamma * min_qf_target
-                    )
-
-                    # Compute Q-Function loss
-                    qf1_loss = tf.reduce_mean((q_backup - qf1) ** 2)
-                    qf2_loss = tf.reduce_mean((q_backup - qf2) ** 2)
-
+                    qf1_loss, qf2_loss, policy_loss = self._make_losses(qf1, qf2, qf1_pi, qf1_target, qf2_target,
+                                                                        self.rewards_ph, self.terminals_ph,
+                                                                        self.discounts_ph)
                     qvalues_losses = qf1_loss + qf2_loss
-
-                    # Policy loss: maximise q value
-                    self.policy_loss = policy_loss = -tf.reduce_mean(qf1_pi)
+                    self.policy_loss = policy_loss
 
                     # Policy train op
                     # will be called only every n training steps,
@@ -231,6 +283,9 @@ class TD3(OffPolicyRLModel):
                     tf.summary.scalar('qf2_loss', qf2_loss)
                     tf.summary.scalar('learning_rate', tf.reduce_mean(self.learning_rate_ph))
 
+                if self.fused_gradient_steps > 1:
+                    self._setup_fused_train(policy_optimizer, qvalues_optimizer)
+
                 # Retrieve parameters that must be saved
                 self.params = get_vars("model")
                 self.target_params = get_vars("target/")
@@ -242,10 +297,112 @@ class TD3(OffPolicyRLModel):
 
                 self.summary = tf.summary.merge_all()
 
+    def _setup_fused_train(self, policy_optimizer, qvalues_optimizer):
+        """
+        Create the ops running `fused_gradient_steps` training steps in a single session call,
+        each on its own minibatch of a batch of `fused_gradient_steps * batch_size` transitions.
+        The policy and target networks are updated every `policy_delay` steps. The steps are chained
+        with control dependencies, and read the variables after the updates of the previous step.
+
+        :param policy_optimizer: (TensorFlow Optimizer) the optimizer of the policy
+        :param qvalues_optimizer: (TensorFlow Optimizer) the optimizer of the Q-Values
+        """
+        assert self.fused_gradient_steps % self.policy_delay == 0, \
+            "fused_gradient_steps must be a multiple of policy_delay"
+
+        with tf.variable_scope("input", reuse=False):
+            # Separate policy objects, as make_actor and make_critics keep their last outputs
+            self.fused_policy_tf = self.policy(self.sess, self.observation_space, self.action_space,
+                                               **self.policy_kwargs)
+            self.fused_target_policy_tf = self.policy(self.sess, self.observation_space, self.action_space,
+                                                      **self.policy_kwargs)
+
+        source_params = get_vars("model/")
+        target_params = get_vars("target/")
+        step_infos = []
+        last_ops = []
+        for k in range(self.fused_gradient_steps):
+            minibatch = slice(k * self.batch_size, (k + 1) * self.batch_size)
+            obs = self.fused_policy_tf.processed_obs[minibatch]
+            next_obs = self.fused_target_policy_tf.processed_obs[minibatch]
+            with tf.control_dependencies(last_ops):
+                with tf.variable_scope("model", reuse=True, custom_getter=tf_util.fresh_read_getter):
+                    policy_out = self.fused_policy_tf.make_actor(obs, reuse=True)
+                    qf1, qf2 = self.fused_policy_tf.make_critics(obs, self.actions_ph[minibatch], reuse=True)
+                    qf1_pi, _ = self.fused_policy_tf.make_critics(obs, policy_out, reuse=True)
+
+                with tf.variable_scope("target", reuse=True, custom_getter=tf_util.fresh_read_getter):
+                    target_policy_out = self.fused_target_policy_tf.make_actor(next_obs, reuse=True)
+                    noisy_target_action = self._smoothed_target_action(target_policy_out)
+                    qf1_target, qf2_target = self.fused_target_policy_tf.make_critics(next_obs, noisy_target_action,
+                                                                                      reuse=True)
+
+                qf1_loss, qf2_loss, policy_loss = self._make_losses(qf1, qf2, qf1_pi, qf1_target, qf2_target,
+                                                                    self.rewards_ph[minibatch],
+                                                                    self.terminals_ph[minibatch],
+                                                                    self.discounts_ph[minibatch])
+                last_ops = [qvalues_optimizer.minimize(qf1_loss + qf2_loss, var_list=get_vars('model/values_fn/'))]
+                step_infos.append(tf.stack([qf1_loss, qf2_loss]))
+
+                if (k + 1) % self.policy_delay == 0:
+                    # Update policy and target networks
+                    with tf.control_dependencies(last_ops):
+                        policy_train_op = policy_optimizer.minimize(policy_loss, var_list=get_vars('model/pi'))
+                    with tf.control_dependencies([policy_train_op]):
+                        # Polyak averaging for target variables
+                        last_ops = [
+                            tf.assign(target, (1 - self.tau) * target.read_value() + self.tau * source.read_value())
+                            for target, source in zip(target_params, source_params)
+                        ]
+
+        self.fused_infos = tf.stack(step_infos)
+        self.fused_train_op = tf.group(*last_ops)
+
+    def _fused_train_steps(self, step, writer, learning_rate):
+        """
+        Run `fused_gradient_steps` training steps in a single session call,
+        on minibatches sampled at once from the replay buffer
+
+        :param step: (int) the current step iteration
+        :param writer: (TensorFlow Summary.writer) the writer for tensorboard
+        :param learning_rate: (float) the learning rate
+        :return: (np.ndarray) the Q-Value losses of each training step (cf ``infos_names``)
+        """
+        n_samples = self.fused_gradient_steps * self.batch_size
+        batch = self.replay_buffer.sample(n_samples)
+        batch_obs, batch_actions, batch_rewards, batch_next_obs, batch_dones, *batch_discounts = batch
+
+        feed_dict = {
+            self.fused_policy_tf.obs_ph: batch_obs,
+            self.actions_ph: batch_actions,
+            self.fused_target_policy_tf.obs_ph: batch_next_obs,
+            self.rewards_ph: batch_rewards.reshape(n_samples, -1),
+            self.terminals_ph: batch_dones.reshape(n_samples, -1),
+            self.learning_rate_ph: learning_rate
+        }
+        if batch_discounts:
+            feed_dict[self.discounts_ph] = batch_discounts[0].reshape(n_samples, -1)
+
+        if writer is not None:
+            # The summaries are computed on the first minibatch, before the updates, as with a single training step
+            summary_feed_dict = {
+                self.observations_ph: batch_obs[:self.batch_size],
+                self.actions_ph: batch_actions[:self.batch_size],
+                self.next_observations_ph: batch_next_obs[:self.batch_size],
+                self.rewards_ph: feed_dict[self.rewards_ph][:self.batch_size],
+                self.terminals_ph: feed_dict[self.terminals_ph][:self.batch_size],
+                self.learning_rate_ph: learning_rate
+            }
+            if batch_discounts:
+                summary_feed_dict[self.discounts_ph] = feed_dict[self.discounts_ph][:self.batch_size]
+            writer.add_summary(self.sess.run(self.summary, summary_feed_dict), step)
+        infos, _ = self.sess.run([self.fused_infos, self.fused_train_op], feed_dict)
+        return infos
+
     def _train_step(self, step, writer, learning_rate, update_policy):
         # Sample a batch from the replay buffer
         batch = self.replay_buffer.sample(self.batch_size)
-        batch_obs, batch_actions, batch_rewards, batch_next_obs, batch_dones = batch
+        batch_obs, batch_actions, batch_rewards, batch_next_obs, batch_dones, *batch_discounts = batch
 
         feed_dict = {
             self.observations_ph: batch_obs,
@@ -255,6 +412,8 @@ class TD3(OffPolicyRLModel):
             self.terminals_ph: batch_dones.reshape(self.batch_size, -1),
             self.learning_rate_ph: learning_rate
         }
+        if batch_discounts:
+            feed_dict[self.discounts_ph] = batch_discounts[0].reshape(self.batch_size, -1)
 
         step_ops = self.step_ops
         if update_policy:
@@ -284,7 +443,7 @@ class TD3(OffPolicyRLModel):
             self.replay_buffer = replay_wrapper(self.replay_buffer)
 
         with SetVerbosity(self.verbose), TensorboardWriter(self.graph, self.tensorboard_log, tb_log_name, new_tb_log) \
-                as writer:
+                as writer, self._prefetch_replay(self.fused_gradient_steps * self.batch_size, self.prefetch_batches):
 
             self._setup_learn()
 
@@ -300,9 +459,14 @@ class TD3(OffPolicyRLModel):
                 self.action_noise.reset()
             obs = self.env.reset()
             n_updates = 0
+            # Gradient steps due, not run yet
+            grad_steps_due = 0
             infos_values = []
+            # With several environments, each step of the VecEnv is n_envs env steps
+            vec_env = self.n_envs > 1
+            running_rewards = np.zeros(self.n_envs)
 
-            for step in range(total_timesteps):
+            for step in range(0, total_timesteps, self.n_envs):
                 if callback is not None:
                     # Only stop training if return value is False, not when it is None. This is for backwards
                     # compatibility with callbacks that have no return statement.
@@ -316,50 +480,75 @@ class TD3(OffPolicyRLModel):
                 if self.num_timesteps < self.learning_starts or np.random.rand() < self.random_exploration:
                     # actions sampled from action space are from range specific to the environment
                     # but algorithm operates on tanh-squashed actions therefore simple scaling is used
-                    unscaled_action = self.env.action_space.sample()
+                    if vec_env:
+                        unscaled_action = np.array([self.env.action_space.sample() for _ in range(self.n_envs)])
+                    else:
+                        unscaled_action = self.env.action_space.sample()
                     action = scale_action(self.action_space, unscaled_action)
                 else:
-                    action = self.policy_tf.step(obs[None]).flatten()
+                    if vec_env:
+                        # One forward pass for all the envs
+                        action = self.policy_tf.step(obs)
+                    else:
+                        action = self.policy_tf.step(obs[None]).flatten()
                     # Add noise to the action, as the policy
                     # is deterministic, this is required for exploration
                     if self.action_noise is not None:
-                        action = np.clip(action + self.action_noise(), -1, 1)
+                        noise = np.array([self.action_noise() for _ in range(self.n_envs)]) if vec_env \
+                            else self.action_noise()
+                        action = np.clip(action + noise, -1, 1)
                     # Rescale from [-1, 1] to the correct bounds
                     unscaled_action = unscale_action(self.action_space, action)
 
-                assert action.shape == self.env.action_space.shape
+                if vec_env:
+                    assert action.shape == (self.n_envs,) + self.env.action_space.shape
+                else:
+                    assert action.shape == self.env.action_space.shape
 
                 new_obs, reward, done, info = self.env.step(unscaled_action)
 
                 # Store transition in the replay buffer.
-                self.replay_buffer.add(obs, action, reward, new_obs, float(done))
+                if vec_env:
+                    self._store_vec_transitions(obs, action, reward, new_obs, done, info)
+                else:
+                    self.replay_buffer.add(obs, action, reward, new_obs, float(done))
                 obs = new_obs
 
                 # Retrieve reward and episode length if using Monitor wrapper
-                maybe_ep_info = info.get('episode')
-                if maybe_ep_info is not None:
-                    self.ep_info_buf.extend([maybe_ep_info])
+                for env_info in (info if vec_env else [info]):
+                    maybe_ep_info = env_info.get('episode')
+                    if maybe_ep_info is not None:
+                        self.ep_info_buf.extend([maybe_ep_info])
 
                 if writer is not None:
                     # Write reward per episode to tensorboard
-                    ep_reward = np.array([reward]).reshape((1, -1))
-                    ep_done = np.array([done]).reshape((1, -1))
+                    ep_reward = np.array([reward]).reshape((self.n_envs, -1))
+                    ep_done = np.array([done]).reshape((self.n_envs, -1))
                     total_episode_reward_logger(self.episode_reward, ep_reward,
                                                 ep_done, writer, self.num_timesteps)
 
-                if step % self.train_freq == 0:
+                # train_freq and gradient_steps are in env steps
+                train_rounds = self._train_rounds(step, self.train_freq)
+                if train_rounds > 0:
                     mb_infos_vals = []
+                    # Skip the gradient steps if the warmup phase is not over
+                    # or if there are not enough samples in the replay buffer
+                    if self.replay_buffer.can_sample(self.fused_gradient_steps * self.batch_size) \
+                            and self.num_timesteps >= self.learning_starts:
+                        grad_steps_due += self.gradient_steps * train_rounds
+                    # Run the gradient steps fused_gradient_steps at a time, the remaining ones in the next rounds
+                    n_grad_steps = grad_steps_due - grad_steps_due % self.fused_gradient_steps
+                    grad_steps_due -= n_grad_steps
                     # Update policy, critics and target networks
-                    for grad_step in range(self.gradient_steps):
-                        # Break if the warmup phase is not over
-                        # or if there are not enough samples in the replay buffer
-                        if not self.replay_buffer.can_sample(self.batch_size) \
-                                or self.num_timesteps < self.learning_starts:
-                            break
-                        n_updates += 1
+                    for grad_step in range(0, n_grad_steps, self.fused_gradient_steps):
+                        n_updates += self.fused_gradient_steps
                         # Compute current learning_rate
                         frac = 1.0 - step / total_timesteps
                         current_lr = self.learning_rate(frac)
+                        if self.fused_gradient_steps > 1:
+                            # Update critics, policy and target networks for several steps in one call
+                            mb_infos_vals.extend(self._fused_train_steps(step, writer, current_lr))
+                            continue
                         # Update policy and critics (q functions)
                         # Note: the policy is updated less frequently than the Q functions
                         # this is controlled by the `policy_delay` parameter
@@ -370,17 +559,24 @@ class TD3(OffPolicyRLModel):
                     if len(mb_infos_vals) > 0:
                         infos_values = np.mean(mb_infos_vals, axis=0)
 
-                episode_rewards[-1] += reward
-                if done:
-                    if self.action_noise is not None:
+                if vec_env:
+                    n_ended = self._vec_episodes_bookkeeping(running_rewards, reward, done, info,
+                                                             episode_rewards, episode_successes)
+                    if n_ended > 0 and self.action_noise is not None:
                         self.action_noise.reset()
-                    if not isinstance(self.env, VecEnv):
-                        obs = self.env.reset()
-                    episode_rewards.append(0.0)
-
-                    maybe_is_success = info.get('is_success')
-                    if maybe_is_success is not None:
-                        episode_successes.append(float(maybe_is_success))
+                else:
+                    n_ended = int(done)
+                    episode_rewards[-1] += reward
+                    if done:
+                        if self.action_noise is not None:
+                            self.action_noise.reset()
+                        if not isinstance(self.env, VecEnv):
+                            obs = self.env.reset()
+                        episode_rewards.append(0.0)
+
+                        maybe_is_success = info.get('is_success')
+                        if maybe_is_success is not None:
+                            episode_successes.append(float(maybe_is_success))
 
                 if len(episode_rewards[-101:-1]) == 0:
                     mean_reward = -np.inf
@@ -388,9 +584,10 @@ class TD3(OffPolicyRLModel):
                     mean_reward = round(float(np.mean(episode_rewards[-101:-1])), 1)
 
                 num_episodes = len(episode_rewards)
-                self.num_timesteps += 1
+                self.num_timesteps += self.n_envs
                 # Display training infos
-                if self.verbose >= 1 and done and log_interval is not None and len(episode_rewards) % log_interval == 0:
+                if self.verbose >= 1 and n_ended > 0 and log_interval is not None and \
+                        num_episodes // log_interval > (num_episodes - n_ended) // log_interval:
                     fps = int(step / (time.time() - start_time))
                     logger.logkv("episodes", num_episodes)
                     logger.logkv("mean 100 episode reward", mean_reward)
@@ -460,6 +657,9 @@ class TD3(OffPolicyRLModel):
             "target_noise_clip": self.target_noise_clip,
             "target_policy_noise": self.target_policy_noise,
             "gamma": self.gamma,
+            "n_step": self.n_step,
+            "prefetch_batches": self.prefetch_batches,
+            "fused_gradient_steps": self.fused_gradient_steps,
             "verbose": self.verbose,
             "observation_space": self.observation_space,
             "action_space": self.action_space,
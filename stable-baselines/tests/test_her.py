@@ -1,10 +1,12 @@
 import os
 
+import numpy as np
 import pytest
 
 from stable_baselines import HER, DQN, SAC, DDPG, TD3
 from stable_baselines.her import GoalSelectionStrategy, HERGoalEnvWrapper
-from stable_baselines.her.replay_buffer import KEY_TO_GOAL_STRATEGY
+from stable_baselines.her.replay_buffer import KEY_TO_GOAL_STRATEGY, HindsightExperienceReplayWrapper
+from stable_baselines.deepq.replay_buffer import ReplayBuffer
 from stable_baselines.common.bit_flipping_env import BitFlippingEnv
 from stable_baselines.common.vec_env import DummyVecEnv, VecNormalize
 
@@ -45,6 +47,102 @@ def test_her(model_class, goal_selection_strategy, discrete_obs_space):
     model.learn(1000)
 
 
+
+@pytest.mark.parametrize('goal_selection_strategy', list(GoalSelectionStrategy))
+@pytest.mark.parametrize('discrete_obs_space', [False, True])
+def test_her_relabelling(goal_selection_strategy, discrete_obs_space):
+    """
+    Check the artificial transitions stored at the end of the episodes
+    """
+    env = HERGoalEnvWrapper(BitFlippingEnv(N_BITS, max_steps=N_BITS, discrete_obs_space=discrete_obs_space))
+    replay_buffer = HindsightExperienceReplayWrapper(ReplayBuffer(1000), 4, goal_selection_strategy, env)
+    for _ in range(3):
+        obs, done = env.reset(), False
+        while not done:
+            action = env.action_space.sample()
+            new_obs, reward, done, _ = env.step(action)
+            replay_buffer.add(obs, action, reward, new_obs, done)
+            obs = new_obs
+
+    n_relabelled = N_BITS - 1 if goal_selection_strategy == GoalSelectionStrategy.FUTURE else N_BITS
+    assert len(replay_buffer) == 3 * (N_BITS + 4 * n_relabelled)
+    for obs_t, _, reward, obs_tp1, _ in (replay_buffer.storage[i] for i in range(len(replay_buffer))):
+        obs_dict, next_obs_dict = map(env.convert_obs_to_dict, (obs_t, obs_tp1))
+        assert np.all(obs_dict['desired_goal'] == next_obs_dict['desired_goal'])
+        assert reward == env.compute_reward(next_obs_dict['desired_goal'], next_obs_dict['achieved_goal'], None)
+
+
+class VectorizedBitFlippingEnv(BitFlippingEnv):
+    """
+    BitFlippingEnv computing the rewards of batches of goals
+    """
+
+    def compute_reward(self, achieved_goal, desired_goal, _info):
+        return np.where(np.all(achieved_goal == desired_goal, axis=-1), 0.0, -1.0)
+
+
+@pytest.mark.parametrize('lazy_relabelling', [False, True])
+def test_her_vectorized_reward(lazy_relabelling):
+    """
+    Check that the rewards computed in batches match the rewards computed one by one,
+    and that an env that does not compute one reward per goal is refused
+    """
+    for env_class in [VectorizedBitFlippingEnv, BitFlippingEnv]:
+        env = HERGoalEnvWrapper(env_class(N_BITS, max_steps=N_BITS))
+        replay_buffer = HindsightExperienceReplayWrapper(ReplayBuffer(1000), 4, GoalSelectionStrategy.FUTURE, env,
+                                                         lazy_relabelling=lazy_relabelling, vectorized_reward=True)
+
+        def add_episodes():
+            for _ in range(3):
+                obs, done = env.reset(), False
+                while not done:
+                    action = env.action_space.sample()
+                    new_obs, reward, done, _ = env.step(action)
+                    replay_buffer.add(obs, action, reward, new_obs, done)
+                    obs = new_obs
+            return replay_buffer.sample(200) if lazy_relabelling else replay_buffer.replay_buffer.sample(200)
+
+        if env_class is BitFlippingEnv:
+            # A single reward for the whole batch
+            with pytest.raises(ValueError):
+                add_episodes()
+            continue
+        obs_t, _, rewards, obs_tp1, _ = add_episodes()
+        for obs, reward, next_obs in zip(obs_t, rewards, obs_tp1):
+            next_obs_dict = env.convert_obs_to_dict(next_obs)
+            assert reward == BitFlippingEnv.compute_reward(env.env, next_obs_dict['desired_goal'],
+                                                           next_obs_dict['achieved_goal'], None)
+
+
+@pytest.mark.parametrize('goal_selection_strategy', list(GoalSelectionStrategy))
+def test_her_lazy_relabelling(goal_selection_strategy):
+    """
+    Check that lazy relabelling only stores the real transitions and relabels them when sampling
+    """
+    env = HERGoalEnvWrapper(BitFlippingEnv(N_BITS, max_steps=N_BITS))
+    replay_buffer = HindsightExperienceReplayWrapper(ReplayBuffer(1000), 4, goal_selection_strategy, env,
+                                                     lazy_relabelling=True)
+    for _ in range(3):
+        obs, done = env.reset(), False
+        while not done:
+            action = env.action_space.sample()
+            new_obs, reward, done, _ = env.step(action)
+            replay_buffer.add(obs, action, reward, new_obs, done)
+            obs = new_obs
+    assert len(replay_buffer) == 3 * N_BITS
+
+    obs_t, _, rewards, obs_tp1, _ = replay_buffer.sample(200)
+    for obs, reward, next_obs in zip(obs_t, rewards, obs_tp1):
+        obs_dict, next_obs_dict = map(env.convert_obs_to_dict, (obs, next_obs))
+        assert np.all(obs_dict['desired_goal'] == next_obs_dict['desired_goal'])
+        assert reward == env.compute_reward(next_obs_dict['desired_goal'], next_obs_dict['achieved_goal'], None)
+    # The desired goal of the env is a vector of ones, relabelled goals are achieved goals
+    assert not np.all(obs_t[:, -N_BITS:] == 1)
+
+    model = HER('MlpPolicy', env.env, DQN, n_sampled_goal=4, goal_selection_strategy=goal_selection_strategy,
+                lazy_relabelling=True)
+    model.learn(200)
+
 @pytest.mark.parametrize('model_class', [DDPG, SAC, DQN, TD3])
 def test_long_episode(model_class):
     """
@@ -6,6 +6,7 @@ from stable_baselines.ddpg import NormalActionNoise
 from stable_baselines.common.identity_env import IdentityEnv, IdentityEnvBox
 from stable_baselines.common.vec_env import DummyVecEnv
 from stable_baselines.common.evaluation import evaluate_policy
+from stable_baselines.deepq.replay_buffer import NStepReplayBuffer
 
 
 # Hyperparameters for learning identity for each RL model
@@ -75,3 +76,89 @@ def test_identity_continuous(model_class):
     evaluate_policy(model, env, n_eval_episodes=20, reward_threshold=0.9)
     # Free memory
     del model, env
+
+
+@pytest.mark.parametrize("model_class", [DQN, DDPG, SAC, TD3])
+def test_n_step_returns(model_class):
+    """
+    Test that the off-policy algorithms train on n-step transitions
+
+    :param model_class: (BaseRLModel) A RL model
+    """
+    env = DummyVecEnv([lambda: IdentityEnv(10) if model_class == DQN else IdentityEnvBox(eps=0.5)])
+    kwargs = {} if model_class == DDPG else {'learning_starts': 100}
+    model = model_class("MlpPolicy", env, n_step=3, seed=0, **kwargs)
+    model.learn(total_timesteps=500)
+
+    assert isinstance(model.replay_buffer, NStepReplayBuffer) and len(model.replay_buffer) > 0
+    *_, dones, discounts = model.replay_buffer.sample(64)
+    assert np.allclose(discounts[dones == 0], model.gamma ** 3)
+
+
+@pytest.mark.parametrize("model_class", [DQN, SAC, TD3])
+def test_off_policy_vec_env(model_class):
+    """
+    Test that the off-policy algorithms learn from a VecEnv with several environments,
+    storing one transition per env step
+
+    :param model_class: (BaseRLModel) A RL model
+    """
+    n_envs = 4
+    env = DummyVecEnv([lambda: IdentityEnv(10) if model_class == DQN else IdentityEnvBox(eps=0.5)] * n_envs)
+    model = model_class("MlpPolicy", env, learning_starts=100, train_freq=2, seed=0)
+    assert model.n_envs == n_envs
+    model.learn(total_timesteps=1000)
+
+    assert model.num_timesteps == 1000
+    assert len(model.replay_buffer) == 1000
+    action, _ = model.predict(env.reset())
+    assert action.shape == (n_envs,) + env.action_space.shape
+
+    with pytest.raises(ValueError):
+        DDPG("MlpPolicy", DummyVecEnv([lambda: IdentityEnvBox(eps=0.5)] * n_envs))
+
+
+@pytest.mark.parametrize("model_class", [SAC, TD3])
+def test_fused_gradient_steps(model_class, tmp_path):
+    """
+    Test that SAC and TD3 run several gradient steps per session call
+
+    :param model_class: (BaseRLModel) A RL model
+    """
+    env = DummyVecEnv([lambda: IdentityEnvBox(eps=0.5)])
+    model = model_class("MlpPolicy", env, learning_starts=100, train_freq=4, gradient_steps=4,
+                        fused_gradient_steps=4, seed=0)
+    params = model.get_parameters()
+    model.learn(total_timesteps=500)
+
+    new_params = model.get_parameters()
+    assert any(not np.allclose(params[name], new_params[name]) for name in params)
+    model.save(str(tmp_path / "model"))
+    assert model_class.load(str(tmp_path / "model")).fused_gradient_steps == 4
+
+
+@pytest.mark.parametrize("model_class", [SAC, TD3])
+def test_fused_gradient_steps_count(model_class):
+    """
+    Test that fusing the gradient steps keeps their number (the update-to-data ratio)
+
+    :param model_class: (BaseRLModel) A RL model
+    """
+    n_grad_steps = {}
+    for fused_gradient_steps in [1, 4]:
+        model = model_class("MlpPolicy", DummyVecEnv([lambda: IdentityEnvBox(eps=0.5)]), learning_starts=100,
+                            batch_size=16, fused_gradient_steps=fused_gradient_steps, seed=0)
+        n_grad_steps[fused_gradient_steps] = 0
+
+        def _count(train_fn, n_steps, fused=fused_gradient_steps):
+            def _counted_train_fn(*args, **kwargs):
+                n_grad_steps[fused] += n_steps
+                return train_fn(*args, **kwargs)
+            return _counted_train_fn
+
+        model._train_step = _count(model._train_step, 1)
+        model._fused_train_steps = _count(model._fused_train_steps, fused_gradient_steps)
+        model.learn(total_timesteps=300)
+    # The last gradient steps that do not fill a fused call are not run
+    assert n_grad_steps[1] - 4 < n_grad_steps[4] <= n_grad_steps[1]
+    assert n_grad_steps[4] % 4 == 0
@@ -1,7 +1,13 @@
+import json
+import os
+import threading
+
 import pytest
 import numpy as np
 
-from stable_baselines.logger import make_output_format, read_tb, read_csv, read_json, _demo
+from stable_baselines.logger import make_output_format, read_tb, read_csv, read_json, _demo, Profiler, \
+    dumpkvs, logkv, read_logs, CSVOutputFormat, KVWriter, Logger, StreamingHistogram, configure, reset, LOG_CACHE_EXT, \
+    ScopedConfigure, _close_at_exit
 from .test_common import _maybe_disable_mpi
 
 
@@ -44,9 +50,267 @@ def test_make_output(_format, mpi_disabled):
         writer.close()
 
 
+def test_csv_output_format_new_keys(tmp_path):
+    """
+    test that the csv log is only appended to when new keys appear (sorted), and gets the full header when closed
+    """
+    filename = str(tmp_path / "progress.csv")
+    writer = CSVOutputFormat(filename, flush_interval=0)
+    writer.writekvs({"a": 1})
+    writer.writekvs({"a": 2, "b": [3, 4]})
+    with open(filename) as file_handler:
+        first_rows = file_handler.read()
+    writer.writekvs({"d": 6, "c": 5})
+    with open(filename) as file_handler:
+        # The previous rows are not rewritten
+        assert file_handler.read().startswith(first_rows)
+    assert first_rows.startswith("a\n")
+    with open(filename + CSVOutputFormat.KEYS_EXT) as file_handler:
+        assert file_handler.read() == "a,b\na,b,c,d\n"
+    data = read_csv(filename)
+    assert list(data.columns) == ["a", "b", "c", "d"]
+    assert data["a"].tolist()[:2] == [1, 2] and np.isnan(data["a"][2])
+    assert data["b"].tolist()[1] == "[3, 4]" and data["b"].isnull()[2]
+    assert np.isnan(data["c"][:2]).all() and data["c"][2] == 5
+    assert np.isnan(data["d"][:2]).all() and data["d"][2] == 6
+
+    writer.close()
+    with open(filename) as file_handler:
+        assert file_handler.readline() == "a,b,c,d\n"
+    assert sorted(os.listdir(str(tmp_path))) == ["progress.csv"]
+    assert read_csv(filename).equals(data)
+
+
 def test_make_output_fail():
     """
     test value error on logger
     """
     with pytest.raises(ValueError):
         make_output_format('dummy_format', LOG_DIR)
+
+
+class _CaptureWriter(KVWriter):
+    def __init__(self):
+        self.kvs = []
+        self.histograms = []
+        self.closed = False
+
+    def writehistograms(self, histograms):
+        self.histograms.append(histograms)
+
+    def writekvs(self, kvs):
+        self.kvs.append(kvs)
+
+    def close(self):
+        self.closed = True
+
+
+def test_profiler(tmp_path):
+    """
+    test that the profiler logs the time spent in scopes and writes a valid Chrome trace
+    """
+    writer = _CaptureWriter()
+    Logger.CURRENT = Logger(folder=None, output_formats=[writer])
+    trace_path = str(tmp_path / "trace.json")
+    profiler = Profiler(trace_path=trace_path)
+    for _ in range(3):
+        with profiler("scope"):
+            pass
+    with profiler("other_scope"):
+        pass
+    profiler.close()
+    dumpkvs()
+    assert writer.kvs[-1]["time_scope"] >= 0
+    assert "time_other_scope" in writer.kvs[-1]
+    with open(trace_path) as file_handler:
+        events = json.load(file_handler)
+    assert [event["name"] for event in events] == ["scope"] * 3 + ["other_scope"]
+
+    disabled_profiler = Profiler(enabled=False, trace_path=trace_path)
+    with disabled_profiler("scope"):
+        pass
+    dumpkvs()
+    assert "time_scope" not in writer.kvs[-1]
+    reset()
+
+
+def test_profiler_threads():
+    """
+    test that the time recorded by another thread is not lost across the dumps
+    """
+    writer = _CaptureWriter()
+    Logger.CURRENT = Logger(folder=None, output_formats=[writer])
+    profiler = Profiler()
+    n_records = 10000
+
+    def record():
+        for _ in range(n_records):
+            profiler.record("env_step", 0.0, 1.0)
+
+    thread = threading.Thread(target=record)
+    thread.start()
+    while thread.is_alive():
+        dumpkvs()
+    thread.join()
+    dumpkvs()
+    reset()
+    assert len(writer.kvs) > 2
+    assert sum(kvs.get("time_env_step", 0) for kvs in writer.kvs) == n_records
+
+
+class _BlockingWriter(KVWriter):
+    def __init__(self):
+        self.kvs = []
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def writekvs(self, kvs):
+        self.writing.set()
+        self.release.wait()
+        self.kvs.append(kvs)
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('backpressure', ['block', 'drop'])
+def test_async_logger(tmp_path, backpressure):
+    """
+    test that the async logger writes the dumps in a background thread, and drains its queue when reset
+    """
+    configure(str(tmp_path), ['csv', 'log'], async_queue_size=2, backpressure=backpressure)
+    for step in range(20):
+        logkv("step", step)
+        logkv("loss", step / 10)
+        dumpkvs()
+    reset()
+    data = read_csv(str(tmp_path / "progress.csv"))
+    if backpressure == 'block':
+        assert data["step"].tolist() == list(range(20))
+
+    writer = _BlockingWriter()
+    async_logger = Logger(folder=None, output_formats=[writer], async_queue_size=1, backpressure=backpressure)
+    if backpressure == 'drop':
+        async_logger.logkv("step", 0)
+        async_logger.dumpkvs()
+        writer.writing.wait()
+        with pytest.warns(UserWarning):
+            for step in range(1, 5):
+                async_logger.logkv("step", step)
+                async_logger.dumpkvs()
+        # One dump being written and one in the queue
+        assert async_logger.n_dropped == 3
+    writer.release.set()
+    async_logger.flush()
+    async_logger.logkv("step", 5)
+    async_logger.dumpkvs()
+    async_logger.close()
+    assert [kvs["step"] for kvs in writer.kvs] == ([0, 1, 5] if backpressure == 'drop' else [5])
+
+
+def test_async_logger_close_at_exit(tmp_path):
+    """
+    test that ScopedConfigure passes the queue options, and that the async loggers and csv logs are closed at exit
+    """
+    with ScopedConfigure(str(tmp_path), ['csv'], async_queue_size=2, backpressure='drop'):
+        assert Logger.CURRENT._queue is not None and Logger.CURRENT.backpressure == 'drop'
+    assert Logger.CURRENT._queue is None
+
+    writer = _CaptureWriter()
+    async_logger = Logger(folder=None, output_formats=[writer], async_queue_size=2)
+    profiler = Profiler(trace_path=str(tmp_path / "trace.json"))
+    with profiler("scope"):
+        async_logger.logkv("step", 0)
+        async_logger.dumpkvs()
+    _close_at_exit()
+    assert [kvs["step"] for kvs in writer.kvs] == [0] and writer.closed
+    assert async_logger._writer_thread is None
+    with open(str(tmp_path / "trace.json")) as file_handler:
+        assert [event["name"] for event in json.load(file_handler)] == ["scope"]
+
+    csv_writer = CSVOutputFormat(str(tmp_path / "exit.csv"))
+    csv_writer.writekvs({"a": 1})
+    csv_writer.writekvs({"b": 2})
+    _close_at_exit()
+    with open(str(tmp_path / "exit.csv")) as file_handler:
+        assert file_handler.read() == "a,b\n1\n,2\n"
+    assert not os.path.exists(str(tmp_path / ("exit.csv" + CSVOutputFormat.KEYS_EXT)))
+
+
+def test_streaming_histogram():
+    """
+    test that the streaming histogram percentiles are within its relative accuracy
+    """
+    values = np.concatenate((np.random.lognormal(0, 2, size=10000), -np.random.lognormal(0, 1, size=1000),
+                             np.zeros(100)))
+    histogram = StreamingHistogram(relative_accuracy=0.01)
+    histogram.add(values[:5000])
+    for value in values[5000:]:
+        histogram.add(value)
+    percentiles = [1, 5, 10, 50, 90, 99]
+    expected = np.percentile(values, percentiles, method='lower')
+    assert np.allclose(histogram.percentiles(percentiles), expected, rtol=0.011)
+    assert histogram.count == len(values) and np.isclose(histogram.sum, values.sum())
+    assert histogram.min == values.min() and histogram.max == values.max()
+    lower, upper, counts = histogram.buckets()
+    assert counts.sum() == len(values) and (lower <= upper).all() and (upper[:-1] <= lower[1:]).all()
+
+    capped_histogram = StreamingHistogram(relative_accuracy=0.01, max_buckets=100)
+    capped_histogram.add(values)
+    assert len(capped_histogram.buckets()[2]) <= 2 * 100 + 1
+    assert np.isclose(capped_histogram.percentiles([99]), np.percentile(values, 99), rtol=0.011)
+
+
+def test_logger_metrics():
+    """
+    test that the counters and gauges are kept across dumps, and the histograms are written for one dump
+    """
+    writer = _CaptureWriter()
+    metrics_logger = Logger(folder=None, output_formats=[writer])
+    metrics_logger.counter("episodes")
+    metrics_logger.counter("steps", 10)
+    metrics_logger.gauge("buffer_size", 5)
+    metrics_logger.histogram("step_time", np.arange(1, 101))
+    metrics_logger.dumpkvs()
+    metrics_logger.counter("episodes", 2)
+    metrics_logger.dumpkvs()
+    metrics_logger.close()
+
+    assert [kvs["episodes"] for kvs in writer.kvs] == [1, 3]
+    assert [kvs["steps"] for kvs in writer.kvs] == [10, 10]
+    assert [kvs["buffer_size"] for kvs in writer.kvs] == [5, 5]
+    assert np.allclose([writer.kvs[0]["step_time/p" + str(percentile)] for percentile in (50, 90, 99)],
+                       [50, 90, 99], rtol=0.011)
+    assert "step_time/p50" not in writer.kvs[1]
+    assert len(writer.histograms) == 1 and writer.histograms[0]["step_time"].count == 100
+
+
+@pytest.mark.parametrize('log_format', ['csv', 'json'])
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_read_logs(tmp_path, log_format, n_workers):
+    """
+    test that the logs of several runs are read in long format, and cached
+    """
+    run_dirs = [str(tmp_path / "run_{}".format(run)) for run in range(3)]
+    for run, run_dir in enumerate(run_dirs):
+        configure(run_dir, [log_format])
+        for step in range(run + 1):
+            logkv("reward", run * 10 + step)
+            logkv("loss", 0.5)
+            logkv("name", "run")
+            dumpkvs()
+        reset()
+
+    data = read_logs(run_dirs, tags=["reward", "name"], log_format=log_format, n_workers=n_workers)
+    assert list(data.columns) == ["run", "tag", "step", "value"]
+    assert (data["tag"] == "reward").all()
+    assert data["run"].tolist() == [run_dirs[0]] + [run_dirs[1]] * 2 + [run_dirs[2]] * 3
+    assert data["step"].tolist() == [1, 1, 2, 1, 2, 3]
+    assert data["value"].tolist() == [0, 10, 11, 20, 21, 22]
+    log_file = "progress." + log_format
+    assert (tmp_path / "run_0" / (log_file + LOG_CACHE_EXT)).exists()
+
+    # Read from the caches
+    cached_data = read_logs(run_dirs, log_format=log_format, n_workers=n_workers)
+    assert set(cached_data["tag"]) == {"reward", "loss"}
+    assert cached_data[cached_data["tag"] == "reward"].reset_index(drop=True).equals(data)
@@ -6,7 +6,7 @@ import pandas
 import gym
 
 from stable_baselines.bench import Monitor
-from stable_baselines.bench.monitor import get_monitor_files, load_results
+from stable_baselines.bench.monitor import get_monitor_files, load_results, ResultsWriter
 
 
 def test_monitor():
@@ -57,6 +57,7 @@ def test_monitor_load_results(tmp_path):
         if done:
             episode_count1 += 1
             monitor_env1.reset()
+    monitor_env1.flush()
 
     results_size1 = len(load_results(os.path.join(tmp_path)).index)
     assert results_size1 == episode_count1
@@ -77,6 +78,7 @@ def test_monitor_load_results(tmp_path):
         if done:
             episode_count2 += 1
             monitor_env2.reset()
+    monitor_env2.flush()
 
     results_size2 = len(load_results(os.path.join(tmp_path)).index)
 
@@ -84,3 +86,94 @@ def test_monitor_load_results(tmp_path):
 
     os.remove(monitor_file1)
     os.remove(monitor_file2)
+
+
+def test_monitor_buffered_binary(tmp_path):
+    """
+    test that the monitor buffers the episodes, and that load_results reads its binary log files
+    """
+    tmp_path = str(tmp_path)
+    env = gym.make("CartPole-v1")
+    env.seed(0)
+    monitor_file = os.path.join(tmp_path, "stable_baselines-test-{}".format(uuid.uuid4()))
+    monitor_env = Monitor(env, monitor_file, flush_interval=float('inf'), flush_size=10, binary=True)
+    assert get_monitor_files(tmp_path) == [monitor_file + "." + Monitor.BINARY_EXT]
+    header_size = os.path.getsize(monitor_file + "." + Monitor.BINARY_EXT)
+
+    monitor_env.reset()
+    episodes = []
+    while len(episodes) < 15:
+        _, _, done, info = monitor_env.step(monitor_env.action_space.sample())
+        if done:
+            episodes.append(info['episode'])
+            monitor_env.reset()
+    # Only the first 10 episodes are written
+    assert os.path.getsize(monitor_file + "." + Monitor.BINARY_EXT) == header_size + 10 * 3 * 8
+    monitor_env.close()
+
+    results = load_results(tmp_path)
+    assert len(results) == 15
+    assert list(results['r']) == [episode['r'] for episode in episodes]
+    assert list(results['l']) == [episode['l'] for episode in episodes]
+    assert results['l'].sum() == monitor_env.get_total_steps()
+
+
+def test_load_results_cache(tmp_path):
+    """
+    test that load_results only parses the new complete rows of the csv logs, and its range queries
+    """
+    tmp_path = str(tmp_path)
+    writer = ResultsWriter(os.path.join(tmp_path, "0"), header={"t_start": 100.0, "env_id": None},
+                           fieldnames=('r', 'l', 't'), flush_size=1)
+    for episode in range(5):
+        writer.write_row({"r": float(episode), "l": 10, "t": float(episode)})
+    assert len(load_results(tmp_path)) == 5
+    assert os.path.exists(writer.filename + Monitor.CACHE_EXT)
+
+    for episode in range(5, 8):
+        writer.write_row({"r": float(episode), "l": 10, "t": float(episode)})
+    # A row being written is not loaded
+    writer.file_handler.write("8.0,10")
+    writer.file_handler.flush()
+    results = load_results(tmp_path)
+    assert list(results['r']) == [float(episode) for episode in range(8)]
+    writer.file_handler.write(",8.0\n")
+    writer.close()
+    results = load_results(tmp_path)
+    assert list(results['r']) == [float(episode) for episode in range(9)]
+    assert results.equals(load_results(tmp_path, cache=False))
+
+    # A new log replacing the file is parsed from the start
+    writer = ResultsWriter(os.path.join(tmp_path, "0"), header={"t_start": 200.0, "env_id": None},
+                           fieldnames=('r', 'l', 't'), flush_size=1)
+    writer.write_row({"r": 1.0, "l": 10, "t": 1.0})
+    writer.close()
+    assert list(load_results(tmp_path)['r']) == [1.0]
+
+    writer = ResultsWriter(os.path.join(tmp_path, "1"), header={"t_start": 200.0, "env_id": None},
+                           fieldnames=('r', 'l', 't'))
+    for episode in range(2, 10):
+        writer.write_row({"r": float(episode), "l": 10, "t": float(episode)})
+    writer.close()
+    assert list(load_results(tmp_path, time_range=(3, 5))['r']) == [3.0, 4.0, 5.0]
+    assert list(load_results(tmp_path, timesteps_range=(None, 30))['r']) == [1.0, 2.0, 3.0]
+
+
+def test_load_results_cache_strings(tmp_path):
+    """
+    test that the string columns are cached without pickled objects
+    """
+    tmp_path = str(tmp_path)
+    writer = ResultsWriter(os.path.join(tmp_path, "0"), header={"t_start": 100.0, "env_id": None},
+                           fieldnames=('r', 'l', 't', 'name'), flush_size=1)
+    for episode, name in enumerate(["a", "", "c,d"]):
+        writer.write_row({"r": float(episode), "l": 10, "t": float(episode), "name": name})
+    results = load_results(tmp_path)
+    with np.load(writer.filename + Monitor.CACHE_EXT, allow_pickle=False) as cache_file:
+        assert cache_file['column_name'].dtype.kind == 'U'
+    writer.write_row({"r": 3.0, "l": 10, "t": 3.0, "name": "e"})
+    writer.close()
+    cached_results = load_results(tmp_path)
+    assert cached_results[:3].equals(results)
+    assert cached_results.equals(load_results(tmp_path, cache=False))
+    assert cached_results['name'][0] == "a" and cached_results['name'].isnull()[1]
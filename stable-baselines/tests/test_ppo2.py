@@ -1,8 +1,49 @@
 import os
+import threading
 
+import gym
+import numpy as np
 import pytest
+import tensorflow as tf
 
 from stable_baselines import PPO2
+from stable_baselines.common.runners import RolloutStorage, compute_gae
+from stable_baselines.common.vec_env import DummyVecEnv, VecFrameStack
+
+N_ENVS = 3
+N_AGENTS = 2
+
+
+class MultiAgentEnv(gym.Env):
+    def __init__(self, num_agents=N_AGENTS, ep_length=5):
+        """
+        Multi-agent environment with a different random observation for each agent,
+        rewarding the agents whose action is their index parity
+        """
+        self.num_agents = num_agents
+        self.observation_space = gym.spaces.Box(low=-1, high=1, shape=(3,), dtype=np.float32)
+        self.action_space = gym.spaces.Discrete(2)
+        self.ep_length = ep_length
+        self.current_step = 0
+
+    def reset(self):
+        self.current_step = 0
+        return self._get_obs()
+
+    def step(self, action):
+        self.current_step += 1
+        rewards = (np.asarray(action) == np.arange(self.num_agents) % 2).astype(np.float32)
+        return self._get_obs(), rewards, self.current_step >= self.ep_length, {}
+
+    def _get_obs(self):
+        return np.random.uniform(-1, 1, size=(self.num_agents, 3)).astype(np.float32)
+
+    def render(self, mode='human'):
+        pass
+
+
+def make_multi_agent_env():
+    return DummyVecEnv([MultiAgentEnv for _ in range(N_ENVS)])
 
 
 @pytest.mark.parametrize("cliprange", [0.2, lambda x: 0.1 * x])
@@ -18,3 +59,167 @@ def test_clipping(cliprange, cliprange_vf):
 
     if os.path.exists('./ppo2_clip.zip'):
         os.remove('./ppo2_clip.zip')
+
+
+def test_compute_gae():
+    """Test the env-major GAE against a step-major reference, for single and multi agent rewards"""
+    n_envs, n_steps, n_agents, gamma, lam = 3, 5, 2, 0.99, 0.95
+    for extra_shape in [(), (n_agents,)]:
+        rewards = np.random.randn(n_steps, n_envs, *extra_shape).astype(np.float32)
+        values = np.random.randn(n_steps, n_envs, *extra_shape).astype(np.float32)
+        dones = np.random.rand(n_steps, n_envs) < 0.3
+        last_values = np.random.randn(n_envs, *extra_shape).astype(np.float32)
+        last_dones = np.random.rand(n_envs) < 0.3
+
+        expected = np.zeros_like(rewards)
+        last_gae_lam = 0
+        for step in reversed(range(n_steps)):
+            if step == n_steps - 1:
+                nextnonterminal, nextvalues = 1.0 - last_dones, last_values
+            else:
+                nextnonterminal, nextvalues = 1.0 - dones[step + 1], values[step + 1]
+            nextnonterminal = nextnonterminal.reshape((n_envs,) + (1,) * len(extra_shape))
+            delta = rewards[step] + gamma * nextvalues * nextnonterminal - values[step]
+            expected[step] = last_gae_lam = delta + gamma * lam * nextnonterminal * last_gae_lam
+
+        storage = RolloutStorage(n_envs, n_steps)
+        for step in range(n_steps):
+            storage.store(step, 'rewards', rewards[step], np.float32)
+            storage.store(step, 'values', values[step], np.float32)
+            storage.store(step, 'dones', dones[step], np.bool_)
+        advs = storage.allocate('advs', extra_shape, np.float32)
+        compute_gae(storage['rewards'], storage['values'], storage['dones'], last_values, last_dones,
+                    gamma, lam, out=advs)
+
+        assert np.allclose(advs, expected.swapaxes(0, 1), atol=1e-5)
+        assert np.allclose(storage.flat('advs'), expected.swapaxes(0, 1).reshape((n_envs * n_steps,) + extra_shape),
+                           atol=1e-5)
+
+
+def test_multi_agent_step():
+    """Test that the stacked multi-agent outputs match the outputs of each agent's policy, in the agents order"""
+    env = make_multi_agent_env()
+    model = PPO2('MlpPolicy', env, n_steps=8, nminibatches=2, seed=0)
+    obs = env.reset()
+
+    actions, values, _, _ = model.step(obs, None, None, deterministic=True)
+    assert actions.shape == (N_ENVS, N_AGENTS) and values.shape == (N_ENVS, N_AGENTS)
+    for i, agent_model in enumerate(model.models):
+        agent_actions, agent_values, _, _ = agent_model.step(obs[:, i], deterministic=True)
+        assert np.array_equal(actions[:, i], agent_actions)
+        assert np.allclose(values[:, i], agent_values)
+        assert np.allclose(model.value(obs, None, None)[:, i], agent_model.value(obs[:, i]))
+    # The agents have different observations, so their outputs differ
+    assert not np.allclose(values[:, 0], values[:, 1])
+
+    # The sampled actions and their neglogp, compared within a single graph execution
+    feed_dict, _ = model._multi_agent_feed_dict(obs)
+    (stacked_actions, stacked_neglogps), agent_outputs = model.sess.run(
+        [[model._multi_action, model._multi_neglogp],
+         [[agent_model.act_model.action, agent_model.act_model.neglogp] for agent_model in model.models]],
+        feed_dict)
+    for i, (agent_actions, agent_neglogps) in enumerate(agent_outputs):
+        assert np.array_equal(stacked_actions[:, i], agent_actions)
+        assert np.allclose(stacked_neglogps[:, i], agent_neglogps)
+
+    # A single observation, as when predicting
+    action, value, _, _ = model.step(obs[0], None, None, deterministic=True)
+    assert np.array_equal(action, actions[0]) and np.allclose(value, values[0])
+    env.close()
+
+
+def test_fused_agent_updates():
+    """Test that a fused update of all the agents equals the serial per-agent updates on the same minibatch"""
+    env = make_multi_agent_env()
+    model = PPO2('MlpPolicy', env, n_steps=8, nminibatches=2, fuse_agent_updates=True, seed=0)
+    env.close()
+    batch_size = 12
+    obs = np.random.uniform(-1, 1, size=(batch_size, N_AGENTS, 3)).astype(np.float32)
+    returns = np.random.randn(batch_size, N_AGENTS).astype(np.float32)
+    masks = np.zeros(batch_size, dtype=np.bool_)
+    actions = np.random.randint(2, size=(batch_size, N_AGENTS))
+    values = np.random.randn(batch_size, N_AGENTS).astype(np.float32)
+    neglogpacs = np.random.rand(batch_size, N_AGENTS).astype(np.float32)
+
+    with model.graph.as_default():
+        # Including the optimizer slots, to restart each update from the same state
+        variables = tf.global_variables()
+        agent_params = [tf.trainable_variables(scope="submodel_{}/".format(i)) for i in range(N_AGENTS)]
+    initial_values = model.sess.run(variables)
+
+    def restore():
+        for var, value in zip(variables, initial_values):
+            var.load(value, model.sess)
+
+    def agent_train_step(i):
+        return model.models[i]._train_step(1e-3, 0.2, obs[:, i], returns[:, i], masks, actions[:, i], values[:, i],
+                                           neglogpacs[:, i], update=0, writer=None, cliprange_vf=0.2)
+
+    fused_losses = model._fused_train_step(1e-3, 0.2, obs, returns, masks, actions, values, neglogpacs, update=0,
+                                           writer=None, cliprange_vf=0.2)
+    fused_params = model.sess.run(agent_params)
+
+    restore()
+    serial_losses = [agent_train_step(i) for i in range(N_AGENTS)]
+    serial_params = model.sess.run(agent_params)
+    assert np.allclose(fused_losses, serial_losses, atol=1e-6)
+    for fused_values, serial_values in zip(fused_params, serial_params):
+        for fused_value, serial_value in zip(fused_values, serial_values):
+            assert np.allclose(fused_value, serial_value, atol=1e-6)
+
+    # Each agent's parameters only change through its own train op
+    restore()
+    initial_params = model.sess.run(agent_params)
+    for i in range(N_AGENTS):
+        restore()
+        agent_train_step(i)
+        params = model.sess.run(agent_params)
+        for j in range(N_AGENTS):
+            changed = [not np.array_equal(value, initial_value)
+                       for value, initial_value in zip(params[j], initial_params[j])]
+            assert any(changed) if j == i else not any(changed)
+
+
+def test_pipeline_rollouts():
+    """Test that the pipelined rollouts are written in another storage than the one being trained on,
+    and that the background rollout is stopped when training stops early or raises"""
+    model = PPO2('MlpPolicy', make_multi_agent_env(), n_steps=8, nminibatches=2, pipeline_rollouts=True, seed=0)
+    trained_storages = []
+
+    def check_storage(_locals, _globals):
+        storages = [storage for storage in model.runner.storages
+                    if 'obs' in storage and np.shares_memory(storage['obs'], _locals['obs'])]
+        assert len(storages) == 1
+        trained_storages.append(storages[0])
+
+    model.learn(10 * N_ENVS * 8, callback=check_storage)
+    assert len(trained_storages) == 10
+    assert all(storage is not next_storage for storage, next_storage in zip(trained_storages, trained_storages[1:]))
+    assert not np.shares_memory(model.runner.storages[0]['obs'], model.runner.storages[1]['obs'])
+
+    threads = set(threading.enumerate())
+    model.learn(10 * N_ENVS * 8, callback=lambda _locals, _globals: False)
+    assert set(threading.enumerate()) <= threads
+
+    def raise_error(_locals, _globals):
+        raise ValueError("stop")
+
+    with pytest.raises(ValueError):
+        model.learn(10 * N_ENVS * 8, callback=raise_error)
+    assert set(threading.enumerate()) <= threads
+    model.env.close()
+
+
+def test_frame_stack_obs_views():
+    """Test that the runner gets views on the stacked frames of a VecFrameStack, and copies them into its storage"""
+    env = VecFrameStack(DummyVecEnv([lambda: gym.make('CartPole-v1')] * 2), n_stack=4)
+    model = PPO2('MlpPolicy', env, n_steps=8, nminibatches=2, seed=0)
+    copy_obs = []
+
+    def check_views(_locals, _globals):
+        copy_obs.append(env.copy_obs)
+        assert not np.shares_memory(_locals['obs'], env.stackedobs)
+
+    model.learn(2 * 2 * 8, callback=check_views)
+    assert copy_obs == [False, False] and env.copy_obs
+    env.close()
@@ -0,0 +1,308 @@
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from stable_baselines.acer.buffer import Buffer
+from stable_baselines.deepq.replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, MemmapReplayBuffer, \
+    NStepReplayBuffer, PrefetchReplayBuffer, FramePoolReplayBuffer
+
+
+def _transitions(n_transitions, obs_shape=(3,)):
+    obs = np.arange((n_transitions + 1) * int(np.prod(obs_shape)), dtype=np.float32)
+    obs = obs.reshape((n_transitions + 1,) + obs_shape)
+    actions = np.arange(n_transitions)
+    rewards = np.arange(n_transitions, dtype=np.float32) / 10
+    dones = (np.arange(n_transitions) % 4 == 3).astype(np.float32)
+    return obs[:-1], actions, rewards, obs[1:], dones
+
+
+def test_replay_buffer_add_sample():
+    """
+    test that the columnar buffer keeps the last transitions and samples consistent batches
+    """
+    buffer = ReplayBuffer(5)
+    obs_t, actions, rewards, obs_tp1, dones = _transitions(8)
+    for i in range(8):
+        buffer.add(obs_t[i], actions[i], rewards[i], obs_tp1[i], float(dones[i]))
+
+    assert len(buffer) == 5 and buffer.is_full()
+    assert sorted(buffer.storage[i][1] for i in range(len(buffer))) == [3, 4, 5, 6, 7]
+
+    s_obs_t, s_actions, s_rewards, s_obs_tp1, s_dones = buffer.sample(32)
+    assert s_obs_t.shape == (32, 3) and s_actions.shape == (32,)
+    assert np.all(s_actions >= 3)
+    assert np.allclose(s_obs_t, obs_t[s_actions])
+    assert np.allclose(s_obs_tp1, obs_tp1[s_actions])
+    assert np.allclose(s_rewards, rewards[s_actions])
+    assert np.allclose(s_dones, dones[s_actions])
+
+
+def test_replay_buffer_extend():
+    """
+    test that adding transitions in batches is equivalent to adding them one by one
+    """
+    transitions = _transitions(11)
+    buffer, batch_buffer = ReplayBuffer(7), ReplayBuffer(7)
+    for i in range(11):
+        buffer.add(*(arr[i] for arr in transitions))
+    batch_buffer.extend(*(arr[:4] for arr in transitions))
+    batch_buffer.extend(*(arr[4:] for arr in transitions))
+
+    assert len(batch_buffer) == len(buffer)
+    for expected, stored in zip(buffer._encode_sample(np.arange(7)), batch_buffer._encode_sample(np.arange(7))):
+        assert np.allclose(expected, stored)
+
+    # A batch larger than the buffer only keeps its last transitions
+    small_buffer = ReplayBuffer(3)
+    small_buffer.extend(*transitions)
+    assert sorted(small_buffer.storage[i][1] for i in range(3)) == [8, 9, 10]
+
+
+def test_prioritized_replay_buffer_extend():
+    """
+    test that transitions added in batches get the maximum priority
+    """
+    buffer = PrioritizedReplayBuffer(8, alpha=0.6)
+    transitions = _transitions(6)
+    buffer.extend(*(arr[:2] for arr in transitions))
+    buffer.update_priorities(np.array([0, 1]), np.array([2.0, 0.5]))
+    buffer.extend(*(arr[2:] for arr in transitions))
+
+    assert np.allclose(buffer._it_sum[np.arange(2, 6)], 2.0 ** 0.6)
+    *_, weights, idxes = buffer.sample(16, beta=0.4)
+    assert np.all(idxes < 6) and weights.shape == (16,)
+
+
+def test_replay_buffer_dedup_obs():
+    """
+    test that storing each observation once returns the same transitions
+    """
+    obs_t, actions, rewards, obs_tp1, dones = _transitions(23, obs_shape=(2, 2))
+    # Episodes are reset after they are done, and the stream is broken once by hand
+    obs_tp1[dones == 1] += 100
+    obs_t[10] -= 50
+    for buffer_class, kwargs in [(ReplayBuffer, {}), (PrioritizedReplayBuffer, {'alpha': 0.6})]:
+        buffer = buffer_class(9, **kwargs)
+        dedup_buffer = buffer_class(9, dedup_obs=True, **kwargs)
+        for i in range(23):
+            buffer.add(obs_t[i], actions[i], rewards[i], obs_tp1[i], float(dones[i]))
+            dedup_buffer.add(obs_t[i], actions[i], rewards[i], obs_tp1[i], float(dones[i]))
+            idxes = np.arange(len(buffer))
+            for expected, stored in zip(buffer._encode_sample(idxes), dedup_buffer._encode_sample(idxes)):
+                assert np.allclose(expected, stored)
+
+        assert dedup_buffer._obses_t.shape == (10, 2, 2)
+        # Only the terminal observations of the stored transitions are kept apart
+        assert len(dedup_buffer._apart_next_obses) == int(np.sum(dones[-9:]))
+
+    # A batch of consecutive transitions is a stream, a batch from several envs is not
+    dedup_buffer = ReplayBuffer(9, dedup_obs=True)
+    dedup_buffer.extend(obs_t[:10], actions[:10], rewards[:10], obs_tp1[:10], dones[:10])
+    with pytest.raises(ValueError):
+        dedup_buffer.extend(obs_t[11:14], actions[11:14], rewards[11:14], obs_t[11:14] + 1, np.zeros(3))
+
+
+def test_memmap_replay_buffer(tmp_path):
+    """
+    test that the memory-mapped buffer can be reopened and snapshotted
+    """
+    transitions = _transitions(13)
+    for dedup_obs in [False, True]:
+        buffer = ReplayBuffer(8, dedup_obs=dedup_obs)
+        memmap_buffer = MemmapReplayBuffer(8, str(tmp_path / "buffer"), dedup_obs=dedup_obs)
+        for i in range(10):
+            buffer.add(*(arr[i] for arr in transitions))
+            memmap_buffer.add(*(arr[i] for arr in transitions))
+        memmap_buffer.flush()
+        memmap_buffer.snapshot(str(tmp_path / "snapshot"))
+
+        # Resume adding transitions to the reopened buffer
+        reopened = MemmapReplayBuffer.load(str(tmp_path / "buffer"))
+        for i in range(10, 13):
+            buffer.add(*(arr[i] for arr in transitions))
+            reopened.add(*(arr[i] for arr in transitions))
+        assert len(reopened) == len(buffer)
+        for expected, stored in zip(buffer._encode_sample(np.arange(8)), reopened._encode_sample(np.arange(8))):
+            assert np.allclose(expected, stored)
+
+        # The snapshot still holds the first transitions
+        snapshot = MemmapReplayBuffer.load(str(tmp_path / "snapshot"), mode='c')
+        assert sorted(snapshot.storage[i][1] for i in range(8)) == list(range(2, 10))
+        s_obs_t, s_actions, _, s_obs_tp1, _ = snapshot.sample(16)
+        assert np.allclose(s_obs_t, transitions[0][s_actions])
+        assert np.allclose(s_obs_tp1, transitions[3][s_actions])
+
+        # Copy of an in-memory buffer
+        copy = MemmapReplayBuffer.from_buffer(buffer, str(tmp_path / "copy"))
+        assert [copy.storage[i][1] for i in copy.ordered_idxes()] == list(range(5, 13))
+
+
+def test_memmap_replay_buffer_copy_dedup(tmp_path):
+    """
+    test that copying a dedup_obs buffer keeps its observation stream, across episodes and broken streams
+    """
+    obs_t, actions, rewards, obs_tp1, dones = _transitions(20, obs_shape=(2,))
+    obs_t, obs_tp1 = obs_t.copy(), obs_tp1.copy()
+    # The episodes end with terminal observations, and the stream is broken once by hand
+    obs_tp1[dones == 1] += 100
+    obs_t[7] -= 50
+    assert dones[:12].any()
+    buffer = ReplayBuffer(9, dedup_obs=True)
+    for i in range(12):
+        buffer.add(obs_t[i], actions[i], rewards[i], obs_tp1[i], dones[i])
+    copy = MemmapReplayBuffer.from_buffer(buffer, str(tmp_path / "copy"))
+    for i in range(12, 20):
+        buffer.add(obs_t[i], actions[i], rewards[i], obs_tp1[i], dones[i])
+        copy.add(obs_t[i], actions[i], rewards[i], obs_tp1[i], dones[i])
+    idxes = buffer.ordered_idxes()
+    assert np.array_equal(copy.ordered_idxes(), idxes)
+    for expected, stored in zip(buffer._encode_sample(idxes), copy._encode_sample(idxes)):
+        assert np.array_equal(expected, stored)
+    assert np.array_equal(copy._encode_sample(idxes)[3], obs_tp1[11:])
+
+
+def test_n_step_replay_buffer():
+    """
+    test the n-step transitions of several envs against the definition
+    """
+    n_step, gamma, n_envs, n_steps = 3, 0.9, 2, 12
+    obs = np.random.random((n_steps + 1, n_envs, 2))
+    rewards = np.random.random((n_steps, n_envs))
+    dones = np.zeros((n_steps, n_envs), dtype=bool)
+    dones[4, 0] = dones[5, 1] = dones[6, 1] = True
+    buffer = NStepReplayBuffer(100, n_step=n_step, gamma=gamma)
+    for step in range(n_steps):
+        buffer.extend(obs[step], np.arange(n_envs) + 10 * step, rewards[step], obs[step + 1], dones[step])
+
+    expected = []
+    for env in range(n_envs):
+        for step in range(n_steps):
+            discounted_reward, end = 0.0, step
+            while True:
+                discounted_reward += gamma ** (end - step) * rewards[end, env]
+                if dones[end, env] or end - step == n_step - 1 or end == n_steps - 1:
+                    break
+                end += 1
+            # The last transitions are still waiting for their rewards
+            if dones[end, env] or end - step == n_step - 1:
+                expected.append((10 * step + env, discounted_reward, end, dones[end, env], gamma ** (end - step + 1)))
+
+    assert len(buffer) == len(expected)
+    stored = {transition[1]: transition for transition in (buffer.storage[i] for i in range(len(buffer)))}
+    for action, discounted_reward, end, done, discount in expected:
+        obs_t, _, reward, obs_tp1, stored_done, stored_discount = stored[action]
+        env, step = action % 10, action // 10
+        assert np.allclose(obs_t, obs[step, env]) and np.allclose(obs_tp1, obs[end + 1, env])
+        assert np.isclose(reward, discounted_reward) and stored_done == done and np.isclose(stored_discount, discount)
+    assert len(buffer.sample(8)) == 6
+
+
+def test_prefetch_replay_buffer():
+    """
+    test that the prefetched batches are consistent while transitions are added
+    """
+    obs_t, actions, rewards, obs_tp1, dones = _transitions(40)
+    with PrefetchReplayBuffer(ReplayBuffer(30), batch_size=8, n_batches=2) as buffer:
+        buffer.extend(obs_t[:10], actions[:10], rewards[:10], obs_tp1[:10], dones[:10])
+        for i in range(10, 40):
+            s_obs_t, s_actions, s_rewards, s_obs_tp1, s_dones = buffer.sample(8)
+            assert s_obs_t.shape == (8, 3)
+            assert np.allclose(s_obs_t, obs_t[s_actions]) and np.allclose(s_obs_tp1, obs_tp1[s_actions])
+            assert np.allclose(s_rewards, rewards[s_actions]) and np.allclose(s_dones, dones[s_actions])
+            buffer.add(obs_t[i], actions[i], rewards[i], obs_tp1[i], dones[i])
+        # Other batch sizes are sampled synchronously
+        assert buffer.sample(5)[0].shape == (5, 3)
+        assert len(buffer) == 30 and buffer.is_full()
+    assert buffer._thread is None
+
+    with pytest.raises(ValueError):
+        PrefetchReplayBuffer(PrioritizedReplayBuffer(10, alpha=0.6), batch_size=8)
+
+    def sample_seeded():
+        np.random.seed(0)
+        with PrefetchReplayBuffer(ReplayBuffer(30), batch_size=8) as seeded_buffer:
+            seeded_buffer.extend(obs_t[:30], actions[:30], rewards[:30], obs_tp1[:30], dones[:30])
+            sampled_actions = [seeded_buffer.sample(8)[1] for _ in range(3)]
+            # The sampling thread does not draw from the global random generator
+            return sampled_actions, np.random.random(3)
+
+    (sampled_actions, draws), (other_sampled_actions, other_draws) = sample_seeded(), sample_seeded()
+    assert np.array_equal(sampled_actions, other_sampled_actions) and np.array_equal(draws, other_draws)
+    np.random.seed(0)
+    np.random.randint(2 ** 31)
+    assert np.array_equal(draws, np.random.random(3))
+
+
+@pytest.mark.parametrize("n_stack", [1, 4])
+def test_acer_buffer_frame_stack(n_stack):
+    """
+    test that the ACER buffer rebuilds the frame stacks of the stored rollouts, reset at the episode starts
+    """
+    n_env, n_steps, frame_shape = 3, 6, (2, 2, 1)
+    env = SimpleNamespace(num_envs=n_env, observation_space=SimpleNamespace(shape=frame_shape[:-1] + (n_stack,)))
+    buffer = Buffer(env, n_steps, size=n_steps, n_stack=n_stack)
+
+    rng = np.random.RandomState(0)
+    frames = rng.randint(1, 255, size=(n_steps + 1, n_env) + frame_shape).astype(np.uint8)
+    # The first observation comes from an unfinished episode
+    stacked = rng.randint(1, 255, size=(n_env,) + frame_shape[:-1] + (n_stack,)).astype(np.uint8)
+    masks = rng.rand(n_env, n_steps + 1) < 0.3
+    enc_obs = [stacked.copy()]
+    for step in range(1, n_steps + 1):
+        stacked = np.roll(stacked, shift=-1, axis=-1)
+        stacked[masks[:, step]] = 0
+        stacked[..., -1:] = frames[step]
+        enc_obs.append(stacked.copy())
+    enc_obs = np.asarray(enc_obs).swapaxes(1, 0)
+    actions = rng.randint(0, 2, size=(n_env, n_steps))
+    rewards = rng.rand(n_env, n_steps).astype(np.float32)
+    mus = rng.rand(n_env, n_steps, 2).astype(np.float32)
+    dones = masks[:, 1:]
+
+    buffer.put(enc_obs, actions, rewards, mus, dones, masks)
+    assert buffer.enc_obs.shape == (1, n_env, n_steps + n_stack) + frame_shape
+    obs, actions_, rewards_, mus_, dones_, masks_ = buffer.get()
+    assert obs.dtype == np.uint8
+    assert np.array_equal(obs, enc_obs)
+    assert np.array_equal(actions_, actions) and np.array_equal(rewards_, rewards) and np.array_equal(mus_, mus)
+    assert np.array_equal(dones_, dones) and np.array_equal(masks_, masks)
+
+
+def test_frame_pool_replay_buffer():
+    """
+    test that the frame pool stores the frames shared by consecutive LazyFrames once and rebuilds the stacks
+    """
+    from stable_baselines.common.atari_wrappers import LazyFrames
+
+    size, n_frames = 10, 4
+    rng = np.random.RandomState(0)
+    buffer, reference = FramePoolReplayBuffer(size), ReplayBuffer(size)
+    frames = deque(maxlen=n_frames)
+    obs = None
+    for step in range(37):
+        if obs is None:
+            # Reset, as FrameStack does
+            frame = rng.randint(0, 255, size=(2, 2, 1)).astype(np.uint8)
+            frames.extend([frame] * n_frames)
+            obs = LazyFrames(list(frames))
+        frames.append(rng.randint(0, 255, size=(2, 2, 1)).astype(np.uint8))
+        new_obs = LazyFrames(list(frames))
+        done = step % 7 == 6
+        # The policy reads the observations before they are stored, which drops their frame lists
+        np.asarray(obs)
+        assert obs.frames is None
+        for replay_buffer in (buffer, reference):
+            replay_buffer.add(obs, step % 3, float(step), new_obs, float(done))
+        obs = None if done else new_obs
+
+    assert np.sum(buffer._frame_counts > 0) <= size + 2 * n_frames
+    for field, expected in zip(buffer._encode_sample(buffer.ordered_idxes()),
+                               reference._encode_sample(reference.ordered_idxes())):
+        assert np.array_equal(field, expected)
+    # Observations that are not LazyFrames are split in frames
+    stacked = rng.randint(0, 255, size=(2, 2, n_frames)).astype(np.uint8)
+    buffer.add(stacked, 0, 0.0, stacked, 1.0)
+    obses_t, _, _, obses_tp1, _ = buffer._encode_sample(buffer.ordered_idxes()[-1:])
+    assert np.array_equal(obses_t[0], stacked) and np.array_equal(obses_tp1[0], stacked)
@@ -1,6 +1,7 @@
 import numpy as np
+import pytest
 
-from stable_baselines.common.segment_tree import SumSegmentTree, MinSegmentTree
+from stable_baselines.common.segment_tree import SegmentTree, SumSegmentTree, MinSegmentTree
 
 
 def test_tree_set():
@@ -186,9 +187,71 @@ def test_max_interval_tree():
     assert np.isclose(tree.min(3, 4), 3.0)
 
 
+def test_batched_update_and_sample():
+    """
+    test batched updates with repeated indexes against a plain array, and sampling in one descent
+    """
+    np.random.seed(0)
+    values = np.random.random(size=32)
+    sum_tree, min_tree = SumSegmentTree(32), MinSegmentTree(32)
+    sum_tree[np.arange(32)] = values
+    min_tree[np.arange(32)] = values
+    for _ in range(10):
+        idxes = np.random.randint(0, 32, size=12)
+        new_values = np.random.random(size=12)
+        # With repeated indexes, the last value is kept
+        values[idxes] = new_values
+        sum_tree[idxes] = new_values
+        min_tree[idxes] = new_values
+        start, end = sorted(np.random.randint(0, 33, size=2))
+        assert np.isclose(sum_tree.sum(), values.sum())
+        assert np.isclose(sum_tree.sum(start, end), values[start:end].sum())
+        if start < end:
+            assert np.isclose(min_tree.min(start, end), values[start:end].min())
+
+    values[:] = 0.0
+    values[[3, 17]] = [1.0, 3.0]
+    sum_tree = SumSegmentTree(32)
+    sum_tree[np.arange(32)] = values
+    for stratified in [False, True]:
+        idxes = sum_tree.sample(4000, stratified=stratified)
+        assert set(np.unique(idxes)) == {3, 17}
+        assert np.isclose(np.mean(idxes == 17), 0.75, atol=0.05)
+    # Stratified sampling splits the total in equal segments
+    assert np.all(sum_tree.sample(4, stratified=True) == [3, 17, 17, 17])
+
+
+def test_sample_end():
+    """
+    test that sampling before an end index only reaches the leaves before it, in proportion to their values
+    """
+    np.random.seed(0)
+    sum_tree = SumSegmentTree(8)
+    sum_tree[np.arange(4)] = [1.0, 3.0, 0.0, 4.0]
+    for stratified in [False, True]:
+        idxes = sum_tree.sample(4000, stratified=stratified, end=3)
+        assert set(np.unique(idxes)) == {0, 1}
+        assert np.isclose(np.mean(idxes == 1), 0.75, atol=0.05)
+    assert np.all(sum_tree.sample(4, stratified=True, end=2) == [0, 1, 1, 1])
+
+
+def test_tree_operation():
+    """
+    test that the trees only take numpy ufuncs as operation
+    """
+    with pytest.raises(AssertionError):
+        SegmentTree(4, operation=lambda a, b: a + b, neutral_element=0.0)
+    tree = SegmentTree(4, operation=np.maximum, neutral_element=float('-inf'))
+    tree[np.arange(4)] = [1.0, 5.0, 2.0, 3.0]
+    assert tree.reduce() == 5.0 and tree.reduce(2, 4) == 3.0
+
+
 if __name__ == '__main__':
     test_tree_set()
     test_tree_set_overlap()
     test_prefixsum_idx()
     test_prefixsum_idx2()
     test_max_interval_tree()
+    test_batched_update_and_sample()
+    test_sample_end()
+    test_tree_operation()
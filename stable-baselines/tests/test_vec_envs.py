@@ -7,11 +7,12 @@ import pytest
 import gym
 import numpy as np
 
-from stable_baselines.common.vec_env import DummyVecEnv, SubprocVecEnv, VecNormalize, VecFrameStack
+from stable_baselines.bench.monitor import load_results
+from stable_baselines.common.vec_env import DummyVecEnv, SubprocVecEnv, VecNormalize, VecFrameStack, VecMonitor
 
 N_ENVS = 3
 VEC_ENV_CLASSES = [DummyVecEnv, SubprocVecEnv]
-VEC_ENV_WRAPPERS = [None, VecNormalize, VecFrameStack]
+VEC_ENV_WRAPPERS = [None, VecNormalize, VecFrameStack, VecMonitor]
 
 
 class CustomGymEnv(gym.Env):
@@ -141,6 +142,89 @@ class StepEnv(gym.Env):
         return np.array([prev_step], dtype='int'), 0.0, done, {}
 
 
+class RewardEnv(StepEnv):
+    def __init__(self, max_steps, num_agents=None):
+        """Gym environment rewarding the step number (scaled by the agent number for several agents)"""
+        super(RewardEnv, self).__init__(max_steps)
+        if num_agents is not None:
+            self.num_agents = num_agents
+
+    def step(self, action):
+        obs, _, done, info = super(RewardEnv, self).step(action)
+        if getattr(self, 'num_agents', None) is None:
+            return obs, float(self.current_step), done, info
+        return obs, self.current_step * np.arange(1, self.num_agents + 1, dtype=np.float32), done, info
+
+
+@pytest.mark.parametrize('num_agents', [None, 2])
+def test_vec_monitor(tmp_path, num_agents):
+    """Test that VecMonitor reports the episodes of all the envs in the infos and the log file"""
+    tmp_path = str(tmp_path)
+    max_steps = [2, 3]
+    vec_env = VecMonitor(DummyVecEnv([functools.partial(RewardEnv, n_steps, num_agents) for n_steps in max_steps]),
+                         tmp_path)
+    vec_env.reset()
+    episodes = []
+    for _ in range(6):
+        _, _, dones, infos = vec_env.step(np.zeros(len(max_steps)))
+        for env_idx in np.flatnonzero(dones):
+            episodes.append((env_idx, infos[env_idx]['episode']))
+    vec_env.close()
+
+    # 3 episodes of the first env and 2 of the second one
+    assert [env_idx for env_idx, _ in episodes] == [0, 1, 0, 0, 1]
+    scales = np.arange(1, (num_agents or 1) + 1)
+    for env_idx, episode in episodes:
+        n_steps = max_steps[env_idx]
+        assert episode['l'] == n_steps
+        agent_returns = scales * n_steps * (n_steps + 1) / 2
+        assert episode['r'] == pytest.approx(agent_returns.mean())
+        if num_agents is not None:
+            assert [episode['r_{}'.format(agent)] for agent in range(num_agents)] == pytest.approx(agent_returns)
+    # The episodes that end at the same step have the same time
+    results = load_results(tmp_path).sort_values(['t', 'l'])
+    episodes = sorted(episodes, key=lambda episode: (episode[1]['t'], episode[1]['l']))
+    assert list(results['l']) == [episode['l'] for _, episode in episodes]
+    assert list(results['r']) == pytest.approx([episode['r'] for _, episode in episodes])
+
+
+@pytest.mark.parametrize('copy_obs', [True, False])
+def test_vec_frame_stack(copy_obs):
+    """Test that the frame stack matches shifting the stack at each step,
+    with the stacks of the finished episodes zeroed"""
+    n_stack = 3
+    vec_env = VecFrameStack(DummyVecEnv([functools.partial(StepEnv, n) for n in [4, 7]]), n_stack=n_stack,
+                            copy_obs=copy_obs)
+    expected = np.zeros((2, n_stack), dtype='int')
+    obs = vec_env.reset()
+    assert np.array_equal(obs, expected)
+    for _ in range(20):
+        prev_obs = obs.copy()
+        obs, _, dones, infos = vec_env.step(np.zeros((2,), dtype='int'))
+        expected = np.roll(expected, shift=-1, axis=-1)
+        for i in np.flatnonzero(dones):
+            assert np.array_equal(infos[i]['terminal_observation'][:-1], prev_obs[i, 1:])
+            expected[i] = 0
+        expected[:, -1] = [env.current_step - 1 if not done else 0
+                           for env, done in zip(vec_env.venv.envs, dones)]
+        assert np.array_equal(obs, expected)
+        assert copy_obs or np.shares_memory(obs, vec_env.stackedobs)
+
+
+def test_vec_frame_stack_obs_views():
+    """Test that the frame stack returns views on its buffer, without copying the stack, inside obs_views"""
+    vec_env = VecFrameStack(DummyVecEnv([functools.partial(StepEnv, n) for n in [4, 7]]), n_stack=3)
+    obs = vec_env.reset()
+    with vec_env.obs_views():
+        view_obs, _, _, _ = vec_env.step(np.zeros((2,), dtype='int'))
+        assert np.shares_memory(view_obs, vec_env.stackedobs)
+        expected = view_obs.copy()
+    obs, _, _, _ = vec_env.step(np.zeros((2,), dtype='int'))
+    assert vec_env.copy_obs and not np.shares_memory(obs, vec_env.stackedobs)
+    # The view follows the frame buffer, the copy does not
+    assert not np.array_equal(view_obs, expected) and np.array_equal(obs, vec_env.stackedobs)
+
+
 @pytest.mark.parametrize('vec_env_class', VEC_ENV_CLASSES)
 @pytest.mark.parametrize('vec_env_wrapper', VEC_ENV_WRAPPERS)
 def test_vecenv_terminal_obs(vec_env_class, vec_env_wrapper):